@@ -5,28 +5,88 @@
 警告: 默认配置中应用将扫描 192.168.*.* 共65536个IP网址, 且服务器IP可能没有在扫描列表中;
      默认扫描端口号为5001, 服务器可能应用与其他端口。 建议使用前先配置IP+端口
 """
+import io
 import os
 import re
 import sys
 import copy
+import math
+import socket
+import gzip
+import zlib
+import errno
+import random
+import struct
+import select
+import ctypes
+import ctypes.util
+import asyncio
+import threading
 import time
 import typing
-import threading
+import statistics
 import itertools
 import functools
+import ipaddress
 import subprocess
+import urllib.parse
 
 import csv
+import json
 import yaml
 import requests
 
+try:
+    import zstandard  # 可选, 压缩比 gzip 快
+except ImportError:
+    zstandard = None
+
 VERSION = "0.0.1"
+DATA_FORMAT = "json/1"  # 上传数据的编码格式, 见服务器端 payload.py
+POOL_CONNECTIONS = 8  # 连接池最多保留的主机数
+POOL_MAXSIZE = 4  # 每个主机最多保留的空闲连接数
+COMPRESS_MIN_SIZE = 1024  # 请求体达到此字节数才压缩, 更短的压缩后几乎不会变小
+# 本机可用的请求体压缩格式, 按优先顺序, 与服务器登录回复中的 "content_encodings" 协商
+CONTENT_ENCODINGS = ("zstd", "gzip", "deflate") if zstandard is not None else ("gzip", "deflate")
+MEASURE_ROWS = (100, 1000, 10000)  # 测量模式上传的行数
+SCAN_CONCURRENCY = 2048  # 扫描时默认同时进行的连接数
+# UDP 信标, 与服务器端 beacon.py 一致
+BEACON_QUERY = b"NUMQ/1"
+BEACON_REPLY = b"NUMB/1 "
+BEACON_QUERY_SIZE = 128  # 查询补齐到的长度, 服务器忽略更短的查询
+BEACON_RESEND = 0.25  # 没有回复时重发查询的间隔(s)
+BEACON_GATHER = 0.1  # 收到第一个回复后继续等待其他服务器的时间(s)
+KEEP_ALIVE_INTERVAL = 1  # 旧版服务器没有给出心跳间隔时使用(s), 需小于服务器端的 nuc_disconnect_time(s)
+POLL_INTERVAL = 0.5  # 不支持 inotify 时检查上传文件的间隔(s)
+SPOOL_BATCH_ROWS = 5000  # 离线队列每个文件、每个上传请求最多包含的行数
+UPLOAD_CONNECT_TIMEOUT = 3  # 上传时建立连接的超时(s)
+UPLOAD_TIMEOUT = 5  # 上传时等待服务器回复的基本超时(s)
+UPLOAD_MIN_RATE = 256 * 1024  # 按此速率(字节/s)给较大的请求体增加回复超时, 包括传输与服务器解析的时间
+BACKOFF_BASE = 1  # 连接失败后第一次重试前的等待时间(s), 之后每次加倍
+BACKOFF_MAX = 60  # 重试等待时间的上限(s)
 
 
 class StopSettingIteration(Exception):
     pass
 
 
+def new_session() -> requests.Session:
+    """
+    建立与服务器通信的会话, 复用 TCP 连接(keep-alive), 每次心跳不必重新握手
+    """
+    s = requests.Session()
+    s.headers["User-Agent"] = f"NumOnlineAPP/{VERSION}"
+    # max_retries 只重试连接失败(如空闲连接已被服务器关闭), 已经发出的请求不会重发
+    adapter = requests.adapters.HTTPAdapter(pool_connections=POOL_CONNECTIONS, pool_maxsize=POOL_MAXSIZE,
+                                            max_retries=1)
+    s.mount("http://", adapter)
+    s.mount("https://", adapter)
+    return s
+
+
+session = new_session()
+
+
 def get_user_name(default="False") -> str:
     if os.name == "win32":
         # Windows system
@@ -358,8 +418,9 @@ def generate_config() -> dict:
     """
     config = {'config_file': '~/.pyNumOnline/config.yaml',
               'upload_file': '~/.pyNumOnline/upload.csv',
-              'search': {'ips': ["192.168.*.*"], 'timeout': 1, "threads": 10},
-              'upload': {'signal_port': 5432, 'command_text': 'send_file'},
+              'search': {'ips': ["192.168.*.*"], 'timeout': 1, "concurrency": SCAN_CONCURRENCY,
+                         "single_server": True, "beacon_timeout(s)": 1, "beacon_addresses": ["255.255.255.255"]},
+              'upload': {'signal_port': 5432, 'command_text': 'send_file', 'spool_dir': '~/.pyNumOnline/spool'},
               'server': {'server_port': 5001, 'upload_delay(s)': 500, 'reconnect_times': 40, 'ping_delay(s)': 15}}
     backup = copy.deepcopy(config)
     ans = None
@@ -449,136 +510,793 @@ def ping_function(ip, port, timeout) -> bool:
     url = f"http://{ip}:{port}"
     # print(url, end="", flush=True)
     try:
-        r = requests.get(url, headers={"User-Agent": f"NumOnlineAPP/{VERSION}"}, timeout=timeout)
+        r = session.get(url, timeout=timeout)
         r.raise_for_status()
     except (requests.exceptions.InvalidSchema, requests.exceptions.ConnectionError):
         return False
     return r.url.endswith("/app_login")
 
 
-def ping_thread_target(ls, ips, port, timeout):
-    for ip in ips:
-        ls.append(ping_function(ip, port, timeout))
+class ScanProgress:
+    """
+    扫描进度, 由扫描协程更新, 显示协程每 0.3s 输出一次
+    """
+
+    def __init__(self, total: int | None):
+        self.total = total  # 地址总数, 未知时为 None
+        self.done = 0  # 已完成的地址数
+        self.open = 0  # 端口开放的地址数
+        self.found = []  # 确认是服务器的地址
+
 
+def _is_emfile(err: OSError) -> bool:
+    return err.errno in (errno.EMFILE, errno.ENFILE)
 
-def try_ips(ips: typing.Iterable[str], port: int, timeout: int = 1, threads: int = 1) -> list[str]:
+
+async def _read_head(loop, sock: socket.socket) -> bytes:
     """
-    多线程尝试ips中的地址是否是服务器IP
-    :return: 可用的IP
+    读取 HTTP 回复头, 对方关闭连接时返回已收到的部分
     """
-    ips = list(ips)
-    groups = []
-    ip_ok = []
-    pool = []
-    for i in range(threads):
-        ok = []
-        ip_ok.append(ok)
-        group = ips[i::threads]
-        groups.append(group)
-        t = threading.Thread(target=functools.partial(ping_thread_target, ok, group, port, timeout), daemon=True)
-        pool.append(t)
-        t.start()
-    number = len(ips)
-    times = -1
+    head = b""
+    while b"\r\n\r\n" not in head and len(head) < 65536:
+        chunk = await loop.sock_recv(sock, 4096)
+        if not chunk:
+            break
+        head += chunk
+    return head.partition(b"\r\n\r\n")[0]
+
+
+async def probe_server(ip: str, port: int, timeout: float, progress: ScanProgress) -> bool:
+    """
+    两步检查一个地址:
+      1. 非阻塞的 TCP 连接, 端口未开放时到此为止, 绝大多数地址只需要这一步
+      2. 端口开放时在同一个连接上发送 HTTP 请求, 检查是否跳转到 /app_login (与 ping_function 的判断一致)
+    直接使用非阻塞套接字, 不建立 asyncio 的 Stream, 每个地址的开销更小
+    :return: 是否是服务器
+    """
+    loop = asyncio.get_running_loop()
+    while True:
+        try:
+            sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        except OSError as err:
+            if not _is_emfile(err):
+                raise
+            # 打开的文件过多, 等其他连接关闭后重试
+            await asyncio.sleep(0.05)
+            continue
+        break
+    try:
+        sock.setblocking(False)
+        try:
+            await asyncio.wait_for(loop.sock_connect(sock, (ip, port)), timeout)
+        except (OSError, asyncio.TimeoutError):
+            return False
+        progress.open += 1
+        request = f"GET / HTTP/1.0\r\nHost: {ip}:{port}\r\nUser-Agent: NumOnlineAPP/{VERSION}\r\n\r\n"
+        try:
+            await asyncio.wait_for(loop.sock_sendall(sock, request.encode()), timeout)
+            head = await asyncio.wait_for(_read_head(loop, sock), timeout)
+        except (OSError, asyncio.TimeoutError):
+            return False
+    finally:
+        sock.close()
+    lines = head.decode("latin-1").split("\r\n")
+    status = lines[0].split(" ")
+    if len(status) < 2 or not status[1].startswith("3"):
+        return False
+    for line in lines[1:]:
+        key, _, value = line.partition(":")
+        if key.strip().lower() == "location":
+            return urllib.parse.urlsplit(value.strip()).path.endswith("/app_login")
+    return False
+
+
+async def scan_ips(ips: typing.Iterable[str], port: int, timeout: float, concurrency: int,
+                   first_only: bool, progress: ScanProgress) -> list[str]:
+    """
+    以 concurrency 个协程同时扫描, 每个协程从 ips 中依次取出地址
+    :param first_only: 找到第一个服务器后立即结束
+    :return: 服务器地址, 按找到的先后排列
+    """
+    ips = iter(ips)
+    finished = asyncio.Event()
+
+    async def worker():
+        for ip in ips:
+            if await probe_server(ip, port, timeout, progress):
+                progress.found.append(ip)
+                if first_only:
+                    finished.set()
+                    return
+            progress.done += 1
+
+    async def run_workers():
+        await asyncio.gather(*(worker() for _ in range(concurrency)))
+        finished.set()
+
+    task = asyncio.ensure_future(run_workers())
+    await finished.wait()
+    task.cancel()  # 提前结束时取消仍在进行的连接
+    try:
+        await task
+    except asyncio.CancelledError:
+        pass
+    return progress.found
+
+
+async def show_progress(progress: ScanProgress):
     texts = ("—", "\\", "|", "/")
-    dl = len(str(number))
-    while any(t.is_alive() for t in pool):
-        times = (times + 1) % 4
-        s = sum(len(i) for i in ip_ok)
-        percentage = s / number * 100
-        text = f"scanning... [%{dl}d/%{dl}d | %3.1f%%] %s"
-        print("\r" + text % (s, number, percentage, texts[times]), end="", flush=True)
-        time.sleep(0.3)
-    print()
+    for times in itertools.cycle(range(4)):
+        if progress.total:
+            text = "%d/%d | %3.1f%%" % (progress.done, progress.total, progress.done / progress.total * 100)
+        else:
+            text = "%d" % progress.done
+        print("\rscanning... [%s | 开放 %d | 服务器 %d] %s" % (text, progress.open, len(progress.found), texts[times]),
+              end="", flush=True)
+        await asyncio.sleep(0.3)
+
+
+def max_concurrency(concurrency: int) -> int:
+    """
+    同时打开的连接数不能超过进程可以打开的文件数, 留出一些给其他文件
+    """
+    try:
+        import resource  # 只有类 Unix 系统有
+    except ImportError:
+        return concurrency
+    soft, _ = resource.getrlimit(resource.RLIMIT_NOFILE)
+    if soft == resource.RLIM_INFINITY:
+        return concurrency
+    return max(1, min(concurrency, soft - 64))
+
+
+def try_ips(ips: typing.Iterable[str], port: int, timeout: float = 1, concurrency: int = SCAN_CONCURRENCY,
+            first_only: bool = False) -> list[str]:
+    """
+    用 asyncio 扫描 ips 中的地址是否是服务器IP
+    :param ips: 地址
+    :param port: 端口
+    :param timeout: 连接与等待回复的最长时间(s)
+    :param concurrency: 同时进行的连接数上限
+    :param first_only: 只需要一个服务器, 找到后立即结束
+    :return: 可用的IP
+    """
+    progress = ScanProgress(len(ips) if isinstance(ips, typing.Sized) else None)
+
+    async def run():
+        display = asyncio.ensure_future(show_progress(progress))
+        try:
+            return await scan_ips(ips, port, timeout, max_concurrency(concurrency), first_only, progress)
+        finally:
+            display.cancel()
 
-    ip_ok = itertools.chain.from_iterable(ip_ok)
-    return list(itertools.compress(itertools.chain.from_iterable(groups), ip_ok))
+    try:
+        return asyncio.run(run())
+    finally:
+        print()
 
 
-def ip_config_part_to_real(ip_config_part: str) -> list[int]:
+def ip_config_part_to_range(ip_config_part: str) -> range:
     if ip_config_part.isdecimal():
         ip_config_part = int(ip_config_part)
         if ip_config_part > 255:
             raise ValueError("IP %s 数字过大" % ip_config_part)
-        return [ip_config_part]
+        return range(ip_config_part, ip_config_part + 1)
     m = re.match(r"^\{(\d+), ?(\d+)}$", ip_config_part)
     if m:
         sta, end = m.groups()
-        return [i for i in range(int(sta), int(end) + 1)]
+        if int(end) > 255:
+            raise ValueError("IP %s 数字过大" % ip_config_part)
+        return range(int(sta), int(end) + 1)
     if ip_config_part == "*":
-        return [i for i in range(256)]
+        return range(256)
     raise ValueError("IP 未能识别, %s" % ip_config_part)
 
 
-def ip_config_to_ip_list(ip_config: str) -> list[str]:
+class IpRange:
     """
-    将ip配置文本转为真实IP
+    一条IP配置对应的地址集合, 每一段是一个连续范围, 按整数地址迭代, 不展开成列表
     ip_config: 192.168.1.1 表示单个IP;
-               192.168.1.* 表示遍历 192.168.1.1 ~ 192.168.1.255;
+               192.168.1.* 表示遍历 192.168.1.0 ~ 192.168.1.255;
                192.168.1.{1,3} 表示遍历 192.168.1.1 ~ 192.168.1.3
-    :param ip_config: ip配置文本
-    :return: iterable
+               192.168.0.0/20 (CIDR) 表示遍历 192.168.0.0 ~ 192.168.15.255
+    """
+
+    def __init__(self, ip_config: str):
+        """
+        :param ip_config: ip配置文本
+        :raise ValueError: 无法识别
+        """
+        if "/" in ip_config:
+            network = ipaddress.IPv4Network(ip_config, strict=False)
+            first, last = int(network.network_address), int(network.broadcast_address)
+            # 前缀之后的各段都是连续范围
+            self.parts = tuple(range(first >> i & 255, (last >> i & 255) + 1) for i in (24, 16, 8, 0))
+        else:
+            values = ip_config.split(".")
+            if len(values) != 4:
+                raise ValueError("IP识别错误")
+            self.parts = tuple(ip_config_part_to_range(i) for i in values)
+
+    def __len__(self):
+        return math.prod(len(i) for i in self.parts)
+
+    def __contains__(self, address: int):
+        return all(address >> i & 255 in part for i, part in zip((24, 16, 8, 0), self.parts))
+
+    def blocks(self) -> typing.Iterator[tuple[int, range]]:
+        """
+        :return: 按 /24 子网分组的地址, (子网的第一个地址, 最后一段的范围)
+        """
+        a, b, c, d = self.parts
+        for ip_1 in a:
+            for ip_2 in b:
+                for ip_3 in c:
+                    yield ip_1 << 24 | ip_2 << 16 | ip_3 << 8, d
+
+    def __iter__(self) -> typing.Iterator[int]:
+        for base, last in self.blocks():
+            yield from range(base + last.start, base + last.stop)
+
+    def intersection(self, other: "IpRange") -> "IpRange":
+        new = copy.copy(self)
+        new.parts = tuple(range(max(i.start, j.start), max(min(i.stop, j.stop), max(i.start, j.start)))
+                          for i, j in zip(self.parts, other.parts))
+        return new
+
+
+def get_local_ip() -> str | None:
+    """
+    本机在局域网中的地址: UDP 套接字 connect 只选择路由, 不会发送数据
+    """
+    try:
+        with socket.socket(socket.AF_INET, socket.SOCK_DGRAM) as sock:
+            sock.connect(("10.255.255.255", 1))
+            return sock.getsockname()[0]
+    except OSError:
+        return None
+
+
+class ScanTargets:
     """
-    values = ip_config.split(".")
-    if len(values) != 4:
-        raise ValueError("IP识别错误")
-    a, b, c, d = (ip_config_part_to_real(i) for i in values)
-    return [f"{ip_1}.{ip_2}.{ip_3}.{ip_4}" for ip_1 in a for ip_2 in b for ip_3 in c for ip_4 in d]
+    按可能性排序的扫描地址, 边迭代边生成, 内存占用与地址数量无关
+    先扫描优先的 /24 子网(本机所在的子网、上次连接的服务器所在的子网), 再扫描其余地址
+    只扫描配置中包含的地址, 配置之间重叠的地址只扫描一次
+    """
+
+    def __init__(self, ip_configs: typing.Iterable[str], priority_ips: typing.Iterable[str | None] = ()):
+        """
+        :param ip_configs: ip配置文本
+        :param priority_ips: 优先扫描这些地址所在的 /24 子网, None 会被忽略
+        """
+        self.ranges = [IpRange(i) for i in ip_configs]
+        self.priority = []  # 优先子网的第一个地址
+        for ip in priority_ips:
+            if ip is None:
+                continue
+            base = int(ipaddress.IPv4Address(ip)) & ~255
+            if base not in self.priority:
+                self.priority.append(base)
+
+    def __len__(self):
+        # 容斥原理计算并集的大小, 配置通常只有一两条
+        total = 0
+        for k in range(1, len(self.ranges) + 1):
+            for group in itertools.combinations(self.ranges, k):
+                total += (-1) ** (k + 1) * len(functools.reduce(IpRange.intersection, group))
+        return total
+
+    def iter_addresses(self) -> typing.Iterator[int]:
+        for base in self.priority:
+            for address in range(base, base + 256):
+                if any(address in i for i in self.ranges):
+                    yield address
+        priority = set(self.priority)
+        for index, ip_range in enumerate(self.ranges):
+            earlier = self.ranges[:index]
+            for base, last in ip_range.blocks():
+                if base in priority:
+                    # 已经扫描过
+                    continue
+                for address in range(base + last.start, base + last.stop):
+                    if not earlier or not any(address in i for i in earlier):
+                        yield address
+
+    def __iter__(self) -> typing.Iterator[str]:
+        # inet_ntoa 比 ipaddress 快很多
+        return (socket.inet_ntoa(i.to_bytes(4, "big")) for i in self.iter_addresses())
 
 
-def scan_and_choose_url(ip_config, port, timeout, threads):
-    ips = list(itertools.chain.from_iterable(ip_config_to_ip_list(i) for i in ip_config))
-    ip_ok = try_ips(ips, port, timeout, threads)
+def scan_and_choose_url(ip_config, port, timeout, concurrency=SCAN_CONCURRENCY, single_server=False, last_ip=None):
+    """
+    扫描并选择服务器
+    :param single_server: 网络中只有一个服务器, 找到后立即停止扫描
+    :param last_ip: 上次连接的服务器地址, 优先扫描它所在的子网
+    """
+    ips = ScanTargets(ip_config, (get_local_ip(), last_ip))
+    ip_ok = try_ips(ips, port, timeout, concurrency, single_server)
     # 扫描结束
     if not ip_ok:
         raise ValueError("找不到服务器")
-    if len(ip_ok) > 1:
-        print("找到了多个服务器, 请选择登录哪一个:")
-        while 1:
-            for i, ip in ip_ok:
-                print("[%d] : %s:%d" % (i, ip, port))
-            i = input("\n>>> ")
-            if i.isdecimal():
-                i = int(i)
-                if i > len(ip_ok):
-                    print("数字错误")
-                else:
-                    return ip_ok[i]
+    return choose_server([(ip, port) for ip in ip_ok])[0]
+
+
+def choose_server(servers: list[tuple[str, int]]) -> tuple[str, int]:
+    """
+    找到多个服务器时让用户选择
+    :param servers: [(IP, 端口), ...], 不能为空
+    :return: 选择的 (IP, 端口)
+    """
+    if len(servers) == 1:
+        return servers[0]
+    print("找到了多个服务器, 请选择登录哪一个:")
+    while 1:
+        for i, (ip, port) in enumerate(servers, 1):
+            print("[%d] : %s:%d" % (i, ip, port))
+        i = input("\n>>> ")
+        if i.isdecimal():
+            i = int(i)
+            if not 1 <= i <= len(servers):
+                print("数字错误")
             else:
-                print("无法识别")
-    else:
-        # 只扫描到了一个网址
-        return ip_ok[0]
+                return servers[i - 1]
+        else:
+            print("无法识别")
 
 
-def login(url: str, my_id: str | None) -> dict:
-    r = requests.post(url, headers={"User-Agent": f"NumOnlineAPP/{VERSION}"},
-                      data={"nuc_name": get_computer_name(),
-                            "nuc_user": get_user_name(),
-                            "nuc_id": my_id})
+def discover_by_beacon(signal_port: int, addresses: typing.Iterable[str], timeout: float = 1,
+                       single_server: bool = False) -> list[tuple[str, int]]:
+    """
+    向信标端口广播查询, 收集回复的服务器, 不需要扫描
+    :param signal_port: 服务器信标端口
+    :param addresses: 查询发送到的地址, 一般是广播地址, 也可以是单个服务器
+    :param timeout: 没有任何回复时等待的最长时间(s)
+    :param single_server: 网络中只有一个服务器, 收到第一个回复后立即返回
+    :return: [(IP, HTTP 端口), ...], 按回复的先后排列
+    """
+    query = BEACON_QUERY.ljust(BEACON_QUERY_SIZE, b" ")
+    found = []
+    with socket.socket(socket.AF_INET, socket.SOCK_DGRAM) as sock:
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_BROADCAST, 1)
+        deadline = time.monotonic() + timeout
+        resend = 0
+        while (now := time.monotonic()) < deadline:
+            if now >= resend and not found:
+                # UDP 可能丢包, 没有回复时重发
+                for address in addresses:
+                    try:
+                        sock.sendto(query, (address, signal_port))
+                    except OSError:
+                        pass  # 没有网络或地址不可用
+                resend = now + BEACON_RESEND
+            # 收到回复后不再重发, 只等到收集结束
+            wake = deadline if found else min(deadline, resend)
+            readable, _, _ = select.select([sock], [], [], max(wake - now, 0))
+            if not readable:
+                continue
+            try:
+                packet, (ip, _) = sock.recvfrom(2048)
+            except OSError:
+                break
+            if not packet.startswith(BEACON_REPLY):
+                continue
+            try:
+                info = json.loads(packet[len(BEACON_REPLY):])
+                server = (ip, int(info["port"]))
+            except (ValueError, TypeError, KeyError):
+                continue
+            if server in found:
+                continue
+            found.append(server)
+            if single_server:
+                break
+            # 稍等片刻, 收集同时回复的其他服务器
+            deadline = min(deadline, time.monotonic() + BEACON_GATHER)
+    return found
+
+
+def login(url: str, my_id: str | None, nuc_user: str | None = None) -> dict:
+    """
+    :param nuc_user: 登录使用的用户名, None 表示当前用户
+    """
+    nuc_user = get_user_name() if nuc_user is None else nuc_user
+    r = session.post(url, data={"nuc_name": get_computer_name(),
+                                "nuc_user": nuc_user,
+                                "nuc_id": my_id})
     r.raise_for_status()
     j = r.json()
     if j["OK"]:
         return j
     else:
         if my_id is None:
-            return login(url, j["id"])  # XXX : 不会收集错误
+            return login(url, j["id"], nuc_user)  # XXX : 不会收集错误
         else:
             raise Exception("服务器登录失败，错误代码", j["error-code"])
 
 
-def update_to_server(url, timeout=1, ping_times=3, ping_delay=1000, data=None, **kwargs):
+class UploadFileTail:
+    """
+    跟踪上传文件: 记住已上传到的字节位置, 每次只读取之后新写入的完整行
+    文件被截断或替换(inode 改变)时从头重新读取
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+        self.offset = 0  # 已上传的字节位置
+        self.seq = 0  # 已上传的行数, 即下一批第一行的序号
+        self.reset = True  # 下一批需要服务器清空旧数据
+        self._inode = None
+        self._pending = 0  # 最近一次读取到的字节数, 上传成功后才计入 offset
+
+    def rewind(self):
+        """
+        从头重新同步
+        """
+        self.offset = 0
+        self.seq = 0
+        self.reset = True
+
+    def read_new_rows(self) -> list[list[str, ...], ...]:
+        """
+        读取新写入的完整行
+        :raise FileNotFoundError: 找不到上传文件
+        :return: CSV 行
+        """
+        path = os.path.expanduser(self.path)
+        st = os.stat(path)
+        if (self._inode is not None and st.st_ino != self._inode) or st.st_size < self.offset:
+            # 文件被替换或截断
+            self.rewind()
+        self._inode = st.st_ino
+        with open(path, "rb") as fp:
+            fp.seek(self.offset)
+            chunk = fp.read(st.st_size - self.offset)
+        end = chunk.rfind(b"\n") + 1  # 末尾没写完的行留到下一次
+        self._pending = end
+        if end == 0:
+            return []
+        return list(csv.reader(io.StringIO(chunk[:end].decode("utf-8"), newline="")))
+
+    def commit(self, rows_number: int):
+        """
+        服务器已收到最近一次读取的行
+        :param rows_number: 行数
+        """
+        self.offset += self._pending
+        self.seq += rows_number
+        self.reset = False
+        self._pending = 0
+
+
+class Inotify:
+    """
+    通过 ctypes 调用 Linux 的 inotify, 监视一个文件夹中文件的变化
+    """
+    IN_MODIFY = 0x2
+    IN_ATTRIB = 0x4
+    IN_CLOSE_WRITE = 0x8
+    IN_MOVED_FROM = 0x40
+    IN_MOVED_TO = 0x80
+    IN_CREATE = 0x100
+    IN_DELETE = 0x200
+    IN_Q_OVERFLOW = 0x4000
+    IN_NONBLOCK = 0o4000
+    IN_CLOEXEC = 0o2000000
+    EVENT = "iIII"  # wd, mask, cookie, len, 之后是 len 字节的文件名
+
+    def __init__(self, directory: str):
+        """
+        :raise OSError: 系统不支持 inotify 或无法监视文件夹
+        """
+        if not sys.platform.startswith("linux"):
+            # Windows 上找不到 libc(find_library 返回 None, CDLL(None) 抛出 TypeError), 其他系统没有 inotify
+            raise OSError("系统不支持 inotify")
+        libc = ctypes.CDLL(ctypes.util.find_library("c"), use_errno=True)
+        try:
+            init, add_watch = libc.inotify_init1, libc.inotify_add_watch
+        except AttributeError:
+            raise OSError("系统不支持 inotify")
+        add_watch.argtypes = (ctypes.c_int, ctypes.c_char_p, ctypes.c_uint32)
+        self.fd = init(self.IN_NONBLOCK | self.IN_CLOEXEC)
+        if self.fd < 0:
+            raise OSError(ctypes.get_errno(), "inotify_init1 失败")
+        mask = self.IN_MODIFY | self.IN_ATTRIB | self.IN_CLOSE_WRITE | self.IN_MOVED_FROM | self.IN_MOVED_TO \
+            | self.IN_CREATE | self.IN_DELETE
+        if add_watch(self.fd, os.fsencode(directory), mask) < 0:
+            err = ctypes.get_errno()
+            os.close(self.fd)
+            raise OSError(err, "无法监视文件夹", directory)
+
+    def close(self):
+        os.close(self.fd)
+
+    def read_names(self) -> set[bytes] | None:
+        """
+        读取已发生的全部事件
+        :return: 发生变化的文件名, 事件队列溢出(无法知道哪些文件变化了)时为 None
+        """
+        names = set()
+        header = struct.Struct(self.EVENT)
+        while True:
+            try:
+                buffer = os.read(self.fd, 64 * 1024)
+            except BlockingIOError:
+                return names
+            pos = 0
+            while pos < len(buffer):
+                _, mask, _, length = header.unpack_from(buffer, pos)
+                if mask & self.IN_Q_OVERFLOW:
+                    names = None
+                elif names is not None:
+                    names.add(buffer[pos + header.size:pos + header.size + length].rstrip(b"\0"))
+                pos += header.size + length
+
+
+class FileWatcher:
+    """
+    等待上传文件变化: Linux 上使用 inotify, 不会占用 CPU; 其他系统定时比较文件的 inode、大小和修改时间
+    监视的是文件所在的文件夹, 文件被替换、删除后重新创建也能发现
+    """
+
+    def __init__(self, path: str):
+        self.path = os.path.expanduser(path)
+        self._name = os.fsencode(os.path.basename(self.path))
+        try:
+            self._inotify = Inotify(os.path.dirname(os.path.abspath(self.path)))
+        except OSError:
+            self._inotify = None
+        self._signature = self._stat()
+
+    def _stat(self) -> tuple | None:
+        try:
+            st = os.stat(self.path)
+        except OSError:
+            return None
+        return st.st_ino, st.st_size, st.st_mtime_ns
+
+    def mark(self):
+        """
+        读取文件前调用, 之后的变化才会被 wait 发现
+        """
+        if self._inotify is not None:
+            self._inotify.read_names()
+        self._signature = self._stat()
+
+    def wait(self, timeout: float) -> bool:
+        """
+        阻塞到文件变化或超时
+        :param timeout: 最长等待时间(s)
+        :return: 文件是否变化了
+        """
+        deadline = time.monotonic() + timeout
+        while (remaining := deadline - time.monotonic()) > 0:
+            if self._inotify is not None:
+                readable, _, _ = select.select([self._inotify.fd], [], [], remaining)
+                if not readable:
+                    return False
+                names = self._inotify.read_names()
+                if names is not None and self._name not in names:
+                    continue  # 同一文件夹中的其他文件
+            else:
+                time.sleep(min(remaining, POLL_INTERVAL))
+            signature = self._stat()
+            if signature != self._signature:
+                self._signature = signature
+                return True
+        return False
+
+    def close(self):
+        if self._inotify is not None:
+            self._inotify.close()
+            self._inotify = None
+
+
+class Spool:
+    """
+    磁盘上的离线队列: 读取到的新行先写入队列, 服务器确认收到后才删除, 服务器不可用期间数据不会丢失
+    每批一个文件 <编号>.json: {"seq": 第一行的序号, "reset": 是否清空服务器的旧数据, "rows": CSV 行},
+    每个文件不超过 SPOOL_BATCH_ROWS 行
+    文件先写到 .tmp 再改名, 中断时不会留下不完整的批次
+    """
+
+    def __init__(self, directory: str):
+        self.directory = os.path.expanduser(directory)
+        os.makedirs(self.directory, exist_ok=True)
+        for name in os.listdir(self.directory):
+            if name.endswith(".tmp"):
+                os.remove(os.path.join(self.directory, name))
+        self.names = sorted(i for i in os.listdir(self.directory) if i.endswith(".json"))  # 从旧到新
+        self._next = int(self.names[-1][:-5]) + 1 if self.names else 0
+
+    def __len__(self):
+        return len(self.names)
+
+    def put(self, seq: int, reset: bool, rows: list[list[str, ...], ...], max_rows: int = SPOOL_BATCH_ROWS):
+        """
+        加入一批, 超过 max_rows 行时(如文件被重写后重新读取整个文件)按顺序分为多个文件, 只有第一个需要清空
+        :param seq: 第一行的序号
+        :param reset: 服务器是否需要先清空旧数据
+        :param rows: CSV 行
+        :param max_rows: 每个文件最多的行数
+        """
+        start = 0
+        while 1:
+            part = rows[start:start + max_rows]
+            name = "%012d.json" % self._next
+            self._next += 1
+            path = os.path.join(self.directory, name)
+            with open(path + ".tmp", "w", encoding="utf-8") as fp:
+                json.dump({"seq": seq + start, "reset": reset and not start, "rows": part}, fp,
+                          ensure_ascii=False, separators=(",", ":"))
+            os.replace(path + ".tmp", path)
+            self.names.append(name)
+            start += max_rows
+            if start >= len(rows):
+                break
+
+    def _load(self, name: str) -> dict:
+        with open(os.path.join(self.directory, name), "r", encoding="utf-8") as fp:
+            return json.load(fp)
+
+    def batch(self, max_rows: int = SPOOL_BATCH_ROWS) -> tuple[dict, list[str]] | None:
+        """
+        合并队列开头的连续批次, 一次上传
+        只有序号相接且不需要清空的批次才能接在后面, 需要清空的批次只能是第一个
+        :param max_rows: 最多合并的行数, 第一批总会被包含(put 保证每批不超过 SPOOL_BATCH_ROWS 行)
+        :return: ({"seq", "reset", "rows"}, 包含的文件名), 队列为空时为 None
+        """
+        if not self.names:
+            return None
+        merged = self._load(self.names[0])
+        names = [self.names[0]]
+        for name in self.names[1:]:
+            item = self._load(name)
+            if item["reset"] or item["seq"] != merged["seq"] + len(merged["rows"]) \
+                    or len(merged["rows"]) + len(item["rows"]) > max_rows:
+                break
+            merged["rows"].extend(item["rows"])
+            names.append(name)
+        return merged, names
+
+    def remove(self, names: list[str]):
+        """
+        服务器已收到, 删除
+        """
+        for name in names:
+            os.remove(os.path.join(self.directory, name))
+            self.names.remove(name)
+
+    def clear(self):
+        self.remove(list(self.names))
+
+
+class Backoff:
+    """
+    连接失败后的指数退避, 加上随机抖动, 服务器恢复时众多客户端不会同时重连
+    """
+
+    def __init__(self, base: float = BACKOFF_BASE, cap: float = BACKOFF_MAX):
+        self.base = base
+        self.cap = cap
+        self.failures = 0
+
+    def fail(self) -> float:
+        """
+        记录一次失败
+        :return: 下次重试前等待的时间(s), 在 [delay / 2, delay] 中随机, delay 每次加倍直到上限
+        """
+        delay = min(self.cap, self.base * 2 ** self.failures)
+        self.failures += 1
+        return random.uniform(delay / 2, delay)
+
+    def reset(self):
+        self.failures = 0
+
+
+class Heartbeat(threading.Thread):
+    """
+    后台心跳, 使用单独的连接, 上传大批数据时也能按时发送
+    服务器回复未登录时清除 logged_in, 由工作循环重新登录
+    连接失败不做处理, 由上传数据的退避重试负责
+    """
+
+    def __init__(self, url: str, my_id: str, interval: float, timeout: float):
+        super().__init__(name="heartbeat", daemon=True)
+        self.url = url
+        self.my_id = my_id
+        self.interval = interval
+        self.timeout = timeout
+        self.logged_in = threading.Event()
+        self.logged_in.set()
+
+    def run(self):
+        heartbeat_session = new_session()
+        while True:
+            time.sleep(self.interval)
+            try:
+                r = heartbeat_session.post(self.url, data={"nuc_id": self.my_id}, timeout=self.timeout)
+                r.raise_for_status()
+                ok = r.json()["OK"]
+            except (requests.exceptions.RequestException, ValueError, KeyError):
+                continue
+            if not ok:
+                self.logged_in.clear()
+
+
+def encode_rows(rows: list[list[str, ...], ...]) -> str:
+    """
+    将 CSV 行编码为 DATA_FORMAT 格式
+    """
+    return json.dumps(rows, ensure_ascii=False, separators=(",", ":"))
+
+
+def choose_encoding(server_encodings: typing.Iterable[str]) -> str | None:
+    """
+    协商请求体的压缩格式
+    :param server_encodings: 服务器接受的格式, 见登录回复中的 "content_encodings", 旧版服务器没有此项
+    :return: 双方都支持的格式中本机最优先的一个, 没有时为 None(不压缩)
+    """
+    server_encodings = set(server_encodings)
+    return next((i for i in CONTENT_ENCODINGS if i in server_encodings), None)
+
+
+def compress_body(body: bytes, encoding: str) -> bytes:
+    if encoding == "zstd":
+        return zstandard.ZstdCompressor(level=3).compress(body)
+    if encoding == "gzip":
+        return gzip.compress(body, compresslevel=6)
+    if encoding == "deflate":
+        return zlib.compress(body, 6)
+    raise LookupError("不支持的压缩格式 %s" % encoding)
+
+
+def encode_form(fields: dict, encoding: str | None = None) -> tuple[bytes, dict]:
+    """
+    编码表单, 请求体较大时压缩
+    :param fields: 表单字段, 值为 None 的字段不发送
+    :param encoding: 压缩格式, 见 choose_encoding, None 表示不压缩
+    :return: (请求体, 请求头)
+    """
+    body = urllib.parse.urlencode({k: v for k, v in fields.items() if v is not None}).encode()
+    headers = {"Content-Type": "application/x-www-form-urlencoded"}
+    if encoding is not None and len(body) >= COMPRESS_MIN_SIZE:
+        body = compress_body(body, encoding)
+        headers["Content-Encoding"] = encoding
+    return body, headers
+
+
+def upload_timeout(size: int) -> tuple[float, float]:
+    """
+    上传数据时的超时: 与扫描服务器时的短超时分开, 等待回复的时间随请求体增大,
+    补传大批数据时不会因服务器解析较慢而被当作不可用, 反复重传同一批
+    :param size: 未压缩的请求体大小(字节)
+    :return: requests 的 (连接超时, 回复超时)
+    """
+    return UPLOAD_CONNECT_TIMEOUT, UPLOAD_TIMEOUT + size / UPLOAD_MIN_RATE
+
+
+def update_to_server(url, timeout=1, ping_times=3, ping_delay=1000, data=None, encoding=None, **kwargs):
+    """
+    :param timeout: 超时(s), None 表示按请求体大小使用 upload_timeout
+    """
     if data:
         kwargs.update(data)
-    for _ in range(ping_times):
+    if "data" in kwargs and not isinstance(kwargs["data"], str):
+        # CSV 行需要编码
+        kwargs["data"] = encode_rows(kwargs["data"])
+        kwargs["data_format"] = DATA_FORMAT
+    if timeout is None:
+        timeout = upload_timeout(len(kwargs.get("data", "")))
+    body, headers = encode_form(kwargs, encoding)
+    for attempt in range(ping_times):
         try:
-            r = requests.post(url, headers={"User-Agent": f"NumOnlineAPP/{VERSION}"},
-                              data=kwargs,
-                              timeout=timeout)
+            r = session.post(url, data=body, headers=headers, timeout=timeout)
             r.raise_for_status()
-        except (requests.exceptions.HTTPError, requests.exceptions.ConnectionError) as err:
+        except (requests.exceptions.HTTPError, requests.exceptions.ConnectionError,
+                requests.exceptions.Timeout) as err:
             print(type(err).__name__, err)
-            time.sleep(ping_delay)
+            if attempt + 1 < ping_times:
+                time.sleep(ping_delay)
         else:
             break
     else:
@@ -586,6 +1304,65 @@ def update_to_server(url, timeout=1, ping_times=3, ping_delay=1000, data=None, *
     return r.json()
 
 
+def measure_latency(url_base: str, my_id: str, split: bool, upload_file: str, server_encodings: typing.Iterable[str],
+                    timeout=5, rounds=20):
+    """
+    测量模式: 比较每次上传的请求体大小与耗时(包括压缩的时间)
+      新建连接: 每次请求都建立新的 TCP 连接(使用会话之前的做法)
+      复用连接: 使用 keep-alive 的会话
+      复用连接+压缩格式: 再用双方都支持的每种格式压缩请求体
+    心跳发送到心跳的接口, 使用自己的令牌
+    按 MEASURE_ROWS 分别上传上传文件开头的若干行: 使用另外登录的临时令牌(用户名加 "(measure)"), 每次都清空后重传,
+    不会向自己的数据中写入任何行, 临时令牌没有心跳, 由服务器过期删除
+    :param url_base: 服务器地址, 如 http://127.0.0.1:5001
+    :param my_id: 令牌
+    :param split: 服务器是否有单独的心跳与上传接口, 旧版服务器都使用 /app_update
+    :param upload_file: 上传文件
+    :param server_encodings: 服务器接受的压缩格式
+    :param timeout: 每次请求的最长时间(s)
+    :param rounds: 每种方式的请求次数
+    """
+    try:
+        with open(os.path.expanduser(upload_file), "r", encoding="utf-8", newline="") as fp:
+            rows = list(itertools.islice(csv.reader(fp), max(MEASURE_ROWS)))
+    except FileNotFoundError:
+        print("上传文件未找到, 只测量心跳")
+        rows = []
+    payloads = {"心跳": (url_base + ("/app_heartbeat" if split else "/app_update"), {"nuc_id": my_id})}
+    numbers = sorted({min(i, len(rows)) for i in MEASURE_ROWS} - {0})
+    if numbers:
+        probe_id = login(url_base + "/app_login", None, get_user_name() + "(measure)")["id"]
+        for number in numbers:
+            payloads["上传 %d 行" % number] = (url_base + ("/app_upload_data" if split else "/app_update"),
+                                            {"nuc_id": probe_id, "data": encode_rows(rows[:number]),
+                                             "data_format": DATA_FORMAT, "seq": 0, "reset": 1})
+
+    def new_connection(url, body, headers):
+        return requests.post(url, data=body, headers={"User-Agent": f"NumOnlineAPP/{VERSION}", **headers},
+                             timeout=timeout)
+
+    def keep_alive(url, body, headers):
+        return session.post(url, data=body, headers=headers, timeout=timeout)
+
+    server_encodings = set(server_encodings)
+    methods = [("新建连接", new_connection, None), ("复用连接", keep_alive, None)]
+    methods += [("复用连接+" + i, keep_alive, i) for i in CONTENT_ENCODINGS if i in server_encodings]
+    for name, (url, fields) in payloads.items():
+        print(name)
+        for method, post, encoding in methods:
+            body, headers = encode_form(fields, encoding)
+            post(url, body, headers).raise_for_status()  # 预热, 复用连接的方式之后都不需要再握手
+            costs = []
+            for _ in range(rounds):
+                t = time.perf_counter()
+                body, headers = encode_form(fields, encoding)
+                post(url, body, headers).raise_for_status()
+                costs.append((time.perf_counter() - t) * 1000)
+            costs.sort()
+            print("  %-16s 请求体 %8d 字节  中位数 %8.2f ms  P90 %8.2f ms  最小 %8.2f ms"
+                  % (method, len(body), statistics.median(costs), costs[int(len(costs) * 0.9) - 1], costs[0]))
+
+
 def main(config_file: str, search: dict, upload_file: str, server: dict, **kwargs):
     """
     输入写在配置文件中
@@ -595,6 +1372,9 @@ def main(config_file: str, search: dict, upload_file: str, server: dict, **kwarg
     :param server:
     """
     argv = sys.argv[1:]
+    measure = "--measure" in argv  # 只测量上传耗时, 然后退出
+    if measure:
+        argv.remove("--measure")
     # 获取服务器地址
     port = server["server_port"]
     timeout = search["timeout"]
@@ -606,24 +1386,49 @@ def main(config_file: str, search: dict, upload_file: str, server: dict, **kwarg
             port = int(port)
         assert ping_function(ip, port, timeout), ValueError("输入的IP未识别为服务器")
     else:
-        # 扫描并获得服务器地址
+        # 先通过信标查找, 没有回复再扫描
         last_ip = kwargs.get("last_ip")
-        if last_ip and ping_function(last_ip, port, timeout):
+        signal_port = (kwargs.get("upload") or {}).get("signal_port")
+        servers = discover_by_beacon(signal_port, search.get("beacon_addresses", ["255.255.255.255"]),
+                                     search.get("beacon_timeout(s)", 1), search.get("single_server", False)) \
+            if signal_port else []
+        last = [i for i in servers if i[0] == last_ip]
+        if servers:
+            ip, port = last[0] if last else choose_server(servers)
+        elif last_ip and ping_function(last_ip, port, timeout):
             ip = last_ip
         else:
-            ip = scan_and_choose_url(search["ips"], port, timeout, search["threads"])
+            # 旧的配置中没有这两项, 其中的 "threads" 不再使用
+            ip = scan_and_choose_url(search["ips"], port, timeout, search.get("concurrency", SCAN_CONCURRENCY),
+                                     search.get("single_server", False), last_ip)
     url_base = f"http://{ip}:{port}"
 
-    ping_times = server["reconnect_times"]
-    ping_delay = server["ping_delay(s)"]
     my_id = kwargs.get("id")
     # 登录完成, 获得了服务器端配置
     config = login(url_base + "/app_login", my_id)
+    encoding = choose_encoding(config.get("content_encodings", ()))
     write_config_to(config_file, {"id": config["id"], "last_ip": ip})
-    start = time.time()
+    if measure:
+        measure_latency(url_base, config["id"], "heartbeat(s)" in config, upload_file,
+                        config.get("content_encodings", ()))
+        return
     times = -1
+    tail = UploadFileTail(upload_file)
+    watcher = FileWatcher(upload_file)
+    spool = Spool((kwargs.get("upload") or {}).get("spool_dir", "~/.pyNumOnline/spool"))
+    backoff = Backoff()
+    upload_delay = server["upload_delay(s)"] / 1000
+    # 新版服务器的心跳与上传数据是分开的接口, 旧版服务器都使用 /app_update
+    split = "heartbeat(s)" in config
+    ingest_url = url_base + ("/app_upload_data" if split else "/app_update")
+    heartbeat_interval = min(server["ping_delay(s)"], config.get("heartbeat(s)", KEEP_ALIVE_INTERVAL))
+    heartbeat = Heartbeat(url_base + ("/app_heartbeat" if split else "/app_update"), config["id"],
+                          heartbeat_interval, timeout)
+    heartbeat.start()
+    last_read = retry_at = 0  # time.monotonic()
+    pending = True  # 上传文件可能有新数据
+    reported_upload = None  # 已告知服务器的上传文件
     while 1:  # 工作循环
-        run_continue = False
         # 检查配置
         my_id = config["id"]
         if os.path.expanduser(config["config"]) != os.path.expanduser(config_file):
@@ -635,51 +1440,88 @@ def main(config_file: str, search: dict, upload_file: str, server: dict, **kwarg
             if os.path.expanduser(_upload) != os.path.expanduser(upload_file):
                 upload_file = _upload
                 write_config_to(config_file, {"upload_file": upload_file})
-        else:
-            # 要告知服务器本机上传文件
-            for _ in range(timeout):
-                config = update_to_server(url_base + "/app_update", timeout, ping_times,
-                                          upload_file=upload_file, nuc_id=my_id)
-                if not config["OK"]:
-                    print("配置更新失败 :", config["error"])
-                    if config["error"] == "未登录":
-                        config = login(url_base + "/app_login", my_id)
-                        run_continue = True
-                        break
-                    # 其余错误只好重试
-                else:
-                    break
-            else:
-                raise TimeoutError("配置上传失败")
-        if run_continue:
-            continue
-        if time.time() - start > server["upload_delay(s)"] / 1000:
-            print("上传数据 ...", end="", flush=True)
+        if tail.path != upload_file:
+            tail = UploadFileTail(upload_file)
+            watcher.close()
+            watcher = FileWatcher(upload_file)
+            pending = True
+        now = time.monotonic()
+        if pending and now >= last_read + upload_delay:
+            # 新行先写入离线队列, 服务器确认收到后才从队列删除
+            watcher.mark()
             try:
-                with open(os.path.expanduser(upload_file), "r", encoding="utf-8") as fp:
-                    r = csv.reader(fp)
-                    data = list(r)
+                data = tail.read_new_rows()
             except FileNotFoundError:
-                # 找不到文件
+                # 找不到文件, 文件出现后会被发现
                 print("上传文件未找到")
-                continue
-            for _ in range(timeout):
-                config = update_to_server(url_base + "/app_update", timeout, ping_times, ping_delay,
-                                          {"data": format(data), "nuc_id": my_id})
-                if not config["OK"]:
-                    print("  配置更新失败 : %s" % config["error"], end="", flush=True)
-                    if config["error"] == "未登录":
-                        config = login(url_base + "/app_login", my_id)
-                        break
-                    # 其余错误只好重试
-                else:  # 刷新时间
-                    times = (times + 1) % 6
-                    print("\r%s上传成功 !" % ("." * times).ljust(5), end="", flush=True)
-                    start = time.time()
-                    break
             else:
-                raise TimeoutError("配置上传失败")
-
+                if data or tail.reset:
+                    spool.put(tail.seq, tail.reset, data)
+                tail.commit(len(data))
+            pending = False
+            last_read = now
+        # 要发送的请求: 重新登录, 告知服务器上传文件, 或上传队列中的数据
+        batch = None
+        if not heartbeat.logged_in.is_set():
+            url, fields = url_base + "/app_login", None
+        elif config["upload"] is None and reported_upload != upload_file:
+            url, fields = url_base + "/app_update", {"upload_file": upload_file, "nuc_id": my_id}
+        elif spool:
+            batch = spool.batch()
+            item, _ = batch
+            url, fields = ingest_url, {"data": item["rows"], "seq": item["seq"], "reset": int(item["reset"]),
+                                       "nuc_id": my_id}
+        else:
+            url = fields = None
+        if url is None or now < retry_at:
+            # 等待文件变化或重试时间; 至多等待一个心跳间隔, 以便及时发现需要重新登录
+            wait = heartbeat_interval if url is None else retry_at - now
+            if pending:
+                # 数据在上传间隔内继续写入, 到时一起读取
+                time.sleep(max(min(wait, last_read + upload_delay - now), 0))
+            elif watcher.wait(wait):
+                pending = True
+            continue
+        try:
+            if fields is None:
+                config = login(url, my_id)
+                encoding = choose_encoding(config.get("content_encodings", ()))
+                reported_upload = None
+                heartbeat.logged_in.set()
+                ret = config
+            else:
+                if batch is not None:
+                    print("上传数据 ...", end="", flush=True)
+                ret = update_to_server(url, None, 1, 0, fields, encoding)
+        except (TimeoutError, requests.exceptions.RequestException):
+            # 服务器不可用, 数据留在队列中, 退避后重试
+            delay = backoff.fail()
+            retry_at = time.monotonic() + delay
+            print("\r服务器不可用, %.1f 秒后重试, 离线队列中有 %d 批数据" % (delay, len(spool)), end="", flush=True)
+            continue
+        if ret["OK"]:
+            backoff.reset()
+            retry_at = 0
+            if "upload" in ret:
+                config.update(config=ret["config"], upload=ret["upload"])
+            if fields is not None and "upload_file" in fields:
+                reported_upload = fields["upload_file"]
+            if batch is not None:
+                spool.remove(batch[1])
+                times = (times + 1) % 6
+                print("\r%s上传成功 !" % ("." * times).ljust(5), end="", flush=True)
+        elif ret["error"] == "未登录":
+            print("  配置更新失败 : %s" % ret["error"], end="", flush=True)
+            heartbeat.logged_in.clear()
+        elif ret["error"] == "需要重新同步":
+            # 服务器缺少数据, 队列中的数据接不上, 从头上传
+            spool.clear()
+            tail.rewind()
+            pending = True
+        else:
+            # 其余错误只好重试
+            print("  配置更新失败 : %s" % ret["error"], end="", flush=True)
+            retry_at = time.monotonic() + backoff.fail()
 
 if __name__ == "__main__":
     # Initiation
@@ -2,24 +2,36 @@
 # -*- coding: utf-8 -*-
 """
 应用主体
-注意由于nuc_ids线程不安全，请单线程运行
+可以多线程运行, 共享状态的锁见 data.py
+客户端数量很多时可改用 async_server.py 运行
 """
 # 第三方模块
 from flask import Flask, request
+from markupsafe import Markup
 import flask
 # 内置模块
 import os
 import re
-import io
+import json
 import time
+import threading
+import collections
 # 项目模块
 import data
+import beacon
 import nuc_ids
+import payload
+
+VERSION = "0.0.1"  # 服务器版本, 随信标发送
 
 # 加载配置
 data.load_config()
+data.open_backend()
 
 app = Flask(__name__)
+# 客户端可以压缩请求体
+app.wsgi_app = payload.decode_request(
+    app.wsgi_app, int(data.CONFIG_DATA["connection"].get("max_upload_size(MB)", 64) * 1024 * 1024))
 
 
 @app.route('/')
@@ -42,34 +54,242 @@ def manager():
         if request.form.get("edit nuc save file"):
             # 修改NUC上的保存文件
             return manager_edit_nuc_save_file()
-        elif request.form.get("SAVE TRACKED DATA"):
+        elif request.form.get("save tracked data"):
             # 保存跟踪中的数据集
-            pass
+            return manager_save_track()
     elif request.method == "GET":
         # Get request
         data.refresh_nuc()
-        return flask.render_template("manager_base.html",
-                                     track_and_cache_data=data.track_and_cache_data,
-                                     tracked_and_cached_nuc_list=list(data.get_nuc_info_from_track_and_cache_data()),  # FIXME: 列表显示不正确
-                                     nucs=data.nuc)
+        # 先读版本号再读数据, 缓存的内容不会比键中的版本旧
+        version = data.version
+        key = (version, int(time.time() // LAST_GRANULARITY))
+        nucs_count, nucs_rows = render_cache.get(("nucs",) + key, render_nucs_rows)
+        tracks_count, tracks_rows = render_cache.get(("tracks",) + key, render_tracks_rows)
+        return flask.render_template("manager_base.html", nucs_count=nucs_count, nucs_rows=nucs_rows,
+                                     tracks_count=tracks_count, tracks_rows=tracks_rows, version=version)
     else:
         # not support
         return 'no support method "%s"' % request.method
 
 
+class RenderCache:
+    """
+    渲染结果的 LRU 缓存, 最多保存 size 项, 记录命中与未命中的次数
+    """
+
+    def __init__(self, size: int):
+        self.size = size
+        self.items = collections.OrderedDict()
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key, build):
+        """
+        :return: 缓存中 key 对应的结果, 没有时调用 build() 生成并缓存
+        """
+        with self.lock:
+            value = self.items.get(key)
+            if value is not None:
+                self.items.move_to_end(key)
+                self.hits += 1
+                return value
+            self.misses += 1
+        # 渲染时不持有锁, 同时未命中的请求可能各渲染一次, 结果相同
+        value = build()
+        with self.lock:
+            self.items[key] = value
+            self.items.move_to_end(key)
+            while len(self.items) > self.size:
+                self.items.popitem(last=False)
+        return value
+
+    def info(self) -> dict:
+        with self.lock:
+            return {"hits": self.hits, "misses": self.misses, "size": len(self.items), "capacity": self.size}
+
+
+# 管理页面中两个表格的缓存, 键为 (表格, 版本号, 时间片)
+# 登录、断开、新数据、跟踪状态变化时版本号改变; "前一次上传" 每秒变化, 按 LAST_GRANULARITY 取整计入键
+# 页面打开后 "前一次上传" 由推送更新, 缓存的值最多旧 LAST_GRANULARITY 秒
+render_cache = RenderCache(32)
+LAST_GRANULARITY = 1  # (s)
+
+
+def render_nucs_rows() -> tuple[int, Markup]:
+    """
+    :return: (已连接的nuc数量, 表格各行的 HTML)
+    """
+    nucs = data.nuc.snapshot()
+    return len(nucs), Markup(flask.render_template(
+        "manager_nucs.html", nucs=nucs, track_and_cache_data=dict(data.track_and_cache_data),
+        tracked_and_cached_nuc_list=list(data.get_nuc_info_from_track_and_cache_data())))  # FIXME: 列表显示不正确
+
+
+def render_tracks_rows() -> tuple[int, Markup]:
+    """
+    :return: (跟踪中的nuc数量, 表格各行的 HTML)
+    """
+    track_and_cache_data = dict(data.track_and_cache_data)
+    return len(track_and_cache_data), Markup(flask.render_template(
+        "manager_tracks.html", track_and_cache_data=track_and_cache_data))
+
+
+@app.route("/manager/render_cache")
+def manager_render_cache():
+    """
+    管理页面渲染缓存的命中与未命中次数
+    """
+    return flask.jsonify(render_cache.info())
+
+
+# 推送事件的文本缓存, 多个页面订阅同一段变化时只生成一次
+_event_cache = {}
+EVENT_INTERVAL = 0.5  # 两次推送的最小间隔(s), 变化频繁时合并推送
+
+
+def cached_event(key, build) -> str:
+    """
+    按 key 缓存 build() 生成的事件文本
+    """
+    text = _event_cache.get(key)
+    if text is None:
+        if len(_event_cache) > 256:
+            _event_cache.clear()
+        text = _event_cache[key] = build()
+    return text
+
+
+def format_event(event, value, event_id=None) -> str:
+    """
+    :return: Server-Sent Events 格式的文本
+    """
+    text = "" if event_id is None else f"id: {event_id}\n"
+    return text + f"event: {event}\ndata: {json.dumps(value, ensure_ascii=False)}\n\n"
+
+
+def nucs_event(old_version, new_version, tokens) -> str:
+    """
+    :return: 两个版本之间发生变化的nuc, tokens 为 None 时返回全部nuc
+    """
+    if tokens is None:
+        value = {"full": True, "nucs": [data.nuc_summary(i) for i in data.nuc], "removed": []}
+    else:
+        value = {"full": False, "nucs": [], "removed": []}
+        for token in tokens:
+            nuc_data = data.nuc.get(token)
+            if nuc_data is None:
+                value["removed"].append(token)
+            else:
+                value["nucs"].append(data.nuc_summary(nuc_data))
+    return format_event("nucs", value, new_version)
+
+
+def last_event() -> str:
+    """
+    :return: 所有nuc距上次更新的秒数, 每秒只生成一次
+    """
+    return cached_event(("last", int(time.time())),
+                        lambda: format_event("last", {i["token"]: i["last"] for i in data.nuc}))
+
+
+def manager_event_stream(version):
+    last_sent = 0
+    while True:
+        data.refresh_nuc()
+        new_version, tokens = data.changes_since(version)
+        if new_version != version:
+            yield cached_event(("nucs", version, new_version),
+                               lambda: nucs_event(version, new_version, tokens))
+            version = new_version
+        if time.time() - last_sent >= 1:
+            yield last_event()
+            last_sent = time.time()
+        time.sleep(EVENT_INTERVAL)
+        data.wait_for_change(version, 1)
+
+
+@app.route("/manager/events")
+def manager_events():
+    """
+    推送已连接nuc的变化 (Server-Sent Events)
+    事件 "nucs": {"full": 是否为全部nuc, "nucs": [变化的nuc], "removed": [断开的令牌]}, 事件id为版本号
+    事件 "last": {令牌: 距上次更新的秒数}, 每秒一次
+    """
+    # 断线重连时浏览器会带上 Last-Event-ID
+    since = request.headers.get("Last-Event-ID", None, int)
+    if since is None:
+        since = request.args.get("since", data.version, int)
+    return flask.Response(manager_event_stream(since),
+                          mimetype="text/event-stream", headers={"Cache-Control": "no-cache"})
+
+
+# 版本号在重启后从零开始, 加上启动时间避免与重启前的 ETag 相同
+ETAG_PREFIX = "%x-" % time.time_ns()
+
+
+def json_with_etag(version, build) -> flask.Response:
+    """
+    以版本号为 ETag 返回 build() 生成的JSON
+    请求的 If-None-Match 与版本号一致时直接返回304, 不调用 build()
+    """
+    etag = ETAG_PREFIX + str(version)
+    if request.if_none_match.contains(etag):
+        response = flask.Response(status=304)
+    else:
+        response = flask.jsonify(build())
+    response.set_etag(etag)
+    response.headers["Cache-Control"] = "no-cache"
+    return response
+
+
+@app.route("/manager/json")
+def manager_json():
+    """
+    已连接nuc的列表, 不含心跳时间, 只在登录、断开、新数据、跟踪状态变化时改变
+    """
+    data.refresh_nuc()
+    return json_with_etag(data.version, lambda: {"version": data.version,
+                                                 "nucs": [data.nuc_summary(i) for i in data.nuc]})
+
+
+@app.route("/manager/id=<nuc_id>/json")
+def manager_id_json(nuc_id):
+    """
+    一个nuc的信息与数据, 参数 start 为返回的第一行的序号
+    """
+    data.refresh_nuc()
+    nuc = data.nuc.get(nuc_id)
+    if nuc is None:
+        return flask.jsonify(OK=False, error="找不到id"), 404
+    start = request.args.get("start", 0, int)
+    rows = nuc.get("data")
+    return json_with_etag(nuc.get("version", 0), lambda: {"version": nuc.get("version", 0),
+                                                          "table": table_id(rows),
+                                                          "nuc": data.nuc_summary(nuc),
+                                                          "start": start,
+                                                          "data": rows[start:] if rows is not None else []})
+
+
 def manager_save_track():
     """
-    返回被更新的文件
+    以流的形式返回跟踪的数据, 默认为CSV, 表单中 "format" 为 "yaml" 时返回多文档yaml
     """
     nuc_id = request.form.get("save tracked data")
-    for track_data in data.track_and_cache_data:
-        if track_data["nuc"]["token"] == nuc_id:
-            break
-    else:
+    track_data = data.track_and_cache_data.get(nuc_id)
+    if track_data is None:
         return manager_error(error="找不到token对应的数据")
-    data_string = data.track_to_string(data)
-    steam = io.StringIO(data_string)
-    return flask.send_file(steam, as_attachment=True)  # NOTE: 我觉得这段没问题......
+    # 保存到磁盘的数据更完整, 优先使用
+    store = track_data["data"] if track_data["disk"] is None else track_data["disk"]
+    # 表单中 "last" 为秒数时只导出最近这段时间的数据, 按时间戳二分查找, 不读取更早的数据
+    last = request.form.get("last", type=float)
+    start_ns = None if last is None else time.time_ns() - int(last * 1e9)
+    if request.form.get("format") == "yaml":
+        chunks, mimetype, suffix = data.iter_track_yaml(store, start_ns), "application/yaml", "yaml"
+    else:
+        chunks, mimetype, suffix = data.iter_track_csv(store, start_ns=start_ns), "text/csv", "csv"
+    return flask.Response(flask.stream_with_context(chunks), mimetype=mimetype,
+                          headers={"Content-Disposition": f"attachment; filename=track_{nuc_id}.{suffix}"})
 
 
 def manager_error(**kwargs):
@@ -83,7 +303,7 @@ def manager_error(**kwargs):
 def manager_edit_nuc_save_file():
     """
     更新nuc端保存文件路径
-    :return: str
+    :return: 出错时为错误页面, 成功时重定向到管理页
     """
     # 获取新保存路径
     new_nuc_save_path = request.form.get("new nuc save file path")
@@ -107,15 +327,11 @@ def manager_edit_nuc_save_file():
             # 没有写入权限, 报错
             return manager_error(error="没有写入权限")
     # 将路径写入配置
-    data.CONFIG_DATA["paths_nuc"]["save_path"] = new_nuc_save_path
-    data.save_config()
-    # 返回新的文件名称
-    data.refresh_nuc()
-    return flask.render_template("manager_base.html",
-                                 nuc_save_file_path=new_nuc_save_path,
-                                 track_and_cache_data=data.track_and_cache_data,
-                                 tracked_and_cached_nuc_list=list(data.get_nuc_info_from_track_and_cache_data()),
-                                 nucs=data.nuc)
+    with data.config_lock:
+        data.CONFIG_DATA["paths_nuc"]["save_path"] = new_nuc_save_path
+        data.save_config()
+    # 回到管理页, 表格由 GET 请求通过渲染缓存生成, 刷新页面也不会重复提交
+    return flask.redirect(flask.url_for('manager'), code=303)
 
 
 @app.route("/app_update", methods=['GET', 'POST'])
@@ -126,35 +342,77 @@ def app_update():
     if request.method == 'GET':
         return manager_error(error="please post the url")
     nuc_id = request.form.get("nuc_id")
-    for nuc_data in data.nuc:
-        if nuc_data["token"] == nuc_id:
-            break
-    else:
+    nuc_data = data.nuc.get(nuc_id)
+    if nuc_data is None:
         return flask.jsonify(OK=False, error="未登录")
-    value = {i: request.form[i] for i in request.form.keys()}
+    data.nuc.touch(nuc_data)
+    value = {i: request.form[i] for i in request.form.keys() if i != "nuc_id"}
     if "data" in value:
-        value["data"] = eval(value["data"])
-    nuc_data.update(value)
-    nuc_data["timestamp"] = time.time()
-    return flask.jsonify(OK=True, id=nuc_id,
+        error = append_form_rows(nuc_data, value)
+        if error is not None:
+            return error
+    if value and data.nuc.save(nuc_data, value):
+        data.mark_changed(nuc_id)
+    return flask.jsonify(OK=True, id=nuc_id, seq=len(nuc_data.get("data", ())),
                          config=nuc_data.get("config_path", data.CONFIG_DATA["paths_nuc"]["config_path"]),
                          upload=nuc_data.get("upload_path", data.CONFIG_DATA["paths_nuc"]["upload_path"]))
 
 
+def append_form_rows(nuc_data, value: dict) -> flask.Response | None:
+    """
+    保存表单中上传的数据, 从 value 中取出 data, data_format, seq, reset
+    :return: 出错时返回给客户端的响应, 成功时为 None
+    """
+    try:
+        rows = payload.decode_rows(value.pop("data"), value.pop("data_format", None))
+    except ValueError as err:
+        return flask.jsonify(OK=False, error="数据格式错误", detail=str(err))
+    if "seq" in value:
+        # 增量上传, 只包含新写入的行
+        seq = int(value.pop("seq"))
+        reset = value.pop("reset", "0") == "1"
+    else:
+        # 旧版客户端每次上传整个文件
+        seq, reset = 0, True
+    if data.nuc_append_data(nuc_data, rows, seq, reset) != 0:
+        return flask.jsonify(OK=False, error="需要重新同步", seq=len(nuc_data["data"]))
+    return None
+
+
 @app.route("/app_upload_data", methods=['GET', 'POST'])
 def app_upload_data():
     """
-    接受上传的数据
+    接受上传的数据, 只保存数据行, 不修改其他字段
     """
     if request.method == 'GET':
         return manager_error(error="please post the url")
     nuc_id = request.form.get("nuc_id")
-    for nuc_data in data.nuc:
-        if nuc_data["token"] == nuc_id:
-            break
-    else:
+    nuc_data = data.nuc.get(nuc_id)
+    if nuc_data is None:
+        return flask.jsonify(OK=False, error="未登录")
+    data.nuc.touch(nuc_data)
+    value = {i: request.form[i] for i in ("data", "data_format", "seq", "reset") if i in request.form}
+    if "data" not in value:
+        return flask.jsonify(OK=False, error="没有数据")
+    error = append_form_rows(nuc_data, value)
+    if error is not None:
+        return error
+    return flask.jsonify(OK=True, seq=len(nuc_data["data"]))
+
+
+@app.route("/app_heartbeat", methods=['POST'])
+def app_heartbeat():
+    """
+    心跳, 只更新时间戳
+    先查本进程中的数据, 共享后端中由其他进程登录的 nuc 才读取完整的记录
+    peek 在数据库被修改过时会确认令牌仍然存在, 其他进程使之过期后心跳返回未登录
+    """
+    nuc_id = request.form.get("nuc_id")
+    nuc_data = data.nuc.peek(nuc_id) or data.nuc.get(nuc_id)
+    if nuc_data is None:
         return flask.jsonify(OK=False, error="未登录")
-    nuc_data["timestamp"] = time.time()
+    data.nuc.touch(nuc_data)
+    return flask.jsonify(OK=True)
 
 
 @app.route("/app_login", methods=['GET', 'POST'])
@@ -181,7 +439,10 @@ def app_login():
         return flask.jsonify({"OK": True,
                               "id": nuc_id,
                               "config": data.CONFIG_DATA["paths_nuc"]["config_path"],
-                              "upload": data.CONFIG_DATA["paths_nuc"]["upload_path"]})
+                              "upload": data.CONFIG_DATA["paths_nuc"]["upload_path"],
+                              "content_encodings": payload.CONTENT_ENCODINGS,
+                              # 心跳间隔, 有此项说明支持 /app_heartbeat 与 /app_upload_data
+                              "heartbeat(s)": data.CONFIG_DATA["connection"]["nuc_disconnect_time(s)"] / 4})
     elif request.method == "GET":
         # Get request
         return flask.render_template("app_login.html")
@@ -202,24 +463,157 @@ def manager_id(nuc_id):
         return manager_id_reversal_tracking_state(nuc_id)
 
 
+@app.route("/manager/id=<nuc_id>/query")
+def manager_id_query(nuc_id):
+    """
+    按时间范围查询并降采样, 参数 from, to 为时间戳(s), points 为返回的点数上限
+    """
+    nuc = data.nuc.get(nuc_id)
+    if nuc is None:
+        return flask.jsonify(OK=False, error="找不到id")
+    # 参数无法转换时使用默认值
+    start = request.args.get("from", None, float)
+    stop = request.args.get("to", None, float)
+    points = min(request.args.get("points", 500, int), 10000)
+    return flask.jsonify(OK=True, id=nuc_id, **data.nuc_query(nuc, start, stop, points))
+
+
+@app.route("/manager/id=<nuc_id>/stats")
+def manager_id_stats(nuc_id):
+    """
+    各列的统计, 参数 from, to 为时间戳(s), 或 last 为最近多少秒, 都没有时统计全部数据
+    没有新数据时重复查询使用缓存的结果
+    """
+    nuc = data.nuc.get(nuc_id)
+    if nuc is None:
+        return flask.jsonify(OK=False, error="找不到id")
+    start = request.args.get("from", None, float)
+    stop = request.args.get("to", None, float)
+    last = request.args.get("last", None, float)
+    if last is not None:
+        start = time.time() - last
+    return flask.jsonify(OK=True, id=nuc_id, **data.nuc_stats(nuc, start, stop))
+
+
+ROWS_PER_EVENT = 1000  # 每次推送的最多行数
+
+
+def table_id(rows) -> int:
+    """
+    :param rows: nuc 数据中的 "data", 可以为 None
+    :return: ColumnTable 的 id, 还没有数据时为 0
+    清空或同一令牌重新登录后 epoch 可能与之前相同, id 总是不同
+    """
+    return 0 if rows is None else rows.id
+
+
+def manager_id_event_stream(nuc_id, sent, table):
+    last_sent = 0
+    while True:
+        version = data.version
+        nuc = data.nuc.get(nuc_id)
+        if nuc is None:
+            yield format_event("gone", nuc_id)
+            return
+        rows = nuc.get("data")
+        if table_id(rows) != table:
+            # 数据被清空重传, 页面需要重新加载
+            yield format_event("reset", table_id(rows))
+            return
+        if rows is not None and len(rows) > sent:
+            stop = min(len(rows), sent + ROWS_PER_EVENT)
+            # 键中的 id 在进程中唯一, 不会与其他登录或清空前的数据混淆
+            yield cached_event(("rows", table, sent, stop),
+                               lambda: format_event("rows", {"start": sent, "rows": rows[sent:stop]}))
+            sent = stop
+            continue
+        if time.time() - last_sent >= 1:
+            yield format_event("last", nuc["last"])
+            last_sent = time.time()
+        time.sleep(EVENT_INTERVAL)
+        data.wait_for_change(version, 1)
+
+
+@app.route("/manager/id=<nuc_id>/events")
+def manager_id_events(nuc_id):
+    """
+    推送一个nuc新收到的数据行 (Server-Sent Events)
+    参数 since 为页面已有的行数, data 为页面数据的 table_id
+    事件 "rows": {"start": 第一行的序号, "rows": [CSV 行]}
+    事件 "last": 距上次更新的秒数, 每秒一次
+    事件 "reset": 数据被清空, 需要重新加载页面; 事件 "gone": nuc已断开
+    """
+    since = request.args.get("since", 0, int)
+    table = request.args.get("data", 0, int)
+    return flask.Response(manager_id_event_stream(nuc_id, since, table),
+                          mimetype="text/event-stream", headers={"Cache-Control": "no-cache"})
+
+
+PAGE_SIZE = 100  # 数据表每页默认的行数
+MAX_PAGE_SIZE = 1000
+
+
+def page_bounds(rows: int, start: int | None, size: int) -> tuple[int, int]:
+    """
+    :param rows: 总行数
+    :param start: 第一行的序号, None 表示最后一页
+    :param size: 每页行数
+    :return: 这一页的 (开始序号, 结束序号)
+    """
+    size = min(max(size, 1), MAX_PAGE_SIZE)
+    if start is None:
+        start = max(rows - size, 0)
+    start = min(max(start, 0), rows)
+    return start, min(start + size, rows)
+
+
+@app.route("/manager/id=<nuc_id>/rows")
+def manager_id_rows(nuc_id):
+    """
+    一段数据行, 供翻页与滚动加载使用, 参数 start 为第一行的序号(默认最后一页), size 为行数上限
+    返回的行数不超过 MAX_PAGE_SIZE, 与数据总量无关
+    table 与页面、推送中的相同, 变化时说明数据被清空或重新登录, 之前取得的行已经无效
+    """
+    nuc = data.nuc.get(nuc_id)
+    if nuc is None:
+        return flask.jsonify(OK=False, error="找不到id"), 404
+    table = nuc.get("data")
+    rows = table if table is not None else ()
+    start, stop = page_bounds(len(rows), request.args.get("start", None, int), request.args.get("size", PAGE_SIZE, int))
+    return flask.jsonify(OK=True, id=nuc_id, table=table_id(table), rows=len(rows),
+                         width=rows.width if rows else 0, start=start, data=rows[start:stop])
+
+
 def manager_id_method_get(nuc_id):
-    for nuc in data.nuc:
-        if nuc["token"] == nuc_id:
-            break
-    else:
+    """
+    只渲染一页数据, 参数同 manager_id_rows
+    """
+    nuc = data.nuc.get(nuc_id)
+    if nuc is None:
         return manager_error(error="找不到id")
-    is_tracking = "停止追踪" if nuc["token"] in data.get_nuc_info_from_track_and_cache_data() else "开始跟踪"
+    is_tracking = "停止追踪" if data.is_tracking(nuc["token"]) else "开始跟踪"
+    rows = nuc.get("data", ())
+    count = len(rows)
+    size = min(max(request.args.get("size", PAGE_SIZE, int), 1), MAX_PAGE_SIZE)
+    start, stop = page_bounds(count, request.args.get("start", None, int), size)
+    # 列数在收到数据时维护, 不需要遍历所有行
     return flask.render_template("manager_id.html",
-                                 column=max(len(i) for i in nuc["data"]), nuc=nuc, is_tracking=is_tracking)
+                                 column=rows.width if rows else 0, nuc=nuc, is_tracking=is_tracking,
+                                 rows=count, table=table_id(nuc.get("data")),
+                                 page=rows[start:stop], start=start, size=size, last_page=stop == count)
 
 
 def manager_id_reversal_tracking_state(nuc_id):
     """
     供 manger_id 调用, 用于反转对某nuc的跟踪状态
     """
-    # TODO: 添加or删除跟踪状态, 其实应该先写data的api
+    if data.is_tracking(nuc_id):
+        data.untrack_nuc(nuc_id)
+    elif not data.track_nuc(nuc_id):
+        return manager_error(error="找不到id")
     return manager_id_method_get(nuc_id)  # 返回值和get方法返回内容一致
 
 
 if __name__ == '__main__':
-    app.run(host="0.0.0.0", port=5001)
+    beacon.start(5001, VERSION, data.CONFIG_DATA["beacon"]["port"])
+    app.run(host="0.0.0.0", port=5001, threaded=True)
@@ -0,0 +1,257 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+asyncio 服务模式
+在单个事件循环上提供与 app.py 相同的全部路由, 适合大量客户端同时心跳的场景
+只有确实不会阻塞的请求直接在事件循环中执行: 首页跳转, 以及使用进程内后端时的心跳(O(1), 不访问磁盘);
+登录(会检查过期)、上传数据、管理页面渲染、导出等交给线程池, 大批量上传不会拖慢心跳
+推送(Server-Sent Events)长时间占用线程, 使用单独的线程池, 打开再多的推送页面也不会占满处理上传的线程
+运行: python async_server.py [host] [port]
+"""
+# 内置模块
+import io
+import re
+import sys
+import typing
+import asyncio
+import urllib.parse
+import concurrent.futures
+# 项目模块
+import data
+import beacon
+from app import app, VERSION
+
+INLINE_PATH = re.compile(r"^/(app_heartbeat)?$")  # 在事件循环中直接执行的路径, 见 executor_for
+STREAM_PATH = re.compile(r"/events$")  # 推送的路径
+EXECUTOR_THREADS = 32  # 处理上传、页面、导出等请求的线程池大小
+STREAM_THREADS = 64  # 推送专用的线程池大小, 也是同时打开的推送页面数量上限
+MAX_BODY_SIZE = 64 * 1024 * 1024
+KEEP_ALIVE_TIMEOUT = 75  # 空闲连接保持的时间(s)
+
+_executor = concurrent.futures.ThreadPoolExecutor(EXECUTOR_THREADS, thread_name_prefix="num-online")
+_streams = concurrent.futures.ThreadPoolExecutor(STREAM_THREADS, thread_name_prefix="num-online-events")
+_end = object()
+
+
+class BadRequest(Exception):
+    """
+    请求无法处理, status 为返回的状态
+    """
+
+    def __init__(self, status: str, message: str):
+        super().__init__(message)
+        self.status = status
+
+
+async def read_request(reader: asyncio.StreamReader) -> tuple[str, str, str, dict, bytes] | None:
+    """
+    读取一个请求
+    :raise BadRequest: 请求无法解析或过大
+    :return: (方法, 路径, 协议版本, 请求头, 请求体), 连接已关闭时为 None
+    """
+    try:
+        head = await reader.readuntil(b"\r\n\r\n")
+    except asyncio.IncompleteReadError:
+        return None
+    except asyncio.LimitOverrunError:
+        raise BadRequest("431 Request Header Fields Too Large", "请求头过大")
+    lines = head.decode("latin-1").split("\r\n")
+    try:
+        method, target, version = lines[0].split(" ")
+    except ValueError:
+        raise BadRequest("400 Bad Request", "请求行错误")
+    headers = {}
+    for line in lines[1:]:
+        if line:
+            key, _, value = line.partition(":")
+            headers[key.strip().lower()] = value.strip()
+    if "chunked" in headers.get("transfer-encoding", "").lower():
+        raise BadRequest("411 Length Required", "不支持分块上传")
+    try:
+        length = int(headers.get("content-length") or 0)
+    except ValueError:
+        raise BadRequest("400 Bad Request", "Content-Length 错误")
+    if length > MAX_BODY_SIZE:
+        raise BadRequest("413 Payload Too Large", "请求体过大")
+    body = await reader.readexactly(length) if length else b""
+    return method, target, version, headers, body
+
+
+def make_environ(method, target, version, headers, body, peer, server_address) -> dict:
+    """
+    :return: WSGI environ
+    """
+    path, _, query = target.partition("?")
+    environ = {
+        "REQUEST_METHOD": method,
+        "SCRIPT_NAME": "",
+        "PATH_INFO": urllib.parse.unquote(path, "latin-1"),
+        "QUERY_STRING": query,
+        "SERVER_NAME": str(server_address[0]),
+        "SERVER_PORT": str(server_address[1]),
+        "SERVER_PROTOCOL": version,
+        "REMOTE_ADDR": str(peer[0]) if peer else "",
+        "CONTENT_TYPE": headers.get("content-type", ""),
+        "CONTENT_LENGTH": str(len(body)),
+        "wsgi.version": (1, 0),
+        "wsgi.url_scheme": "http",
+        "wsgi.input": io.BytesIO(body),
+        "wsgi.errors": sys.stderr,
+        "wsgi.multithread": True,
+        "wsgi.multiprocess": False,
+        "wsgi.run_once": False,
+    }
+    for key, value in headers.items():
+        if key not in ("content-type", "content-length"):
+            environ["HTTP_" + key.upper().replace("-", "_")] = value
+    return environ
+
+
+def call_app(environ) -> tuple[str, list, object, typing.Iterator[bytes], typing.Iterable[bytes]]:
+    """
+    调用 WSGI 应用, 并取得第一块响应内容(部分应用在此时才调用 start_response)
+    :return: (状态, 响应头, 第一块内容或 _end, 剩余内容的迭代器, 需要关闭的响应体)
+    """
+    started = []
+
+    def start_response(status, response_headers, exc_info=None):
+        started[:] = [status, response_headers]
+
+    body = app.wsgi_app(environ, start_response)
+    iterator = iter(body)
+    first = next(iterator, _end)
+    return started[0], started[1], first, iterator, body
+
+
+def executor_for(path: str) -> concurrent.futures.ThreadPoolExecutor | None:
+    """
+    :return: 处理这个路径的线程池, None 表示直接在事件循环中执行
+    共享的后端(sqlite)中心跳可能需要查询数据库, 也交给线程池
+    """
+    if INLINE_PATH.match(path) and (path == "/" or not data.nuc.shared):
+        return None
+    return _streams if STREAM_PATH.search(path) else _executor
+
+
+def close_body(body):
+    if hasattr(body, "close"):
+        body.close()
+
+
+class Connection:
+    """
+    一个客户端连接, 可以依次处理多个请求(keep-alive)
+    """
+
+    def __init__(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        self.reader = reader
+        self.writer = writer
+        self.peer = writer.get_extra_info("peername")
+        self.server_address = writer.get_extra_info("sockname")
+
+    async def run(self):
+        loop = asyncio.get_running_loop()
+        try:
+            while True:
+                try:
+                    request = await asyncio.wait_for(read_request(self.reader), KEEP_ALIVE_TIMEOUT)
+                except BadRequest as err:
+                    await self.send_simple(err.status, str(err))
+                    break
+                if request is None:
+                    break
+                method, target, version, headers, body = request
+                connection = headers.get("connection", "").lower()
+                keep_alive = connection == "keep-alive" if version == "HTTP/1.0" else connection != "close"
+                environ = make_environ(method, target, version, headers, body, self.peer, self.server_address)
+                executor = executor_for(environ["PATH_INFO"])
+                if executor is None:
+                    # 心跳, 直接执行
+                    keep_alive = await self.respond(call_app(environ), version, keep_alive, method, None)
+                else:
+                    result = await loop.run_in_executor(executor, call_app, environ)
+                    keep_alive = await self.respond(result, version, keep_alive, method, executor)
+                if not keep_alive:
+                    break
+        except (asyncio.TimeoutError, ConnectionError, asyncio.IncompleteReadError):
+            pass
+        finally:
+            self.writer.close()
+
+    async def send_simple(self, status, text):
+        body = text.encode()
+        self.writer.write(f"HTTP/1.1 {status}\r\nContent-Type: text/plain; charset=utf-8\r\n"
+                          f"Content-Length: {len(body)}\r\nConnection: close\r\n\r\n".encode("latin-1") + body)
+        await self.writer.drain()
+
+    async def respond(self, result, version, keep_alive, method,
+                      executor: concurrent.futures.ThreadPoolExecutor | None) -> bool:
+        """
+        发送响应
+        响应体较短或在事件循环中生成时一次发送; 否则(导出、推送)逐块在线程池中生成并以分块编码发送
+        :param executor: 生成响应体使用的线程池, 与调用应用时相同, None 表示在事件循环中生成
+        :return: 连接是否可以继续使用
+        """
+        status, headers, first, iterator, body = result
+        inline = executor is None
+        loop = asyncio.get_running_loop()
+        names = {key.lower() for key, _ in headers}
+        chunks = [] if first is _end else [first]
+        try:
+            if inline or "content-length" in names:
+                # 内容已经确定, 一次取完
+                if inline:
+                    chunks.extend(iterator)
+                streaming = False
+            else:
+                streaming = True
+            if not streaming and "content-length" not in names:
+                headers = headers + [("Content-Length", str(sum(len(i) for i in chunks)))]
+            chunked = streaming and version == "HTTP/1.1"
+            if chunked:
+                headers = headers + [("Transfer-Encoding", "chunked")]
+            elif streaming:
+                keep_alive = False  # HTTP/1.0 只能以关闭连接表示结束
+            headers = headers + [("Connection", "keep-alive" if keep_alive else "close")]
+            head = f"{version} {status}\r\n" + "".join(f"{k}: {v}\r\n" for k, v in headers) + "\r\n"
+            self.writer.write(head.encode("latin-1"))
+            if method == "HEAD":
+                return keep_alive
+            if not streaming:
+                if not inline and "content-length" in names:
+                    # 已知长度的响应(如 send_file)仍在线程池中读取
+                    while (chunk := await loop.run_in_executor(executor, next, iterator, _end)) is not _end:
+                        chunks.append(chunk)
+                self.writer.write(b"".join(chunks))
+                await self.writer.drain()
+                return keep_alive
+            chunk = chunks[0] if chunks else _end
+            while chunk is not _end:
+                if chunk:
+                    self.writer.write(b"%x\r\n%s\r\n" % (len(chunk), chunk) if chunked else chunk)
+                    await self.writer.drain()
+                chunk = await loop.run_in_executor(executor, next, iterator, _end)
+            if chunked:
+                self.writer.write(b"0\r\n\r\n")
+                await self.writer.drain()
+            return keep_alive
+        finally:
+            if inline:
+                close_body(body)
+            else:
+                # 关闭推送的生成器也可能阻塞, 放到线程池
+                await loop.run_in_executor(executor, close_body, body)
+
+
+async def serve(host="0.0.0.0", port=5001):
+    server = await asyncio.start_server(lambda r, w: Connection(r, w).run(), host, port, limit=64 * 1024)
+    print("serving on %s:%d (asyncio)" % (host, port))
+    async with server:
+        await server.serve_forever()
+
+
+if __name__ == "__main__":
+    argv = sys.argv[1:]
+    http_port = int(argv[1]) if len(argv) > 1 else 5001
+    beacon.start(http_port, VERSION, data.CONFIG_DATA["beacon"]["port"])
+    asyncio.run(serve(argv[0] if argv else "0.0.0.0", http_port))
@@ -0,0 +1,740 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+保存已连接 nuc 与跟踪状态的后端
+MemoryBackend: 全部保存在本进程内, 只能单进程运行
+SqliteBackend: 保存在 SQLite 文件中(WAL 模式), 多个服务器进程使用同一个文件时共享全部 nuc
+两者接口相同, 由 data.open_backend 按配置选择
+"""
+import sys
+import json
+import time
+import heapq
+import queue
+import typing
+import sqlite3
+import threading
+import contextlib
+
+import columns
+import track_store
+
+
+class NucSession(dict):
+    """
+    单个 nuc 的数据字典
+    "last" (距上次更新的秒数) 不再保存, 读取时按 "timestamp" 即时计算
+    ingest_lock 是这个 nuc 自己的锁, 追加数据行时持有, 大批上传不会阻塞同一分片中的登录、心跳与过期检查
+    """
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.ingest_lock = threading.Lock()
+
+    def __missing__(self, key):
+        if key == "last":
+            return round(time.time() - self["timestamp"], 1)
+        raise KeyError(key)
+
+
+class _Shard:
+    """
+    MemoryBackend 的一个分片, 字段由 lock 保护
+    """
+
+    def __init__(self):
+        self.lock = threading.RLock()
+        self.by_token = {}  # 令牌 -> nuc 数据
+        self.deadlines = []  # 最小堆, 元素为 (入堆时的时间戳, 令牌)
+        self.queued = {}  # 令牌 -> 堆中有效元素的时间戳, 每个令牌在堆中只有一个有效元素
+
+
+class MemoryBackend:
+    """
+    进程内的后端: 已连接 nuc 的登记表, 可以在多个线程中使用
+    按令牌建立索引, 查找、添加、删除都是 O(1)
+    另有一个按时间戳排序的最小堆, 过期检查只会碰到真正到期的 nuc
+    数据按令牌分为多个分片, 每个分片一把锁, 不同令牌的请求很少互相等待
+    迭代时依次返回各个 nuc 的数据字典(迭代开始时的快照)
+    """
+
+    def __init__(self, shards: int = 16):
+        self._shards = [_Shard() for _ in range(shards)]
+
+    def _shard(self, key) -> _Shard:
+        return self._shards[hash(key) % len(self._shards)]
+
+    def lock(self, token) -> threading.RLock:
+        """
+        :return: 令牌所在分片的锁, 修改同一个 nuc 的数据时需要持有
+        """
+        return self._shard(token).lock
+
+    def __len__(self):
+        return sum(len(shard.by_token) for shard in self._shards)
+
+    def __iter__(self):
+        return iter(self.values())
+
+    def __contains__(self, token):
+        return token in self._shard(token).by_token
+
+    def values(self) -> list[dict, ...]:
+        """
+        :return: 所有 nuc 数据(列表是快照, 字典本身仍会被修改)
+        """
+        result = []
+        for shard in self._shards:
+            with shard.lock:
+                result.extend(shard.by_token.values())
+        return result
+
+    def snapshot(self) -> list[dict, ...]:
+        """
+        :return: 所有 nuc 数据的浅复制, 供管理页面在不持有锁的情况下读取
+        """
+        result = []
+        for shard in self._shards:
+            with shard.lock:
+                result.extend(NucSession(i) for i in shard.by_token.values())
+        return result
+
+    def tokens(self) -> list[str, ...]:
+        """
+        :return: 所有令牌
+        """
+        result = []
+        for shard in self._shards:
+            with shard.lock:
+                result.extend(shard.by_token)
+        return result
+
+    def get(self, token, default=None):
+        """
+        按令牌查找
+        :param token: 令牌
+        :param default: 找不到时的返回值
+        :return: nuc 数据或 default
+        """
+        return self._shard(token).by_token.get(token, default)  # dict.get 本身是原子的, 不必加锁
+
+    def add(self, nuc_data: dict):
+        """
+        添加(或替换)一个 nuc
+        :param nuc_data: nuc 数据, 必须含有 "token", "timestamp"
+        """
+        token = nuc_data["token"]
+        shard = self._shard(token)
+        with shard.lock:
+            shard.by_token[token] = nuc_data
+            if token not in shard.queued:
+                # 已在堆中的元素时间戳只会更早, 到期检查时会重新入堆, 这里不必重复添加
+                shard.queued[token] = nuc_data["timestamp"]
+                heapq.heappush(shard.deadlines, (nuc_data["timestamp"], token))
+
+    def remove(self, token):
+        """
+        删除一个 nuc
+        :param token: 令牌
+        :return: 被删除的 nuc 数据, 不存在时为 None
+        """
+        shard = self._shard(token)
+        with shard.lock:
+            # 堆中的元素留到到期时再丢弃
+            return shard.by_token.pop(token, None)
+
+    def expire(self, max_age) -> list[dict, ...]:
+        """
+        删除超过 max_age 秒未更新的 nuc
+        更新时间戳时不必通知登记表: 堆顶到期时再读取真实时间戳, 未过期则按新时间戳重新入堆
+        :param max_age: 最长未更新时间(s)
+        :return: 被删除的 nuc 数据
+        """
+        limit = time.time() - max_age
+        removed = []
+        for shard in self._shards:
+            with shard.lock:
+                while shard.deadlines and shard.deadlines[0][0] < limit:
+                    stamp, token = heapq.heappop(shard.deadlines)
+                    if shard.queued.get(token) != stamp:
+                        # 失效的元素
+                        continue
+                    nuc_data = shard.by_token.get(token)
+                    if nuc_data is None:
+                        # 已被删除
+                        del shard.queued[token]
+                    elif nuc_data["timestamp"] < limit:
+                        # 确实过期
+                        del shard.queued[token]
+                        removed.append(shard.by_token.pop(token))
+                    else:
+                        # 期间有更新, 按新的时间戳重新入堆
+                        shard.queued[token] = nuc_data["timestamp"]
+                        heapq.heappush(shard.deadlines, (nuc_data["timestamp"], token))
+        return removed
+
+    # 以下是与 SqliteBackend 共用的接口, 进程内的数据就是唯一的一份, 大多不需要额外的操作
+
+    shared = False  # 是否与其他进程共享
+
+    def peek(self, token, default=None):
+        """
+        只读取本进程中的数据, 不访问共享存储
+        """
+        return self.get(token, default)
+
+    def touch(self, nuc_data):
+        """
+        心跳, 更新时间戳
+        """
+        nuc_data["timestamp"] = time.time()
+
+    def save(self, nuc_data, fields: dict) -> bool:
+        """
+        修改 nuc 数据中的字段
+        :return: 是否有字段发生了变化
+        """
+        with self.lock(nuc_data["token"]):
+            changed = {k: v for k, v in fields.items() if nuc_data.get(k) != v}
+            nuc_data.update(changed)
+        return bool(changed)
+
+    def save_rows(self, nuc_data, start: int, reset: bool):
+        """
+        nuc_data["data"] 从第 start 行开始是新追加的, 调用时持有 nuc_data.ingest_lock
+        :param reset: 追加前是否清空过
+        """
+
+    def track_store(self, nuc_data, capacity: int, retention: float | None) -> track_store.TrackStore:
+        """
+        :return: 保存跟踪数据的对象
+        """
+        return track_store.TrackStore(capacity, retention)
+
+    def set_tracking(self, nuc_data, tracking: bool):
+        """
+        记录跟踪状态
+        """
+
+    def tracked(self) -> dict | None:
+        """
+        :return: 所有被跟踪的 令牌 -> nuc 数据, None 表示跟踪状态只保存在本进程中
+        """
+        return None
+
+    def rekey(self, old, new):
+        """
+        被跟踪的 nuc 断开后以新的令牌重新登录, 把保存的数据转到新的令牌下
+        """
+
+    def watch(self, callback: typing.Callable[[str], None]):
+        """
+        其他进程修改数据后调用 callback(令牌)
+        """
+
+    def flush(self):
+        """
+        写入缓冲中的修改
+        """
+
+    def close(self):
+        self.flush()
+
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS nuc (
+    token TEXT PRIMARY KEY,
+    name TEXT NOT NULL,
+    user TEXT NOT NULL,
+    timestamp REAL NOT NULL,
+    fields TEXT NOT NULL DEFAULT '{}',  -- 其余字段, JSON 对象
+    rows INTEGER NOT NULL DEFAULT 0,  -- 当前这一轮上传的行数
+    epoch INTEGER NOT NULL DEFAULT 0,  -- 清空次数
+    revision INTEGER NOT NULL DEFAULT 0  -- 除心跳外每次修改加一, 其他进程据此发现变化
+);
+CREATE INDEX IF NOT EXISTS nuc_timestamp ON nuc (timestamp);
+CREATE TABLE IF NOT EXISTS nuc_row (
+    token TEXT NOT NULL,
+    epoch INTEGER NOT NULL,
+    seq INTEGER NOT NULL,
+    time REAL NOT NULL,  -- 收到的时间(s)
+    row TEXT NOT NULL,  -- CSV 行, JSON 数组
+    PRIMARY KEY (token, epoch, seq)
+) WITHOUT ROWID;
+CREATE TABLE IF NOT EXISTS tracked (
+    token TEXT PRIMARY KEY,
+    name TEXT NOT NULL,
+    user TEXT NOT NULL,
+    since REAL NOT NULL  -- 开始跟踪的时间(s)
+);
+"""
+# 这些字段单独成列或只在本进程中使用, 不写入 nuc.fields
+LOCAL_KEYS = frozenset(("token", "name", "user", "timestamp", "data", "epoch", "version"))
+SELECT_NUC = "SELECT token, name, user, timestamp, fields, rows, epoch FROM nuc"
+WATCH_INTERVAL = 0.5  # 检查其他进程修改的间隔(s)
+FETCH_SIZE = 1024  # 逐批读取数据行时每批的行数
+
+
+def _dump_row(row) -> str:
+    return json.dumps(row, ensure_ascii=False, separators=(",", ":"))
+
+
+class SqliteTrackView:
+    """
+    SqliteBackend 中一个被跟踪 nuc 的数据, 接口与 track_store.TrackStore 一致
+    上传的行已经由 save_rows 写入 nuc_row 表, 这里只按开始跟踪的时间、容量与保留时间读取, 不另外保存
+    """
+
+    def __init__(self, backend: "SqliteBackend", nuc_data, capacity: int, retention: float | None):
+        self.backend = backend
+        self.nuc_data = nuc_data  # 重新登录后令牌会改变, 每次读取时从这里取
+        self.capacity = capacity
+        self.retention = retention
+
+    def append(self, time_ns: int, row: typing.Sequence[str]):
+        pass
+
+    def extend(self, time_ns: int, rows: typing.Iterable[typing.Sequence[str]]):
+        pass
+
+    def _range(self, db) -> tuple[str, float]:
+        token = self.nuc_data["token"]
+        since = db.execute("SELECT since FROM tracked WHERE token = ?", (token,)).fetchone()
+        since = since[0] if since else float("inf")
+        if self.retention is not None:
+            since = max(since, time.time() - self.retention)
+        return token, since
+
+    def __len__(self):
+        with self.backend.connect() as db:
+            count = db.execute("SELECT COUNT(*) FROM nuc_row WHERE token = ? AND time >= ?", self._range(db)).fetchone()
+        return min(count[0], self.capacity)
+
+    def rows(self, start_ns: int | None = None, stop_ns: int | None = None) \
+            -> typing.Iterator[tuple[int, list[str, ...]]]:
+        """
+        从旧到新返回时间戳在 [start_ns, stop_ns) 内的 (时间戳(ns), CSV 行)
+        """
+        with self.backend.connect() as db:
+            token, since = self._range(db)
+            if start_ns is not None:
+                since = max(since, start_ns / 1e9)
+            until = float("inf") if stop_ns is None else stop_ns / 1e9
+            cursor = db.execute("SELECT time, row FROM ("
+                                "  SELECT epoch, seq, time, row FROM nuc_row WHERE token = ? AND time >= ? AND time < ?"
+                                "  ORDER BY epoch DESC, seq DESC LIMIT ?"
+                                ") ORDER BY epoch, seq", (token, since, until, self.capacity))
+            while batch := cursor.fetchmany(FETCH_SIZE):
+                for row_time, row in batch:
+                    yield int(row_time * 1e9), json.loads(row)
+
+
+class SqliteBackend:
+    """
+    多个服务器进程共享的后端, 数据保存在一个 SQLite 文件中(WAL 模式, 读写互不阻塞)
+    登录、断开、数据行、跟踪状态立即写入, 其他进程的下一个请求就能看到
+    心跳时间戳与字段修改先在内存中合并, 由后台线程每 flush_interval 秒在一个事务中批量写入
+    每个进程缓存 nuc 数据字典, 读取时只从数据库补充变化的部分, 同一个令牌总是得到同一个字典
+    """
+
+    shared = True
+
+    def __init__(self, path: str, flush_interval: float = 0.2, locks: int = 16):
+        """
+        :param path: 数据库文件路径
+        :param flush_interval: 批量写入心跳的间隔(s)
+        :param locks: 本进程中令牌锁的数量
+        """
+        self.path = path
+        self.flush_interval = flush_interval
+        self._locks = [threading.RLock() for _ in range(locks)]
+        self._pool = queue.SimpleQueue()  # 空闲的连接
+        self._cache = {}  # 令牌 -> NucSession
+        self._confirmed = {}  # 令牌 -> 确认仍在数据库中时 peek 连接的 data_version, 见 peek
+        self._peek_db = None  # peek 专用的连接, data_version 按连接计算
+        self._peek_lock = threading.Lock()
+        self._pending = {}  # 令牌 -> {"timestamp": 时间戳, "fields": {字段}}, 等待写入的修改
+        self._flushing = {}  # 正在写入的修改, 写入完成前读取时仍以这里为准
+        self._pending_lock = threading.Lock()
+        self._flush_lock = threading.Lock()  # 同一时刻只有一个线程在写入缓冲
+        self._closed = threading.Event()
+        with self.connect() as db:
+            db.execute("PRAGMA journal_mode = WAL")
+            db.executescript(SCHEMA)
+        threading.Thread(target=self._flush_loop, name="sqlite-flush", daemon=True).start()
+
+    def _new_connection(self) -> sqlite3.Connection:
+        # 自动提交模式, 需要事务时显式 BEGIN
+        db = sqlite3.connect(self.path, timeout=30, isolation_level=None, check_same_thread=False)
+        db.execute("PRAGMA synchronous = NORMAL")  # WAL 模式下不会损坏数据库, 只可能丢失最近的事务
+        return db
+
+    @contextlib.contextmanager
+    def connect(self) -> typing.Iterator[sqlite3.Connection]:
+        """
+        从连接池中取出一个连接, 用完放回
+        """
+        try:
+            db = self._pool.get_nowait()
+        except queue.Empty:
+            db = self._new_connection()
+        try:
+            yield db
+        finally:
+            self._pool.put(db)
+
+    @contextlib.contextmanager
+    def transaction(self) -> typing.Iterator[sqlite3.Connection]:
+        """
+        写事务, 开始时就取得写锁, 避免读后写升级时出现 SQLITE_BUSY
+        """
+        with self.connect() as db:
+            db.execute("BEGIN IMMEDIATE")
+            try:
+                yield db
+            except BaseException:
+                db.execute("ROLLBACK")
+                raise
+            db.execute("COMMIT")
+
+    def lock(self, token) -> threading.RLock:
+        """
+        :return: 令牌对应的本进程内的锁, 修改同一个 nuc 的数据时需要持有
+        """
+        return self._locks[hash(token) % len(self._locks)]
+
+    def _overlay(self, token) -> dict:
+        """
+        :return: 本进程中还没有写入数据库的修改
+        """
+        with self._pending_lock:
+            flushing, pending = self._flushing.get(token, {}), self._pending.get(token, {})
+            fields = {**flushing.get("fields", {}), **pending.get("fields", {})}
+            timestamp = max(flushing.get("timestamp", 0), pending.get("timestamp", 0))
+        return {"fields": fields, "timestamp": timestamp}
+
+    def _sync(self, db, record) -> NucSession:
+        """
+        用数据库中的一条记录更新本进程缓存的 nuc 数据, 只读取新增的数据行
+        """
+        token, name, user, timestamp, fields, rows, epoch = record
+        overlay = self._overlay(token)
+        with self.lock(token):
+            nuc_data = self._cache.get(token)
+            if nuc_data is None:
+                nuc_data = self._cache[token] = NucSession(token=token, name=name, user=user, timestamp=timestamp)
+            nuc_data["timestamp"] = max(nuc_data["timestamp"], timestamp, overlay["timestamp"])
+            nuc_data.update(json.loads(fields))
+            nuc_data.update(overlay["fields"])
+        if not nuc_data.ingest_lock.acquire(blocking=False):
+            # 本进程正在追加这个 nuc 的数据行, 追加完成后本地的数据就是最新的, 这次不必读取
+            return nuc_data
+        try:
+            if epoch != nuc_data.get("epoch", 0) or rows and "data" not in nuc_data:
+                nuc_data["data"] = columns.ColumnTable()
+                nuc_data["epoch"] = epoch
+            have = len(nuc_data.get("data", ()))
+            if rows > have:
+                cursor = db.execute("SELECT time, row FROM nuc_row WHERE token = ? AND epoch = ? AND seq >= ? "
+                                    "ORDER BY seq LIMIT ?", (token, epoch, have, rows - have))
+                while batch := cursor.fetchmany(FETCH_SIZE):
+                    # 整批追加, 按列解析
+                    nuc_data["data"].extend([json.loads(row) for _, row in batch],
+                                            [row_time for row_time, _ in batch])
+        finally:
+            nuc_data.ingest_lock.release()
+        return nuc_data
+
+    def __len__(self):
+        with self.connect() as db:
+            return db.execute("SELECT COUNT(*) FROM nuc").fetchone()[0]
+
+    def __iter__(self):
+        return iter(self.values())
+
+    def __contains__(self, token):
+        with self.connect() as db:
+            return db.execute("SELECT 1 FROM nuc WHERE token = ?", (token,)).fetchone() is not None
+
+    def values(self) -> list[dict, ...]:
+        """
+        :return: 所有 nuc 数据
+        """
+        with self.connect() as db:
+            result = [self._sync(db, record) for record in db.execute(SELECT_NUC).fetchall()]
+        alive = {nuc_data["token"] for nuc_data in result}
+        for token in list(self._cache):
+            if token not in alive:
+                self._forget(token)
+        return result
+
+    def snapshot(self) -> list[dict, ...]:
+        """
+        :return: 所有 nuc 数据的浅复制
+        """
+        return [NucSession(i) for i in self.values()]
+
+    def tokens(self) -> list[str, ...]:
+        with self.connect() as db:
+            return [token for token, in db.execute("SELECT token FROM nuc")]
+
+    def get(self, token, default=None):
+        """
+        按令牌查找, 同时取得其他进程写入的修改
+        """
+        with self.connect() as db:
+            record = db.execute(SELECT_NUC + " WHERE token = ?", (token,)).fetchone()
+            if record is None:
+                self._forget(token)
+                return default
+            return self._sync(db, record)
+
+    def peek(self, token, default=None):
+        """
+        读取本进程缓存的数据, 不读取其他进程写入的修改
+        数据库在上次确认之后被修改过(PRAGMA data_version 变化)时先确认令牌仍然存在,
+        被其他进程断开或过期删除的 nuc 不会因为本进程的缓存而继续被当作在线
+        """
+        nuc_data = self._cache.get(token)
+        if nuc_data is None:
+            return default
+        with self._peek_lock:
+            if self._peek_db is None:
+                self._peek_db = self._new_connection()
+            version = self._peek_db.execute("PRAGMA data_version").fetchone()[0]
+            if self._confirmed.get(token) == version:
+                return nuc_data
+            alive = self._peek_db.execute("SELECT 1 FROM nuc WHERE token = ?", (token,)).fetchone() is not None
+            if alive:
+                self._confirmed[token] = version
+        if not alive:
+            self._forget(token)
+            return default
+        return nuc_data
+
+    def _forget(self, token):
+        """
+        删除本进程中缓存的数据
+        """
+        self._cache.pop(token, None)
+        with self._peek_lock:
+            self._confirmed.pop(token, None)
+
+    def add(self, nuc_data: dict):
+        """
+        添加(或替换)一个 nuc
+        """
+        token = nuc_data["token"]
+        fields = {k: v for k, v in nuc_data.items() if k not in LOCAL_KEYS}
+        with self.lock(token), self.transaction() as db:
+            db.execute("INSERT OR REPLACE INTO nuc VALUES (?, ?, ?, ?, ?, ?, ?, "
+                       "  COALESCE((SELECT revision FROM nuc WHERE token = ?), 0) + 1)",
+                       (token, nuc_data["name"], nuc_data["user"], nuc_data["timestamp"], json.dumps(fields),
+                        len(nuc_data.get("data", ())), nuc_data.get("epoch", 0), token))
+            self._cache[token] = nuc_data
+
+    def _delete(self, db, tokens: list):
+        # 被跟踪的 nuc 断开后保留数据行, 重新登录时转到新的令牌下
+        db.executemany("DELETE FROM nuc WHERE token = ?", [(token,) for token in tokens])
+        db.executemany("DELETE FROM nuc_row WHERE token = ? AND token NOT IN (SELECT token FROM tracked)",
+                       [(token,) for token in tokens])
+
+    def remove(self, token):
+        """
+        删除一个 nuc
+        :return: 被删除的 nuc 数据, 不存在时为 None
+        """
+        nuc_data = self.get(token)
+        if nuc_data is not None:
+            with self.transaction() as db:
+                self._delete(db, [token])
+            self._forget(token)
+        return nuc_data
+
+    def expire(self, max_age) -> list[dict, ...]:
+        """
+        删除超过 max_age 秒未更新的 nuc
+        只有确实存在过期的 nuc 时才开始写事务
+        """
+        limit = time.time() - max_age
+        with self.connect() as db:
+            if db.execute("SELECT 1 FROM nuc WHERE timestamp < ? LIMIT 1", (limit,)).fetchone() is None:
+                return []
+        self.flush()  # 本进程缓冲中的心跳
+        with self.transaction() as db:
+            records = db.execute(SELECT_NUC + " WHERE timestamp < ?", (limit,)).fetchall()
+            # 其他线程在 flush 之后收到的心跳
+            records = [i for i in records if self._overlay(i[0])["timestamp"] < limit]
+            self._delete(db, [i[0] for i in records])
+        removed = []
+        for token, name, user, timestamp, *_ in records:
+            nuc_data = self._cache.get(token)
+            self._forget(token)
+            removed.append(nuc_data if nuc_data is not None else
+                           NucSession(token=token, name=name, user=user, timestamp=timestamp))
+        return removed
+
+    def touch(self, nuc_data):
+        """
+        心跳, 更新时间戳, 稍后批量写入
+        """
+        now = time.time()
+        nuc_data["timestamp"] = now
+        with self._pending_lock:
+            self._pending.setdefault(nuc_data["token"], {})["timestamp"] = now
+
+    def save(self, nuc_data, fields: dict) -> bool:
+        """
+        修改 nuc 数据中的字段, 稍后批量写入
+        :return: 是否有字段发生了变化
+        """
+        with self.lock(nuc_data["token"]):
+            changed = {k: v for k, v in fields.items() if nuc_data.get(k) != v}
+            nuc_data.update(changed)
+        if changed:
+            with self._pending_lock:
+                self._pending.setdefault(nuc_data["token"], {}).setdefault("fields", {}).update(changed)
+        return bool(changed)
+
+    def save_rows(self, nuc_data, start: int, reset: bool):
+        """
+        在一个事务中写入新追加的行, 调用时持有 nuc_data.ingest_lock
+        清空后的轮次号必须大于数据库中已有的轮次, 否则新行会与保留的旧行冲突
+        """
+        token = nuc_data["token"]
+        rows = nuc_data["data"]
+        row_time = rows.row_time
+        with self.transaction() as db:
+            if reset:
+                top = db.execute("SELECT MAX(epoch) FROM nuc_row WHERE token = ?", (token,)).fetchone()[0]
+                if top is not None and top >= nuc_data["epoch"]:
+                    nuc_data["epoch"] = top + 1
+                db.execute("DELETE FROM nuc_row WHERE token = ? AND token NOT IN (SELECT token FROM tracked)",
+                           (token,))
+            epoch = nuc_data["epoch"]
+            db.executemany("INSERT OR IGNORE INTO nuc_row VALUES (?, ?, ?, ?, ?)",
+                           ((token, epoch, seq, row_time[seq], _dump_row(row))
+                            for seq, row in enumerate(rows[start:], start)))
+            # SET 中的 epoch 是修改前的值
+            db.execute("UPDATE nuc SET rows = CASE WHEN epoch = ? THEN max(rows, ?) ELSE ? END, epoch = ?, "
+                       "timestamp = max(timestamp, ?), revision = revision + 1 WHERE token = ?",
+                       (epoch, len(rows), len(rows), epoch, nuc_data["timestamp"], token))
+
+    def track_store(self, nuc_data, capacity: int, retention: float | None) -> SqliteTrackView:
+        return SqliteTrackView(self, nuc_data, capacity, retention)
+
+    def set_tracking(self, nuc_data, tracking: bool):
+        token = nuc_data["token"]
+        with self.transaction() as db:
+            if tracking:
+                db.execute("INSERT OR IGNORE INTO tracked VALUES (?, ?, ?, ?)",
+                           (token, nuc_data["name"], nuc_data["user"], time.time()))
+                return
+            db.execute("DELETE FROM tracked WHERE token = ?", (token,))
+            # 之前轮次的行只为跟踪而保留
+            db.execute("DELETE FROM nuc_row WHERE token = ? AND epoch < "
+                       "  COALESCE((SELECT epoch FROM nuc WHERE token = ?), 1 << 62)", (token, token))
+
+    def tracked(self) -> dict:
+        """
+        :return: 所有被跟踪的 令牌 -> nuc 数据, 已断开的 nuc 只有名称与时间戳
+        """
+        with self.connect() as db:
+            records = db.execute("SELECT token, name, user, since FROM tracked").fetchall()
+        return {token: self.peek(token) or NucSession(token=token, name=name, user=user, timestamp=since)
+                for token, name, user, since in records}
+
+    def rekey(self, old, new):
+        with self.transaction() as db:
+            db.execute("UPDATE nuc_row SET token = ? WHERE token = ?", (new, old))
+            db.execute("UPDATE tracked SET token = ? WHERE token = ?", (new, old))
+
+    def watch(self, callback: typing.Callable[[str], None]):
+        """
+        后台线程每 WATCH_INTERVAL 秒检查数据库是否被修改(PRAGMA data_version),
+        有修改时对 revision 或跟踪状态变化了的令牌调用 callback(令牌), 本进程自己的修改也会被通知
+        """
+        threading.Thread(target=self._watch_loop, args=(callback,), name="sqlite-watch", daemon=True).start()
+
+    def _watch_loop(self, callback):
+        db = self._new_connection()
+        data_version = None
+        revisions, tracked = {}, set()
+        while not self._closed.wait(WATCH_INTERVAL):
+            current = db.execute("PRAGMA data_version").fetchone()[0]
+            if current == data_version:
+                continue
+            data_version = current
+            new_revisions = dict(db.execute("SELECT token, revision FROM nuc"))
+            new_tracked = {token for token, in db.execute("SELECT token FROM tracked")}
+            changed = {token for token in new_revisions.keys() | revisions.keys()
+                       if new_revisions.get(token) != revisions.get(token)}
+            revisions, changed_tracking, tracked = new_revisions, new_tracked ^ tracked, new_tracked
+            for token in changed | changed_tracking:
+                callback(token)
+        db.close()
+
+    def _flush_loop(self):
+        while not self._closed.wait(self.flush_interval):
+            try:
+                self.flush()
+            except sqlite3.Error as err:
+                print("写入缓冲的修改失败: %s" % err, file=sys.stderr)
+
+    def flush(self):
+        """
+        在一个事务中写入缓冲的心跳与字段修改
+        """
+        with self._flush_lock:
+            with self._pending_lock:
+                if not self._pending:
+                    return
+                self._flushing, self._pending = self._pending, {}
+            pending = self._flushing
+            try:
+                with self.transaction() as db:
+                    db.executemany("UPDATE nuc SET timestamp = max(timestamp, ?) WHERE token = ?",
+                                   [(i["timestamp"], token) for token, i in pending.items() if "timestamp" in i])
+                    db.executemany("UPDATE nuc SET fields = json_patch(fields, ?), revision = revision + 1 "
+                                   "WHERE token = ?",
+                                   [(json.dumps(i["fields"]), token) for token, i in pending.items() if "fields" in i])
+            except sqlite3.Error:
+                # 写入失败, 放回缓冲等下次再写, 期间较新的修改优先
+                with self._pending_lock:
+                    for token, old in pending.items():
+                        new = self._pending.setdefault(token, {})
+                        new["timestamp"] = max(old.get("timestamp", 0), new.get("timestamp", 0))
+                        if "fields" in old:
+                            new["fields"] = {**old["fields"], **new.get("fields", {})}
+                raise
+            finally:
+                with self._pending_lock:
+                    self._flushing = {}
+
+    def close(self):
+        self._closed.set()
+        self.flush()
+        with self._peek_lock:
+            if self._peek_db is not None:
+                self._peek_db.close()
+                self._peek_db = None
+        while True:
+            try:
+                self._pool.get_nowait().close()
+            except queue.Empty:
+                break
+
+
+def open_backend(name: str = "memory", path: str | None = None, flush_interval: float = 0.2) \
+        -> MemoryBackend | SqliteBackend:
+    """
+    :param name: "memory" 或 "sqlite"
+    :param path: sqlite 数据库文件路径
+    :param flush_interval: sqlite 批量写入心跳的间隔(s)
+    :raise ValueError: 不支持的后端
+    """
+    if name == "memory":
+        return MemoryBackend()
+    if name == "sqlite":
+        return SqliteBackend(path, flush_interval)
+    raise ValueError("不支持的后端 %s" % name)
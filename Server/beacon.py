@@ -0,0 +1,81 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+UDP 信标: 客户端广播查询, 服务器回复自己的 HTTP 端口与版本, 客户端不必扫描整个网段
+查询: QUERY 开头, 用空格补齐到至少 QUERY_SIZE 字节
+回复: BEACON 开头, 之后是 JSON {"port": HTTP 端口, "version": 服务器版本}
+回复比查询短, 无法被用来放大流量; 不是查询的数据报直接忽略
+"""
+import json
+import socket
+import threading
+
+QUERY = b"NUMQ/1"
+BEACON = b"NUMB/1 "
+QUERY_SIZE = 128
+DEFAULT_PORT = 5432  # 与客户端配置 upload.signal_port 的默认值一致
+
+
+def make_beacon(http_port: int, version: str) -> bytes:
+    return BEACON + json.dumps({"port": http_port, "version": version}, separators=(",", ":")).encode()
+
+
+def parse_beacon(packet: bytes) -> dict | None:
+    """
+    :return: 信标内容, 不是信标时为 None
+    """
+    if not packet.startswith(BEACON):
+        return None
+    try:
+        info = json.loads(packet[len(BEACON):])
+    except ValueError:
+        return None
+    if not isinstance(info, dict) or not isinstance(info.get("port"), int):
+        return None
+    return info
+
+
+def serve(sock: socket.socket, reply: bytes):
+    """
+    回复查询, 一直运行
+    :param sock: 已绑定信标端口的套接字
+    :param reply: 回复的信标, 见 make_beacon
+    """
+    while True:
+        try:
+            packet, address = sock.recvfrom(2048)
+        except OSError:
+            continue
+        if packet.startswith(QUERY) and len(packet) >= QUERY_SIZE:
+            try:
+                sock.sendto(reply, address)
+            except OSError:
+                pass
+
+
+def start(http_port: int, version: str, port: int | None = DEFAULT_PORT, host: str = "") -> threading.Thread | None:
+    """
+    在后台线程中回复查询
+    :param http_port: 服务器的 HTTP 端口
+    :param version: 服务器版本
+    :param port: 信标端口, None 表示不启用
+    :param host: 绑定的地址, 空字符串表示所有网卡(能收到广播)
+    :return: 线程, 未启用、回复过长或端口无法使用时为 None
+    """
+    if port is None:
+        return None
+    reply = make_beacon(http_port, version)
+    if len(reply) > QUERY_SIZE:
+        # 回复比查询长时信标可以被用来放大流量, 不启用
+        print("信标回复 %d 字节, 超过查询的 %d 字节(版本号过长?), 不启用信标" % (len(reply), QUERY_SIZE))
+        return None
+    sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    try:
+        sock.bind((host, port))
+    except OSError as err:
+        sock.close()
+        print("信标端口 %d 无法使用: %s" % (port, err))
+        return None
+    thread = threading.Thread(target=serve, args=(sock, reply), name="beacon", daemon=True)
+    thread.start()
+    return thread
@@ -0,0 +1,64 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+上传数据解析的对比: 原来的 eval、迁移期间的 repr (ast.literal_eval) 与 "json/1"
+对 1 万到 100 万个单元格的数据分别报告解析耗时与峰值内存(tracemalloc), eval 与 repr 只测到 SLOW_LIMIT
+运行: python benchmarks/bench_payload.py
+"""
+import os
+import sys
+import json
+import time
+import random
+import tracemalloc
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import payload  # noqa: E402
+
+CELLS = (10_000, 100_000, 1_000_000)
+COLUMNS = 10
+SLOW_LIMIT = 100_000  # eval 与 repr 解析 100 万个单元格需要数分钟与 1GB 以上的内存, 只测到这个规模
+
+
+def make_rows(cells: int) -> list[list[str]]:
+    rng = random.Random(cells)
+    return [["%.3f" % rng.uniform(-100, 100) for _ in range(COLUMNS)] for _ in range(cells // COLUMNS)]
+
+
+def measure(decode, text) -> tuple[float, float]:
+    """
+    :return: (解析耗时(ms), 峰值内存(MiB))
+    """
+    start = time.perf_counter()
+    decode(text)
+    elapsed = time.perf_counter() - start
+    tracemalloc.start()
+    decode(text)
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    return elapsed * 1000, peak / 2 ** 20
+
+
+def main():
+    decoders = {
+        "eval": lambda text: eval(text),  # 原来的做法, 仅用于对比
+        "repr": lambda text: payload.decode_rows(text, "repr"),
+        "json/1": lambda text: payload.decode_rows(text, payload.DATA_FORMAT),
+    }
+    print("orjson: %s" % ("是" if payload.orjson is not None else "否"))
+    print("%10s %8s %12s %12s %10s" % ("cells", "format", "size(KB)", "time(ms)", "peak(MiB)"))
+    for cells in CELLS:
+        rows = make_rows(cells)
+        texts = {"eval": repr(rows), "repr": repr(rows),
+                 "json/1": json.dumps(rows, separators=(",", ":"))}
+        for name, decode in decoders.items():
+            if name != "json/1" and cells > SLOW_LIMIT:
+                continue
+            assert decode(texts[name]) == rows
+            elapsed, peak = measure(decode, texts[name])
+            print("%10d %8s %12d %12.1f %10.1f" % (cells, name, len(texts[name]) // 1024, elapsed, peak))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,68 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+登记表的规模测试: 已连接的 nuc 从 10 增加到 100k 时, 登录、心跳、上传、刷新每个请求的耗时应当基本不变
+运行: python benchmarks/bench_registry.py [请求数]
+"""
+import os
+import sys
+import time
+import json
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import app  # noqa: E402
+import data  # noqa: E402
+import backends  # noqa: E402
+import nuc_ids  # noqa: E402
+
+SIZES = (10, 1000, 10000, 100000)
+
+
+def populate(count: int) -> list[str]:
+    """
+    换成一个新的登记表, 加入 count 个已连接的 nuc
+    :return: 这些 nuc 的令牌
+    """
+    data.nuc = backends.MemoryBackend()
+    data.CONFIG_DATA["connection"]["nuc_disconnect_time(s)"] = 3600
+    now = time.time()
+    tokens = []
+    for i in range(count):
+        token = nuc_ids.generate_id("bench-%d" % i, "bench")
+        data.nuc.add(backends.NucSession(token=token, name="bench-%d" % i, user="bench", timestamp=now))
+        tokens.append(token)
+    return tokens
+
+
+def per_request(client, requests: int, make) -> float:
+    """
+    :param make: make(i) 发出第 i 个请求
+    :return: 每个请求的平均耗时(us)
+    """
+    start = time.perf_counter()
+    for i in range(requests):
+        make(i)
+    return (time.perf_counter() - start) / requests * 1e6
+
+
+def main(requests: int = 2000):
+    client = app.app.test_client()
+    rows = json.dumps([["1", "2.5", "3"]])
+    print("%8s %12s %12s %12s %12s" % ("nuc", "login(us)", "heartbeat", "upload", "refresh"))
+    for size in SIZES:
+        tokens = populate(size)
+        targets = [tokens[i * 7919 % size] for i in range(requests)]
+        login = per_request(client, requests, lambda i: client.post("/app_login", data={
+            "nuc_id": nuc_ids.generate_id("new-%d-%d" % (size, i), "bench"),
+            "nuc_name": "new-%d" % i, "nuc_user": "bench"}))
+        heartbeat = per_request(client, requests, lambda i: client.post(
+            "/app_heartbeat", data={"nuc_id": targets[i]}))
+        upload = per_request(client, requests, lambda i: client.post("/app_upload_data", data={
+            "nuc_id": targets[i], "data": rows, "data_format": "json/1", "seq": "0", "reset": "1"}))
+        refresh = per_request(client, requests, lambda i: data.refresh_nuc())
+        print("%8d %12.0f %12.0f %12.0f %12.1f" % (size, login, heartbeat, upload, refresh))
+
+
+if __name__ == "__main__":
+    main(*map(int, sys.argv[1:]))
@@ -0,0 +1,501 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+nuc 上传数据的按列存储, 代替 CSV 行组成的列表
+每列第一次收到数据时推断类型: 整数列 int64, 小数列 float64(空单元格为 nan), 其余保存原始文本
+安装了 NumPy 时数值列是 numpy 数组, 整批解析; 否则使用 array.array 逐个解析
+读取的单元格与上传的文本完全一致: 每个数值列记住一种格式(如 "%.2f"), 按格式写不回原文的少数单元格(表头、"nan" 等)
+另外记录原文, 这样的单元格太多时该列改为文本列
+"""
+import math
+import array
+import typing
+import itertools
+
+try:
+    import numpy  # 可选, 整批解析, 统计可以直接使用数组
+except ImportError:
+    numpy = None
+
+INT = "int"
+FLOAT = "float"
+OBJECT = "object"
+EXACT_INT = 2 ** 53  # 绝对值小于此数的整数转为 float64 不损失精度
+TEXT_LIMIT = 64  # 数值列中记录原文的单元格数量上限, 超过后改为文本列
+FORMAT_SAMPLE = 64  # 推断小数列格式时检查的单元格数
+QUANTILES = (50, 95, 99)  # 统计的百分位数
+NO_NUMBERS = (0, 0.0, 0.0, math.nan, math.nan)  # 没有数值时的汇总, 见 _summary
+_table_ids = itertools.count(1)  # ColumnTable.id
+
+
+def parse_cell(cell: str) -> float | None:
+    """
+    :return: 单元格对应的数值, 空单元格为 nan, 无法转换时为 None
+    """
+    if cell == "":
+        return math.nan
+    try:
+        return float(cell)
+    except ValueError:
+        return None
+
+
+def _shortest_int(value: float) -> str:
+    """
+    整数不带小数点, 其余同 repr
+    """
+    if value.is_integer() and abs(value) < EXACT_INT:
+        return "%d" % value
+    return repr(value)
+
+
+def _format_all(fmt: str | typing.Callable[[float], str], values: list) -> list[str]:
+    """
+    按格式写出一批数值, 格式是 % 格式字符串时整批一次格式化
+    """
+    if isinstance(fmt, str):
+        return ((fmt + "\0") * len(values) % tuple(values)).split("\0")[:-1]
+    return [fmt(value) for value in values]
+
+
+def _float_formats(cells: typing.Sequence[str | None]) -> list[str | typing.Callable[[float], str]]:
+    """
+    小数列可能使用的格式: repr、整数不带小数点、样本中出现的固定小数位数
+    """
+    formats = ["%r", _shortest_int]
+    decimals = set()
+    for cell in cells[:FORMAT_SAMPLE]:
+        if cell and "." in cell and "e" not in cell.lower():
+            decimals.add(len(cell) - cell.index(".") - 1)
+    formats.extend("%%.%df" % i for i in sorted(decimals))
+    return formats
+
+
+def _parse(cells: typing.Sequence[str | None]) -> tuple[str, typing.Sequence, dict]:
+    """
+    整批解析一列中的单元格, None 表示这一行没有这一列
+    :return: (INT 或 FLOAT, 数值, {批内序号: 无法解析的原文}), 无法解析的位置为 nan
+    """
+    if numpy is not None:
+        try:
+            return INT, numpy.array(cells, dtype=numpy.int64), {}
+        except (ValueError, OverflowError, TypeError):
+            pass
+        try:
+            return FLOAT, numpy.array([cell or "nan" for cell in cells], dtype=numpy.float64), {}
+        except ValueError:
+            pass
+    else:
+        try:
+            return INT, array.array("q", map(int, cells)), {}
+        except (ValueError, OverflowError, TypeError):
+            pass
+    # 有无法解析的单元格, 逐个解析
+    values = array.array("d", bytes(8 * len(cells)))
+    text = {}
+    for i, cell in enumerate(cells):
+        if not cell:
+            values[i] = math.nan
+            continue
+        try:
+            values[i] = float(cell)
+        except ValueError:
+            values[i] = math.nan
+            text[i] = cell
+    return FLOAT, numpy.frombuffer(values, numpy.float64) if numpy is not None else values, text
+
+
+def _empty(kind: str):
+    if numpy is not None:
+        return numpy.empty(0, numpy.int64 if kind == INT else numpy.float64)
+    return array.array("q" if kind == INT else "d")
+
+
+def _numbers(values) -> typing.Sequence[float]:
+    """
+    :return: 其中的数值(float64), 去掉 nan
+    """
+    if numpy is not None:
+        values = numpy.asarray(values, numpy.float64)
+        return values[~numpy.isnan(values)]
+    return [float(value) for value in values if value == value]
+
+
+def _summary(numbers: typing.Sequence[float]) -> tuple[int, float, float, float, float]:
+    """
+    :param numbers: 不含 nan 的数值, 见 _numbers
+    :return: (个数, 平均值, 离差平方和, 最小值, 最大值)
+    """
+    if not len(numbers):
+        return NO_NUMBERS
+    if numpy is not None:
+        with numpy.errstate(invalid="ignore"):  # 含有 inf 时结果为 nan, 由 Column.stats 处理
+            mean = float(numbers.mean())
+            squares = float(numpy.square(numbers - mean).sum())
+        return len(numbers), mean, squares, float(numbers.min()), float(numbers.max())
+    try:
+        mean = math.fsum(numbers) / len(numbers)
+    except ValueError:
+        mean = math.nan  # 同时含有 inf 与 -inf
+    return len(numbers), mean, math.fsum((i - mean) ** 2 for i in numbers), min(numbers), max(numbers)
+
+
+def _merge(a: tuple, b: tuple) -> tuple[int, float, float, float, float]:
+    """
+    合并两个 _summary 的结果, 与对合并后的数据求 _summary 相同, 不需要重新扫描数据
+    """
+    if not b[0]:
+        return a
+    if not a[0]:
+        return b
+    count = a[0] + b[0]
+    delta = b[1] - a[1]
+    return (count, a[1] + delta * b[0] / count, a[2] + b[2] + delta * delta * a[0] * b[0] / count,
+            min(a[3], b[3]), max(a[4], b[4]))
+
+
+def _percentiles(numbers: list[float], quantiles: typing.Sequence[float]) -> list[float]:
+    """
+    线性插值的百分位数, 与 numpy.percentile 的默认方法相同
+    :param numbers: 已排序的数值
+    """
+    result = []
+    for q in quantiles:
+        position = (len(numbers) - 1) * q / 100
+        low = math.floor(position)
+        high = min(low + 1, len(numbers) - 1)
+        result.append(numbers[low] + (numbers[high] - numbers[low]) * (position - low))
+    return result
+
+
+class Column:
+    """
+    一列数据
+    数值列: values 的前 count 项有效, text 为 {行号: 原文}, 是读取时不按 fmt 格式化的单元格
+    文本列: values 是原文的列表
+    kind、values、text、fmt 一起放在 state 中整体替换, 读取时不会看到转换到一半的列
+    """
+
+    def __init__(self, absent: int = 0):
+        """
+        :param absent: 之前已有的行数, 这些行没有这一列
+        """
+        self.count = 0
+        self.shared = {}  # 文本列中出现过的文本
+        self.totals = (0, NO_NUMBERS)  # (行数, 前这么多行的 _summary), 追加时合并, 文本列不使用
+        self.state = (None, None, {}, None)  # (类型, 值, 原文, 格式), 收到第一批数据时确定类型
+        if absent:
+            self.extend([None] * absent)
+
+    @property
+    def kind(self) -> str | None:
+        return self.state[0]
+
+    def values(self) -> typing.Sequence:
+        """
+        :return: 数值列为各行的数值(numpy 数组或 array.array, 原文单元格为 nan), 文本列为原文列表
+        """
+        kind, values, _, _ = self.state
+        if kind is None:
+            return []
+        return values[:self.count]
+
+    def _append(self, values):
+        kind, old, text, fmt = self.state
+        if kind == OBJECT:
+            old.extend(values)
+        elif numpy is not None:
+            need = self.count + len(values)
+            if need > len(old):
+                # 容量加倍, 读取中的旧数组保持不变
+                grown = numpy.empty(max(need, 2 * len(old), 1024), old.dtype)
+                grown[:self.count] = old[:self.count]
+                old = grown
+                self.state = (kind, old, text, fmt)
+            old[self.count:need] = values
+        else:
+            old.extend(values)
+        self.count += len(values)
+
+    def _to_float(self) -> bool:
+        """
+        整数列转为小数列
+        :return: 是否成功, 有超出 float64 精度的整数时失败
+        """
+        kind, values, text, fmt = self.state
+        values = values[:self.count]
+        if numpy is not None:
+            if len(values) and numpy.abs(values).max() >= EXACT_INT:
+                return False
+            values = values.astype(numpy.float64)
+        else:
+            if any(abs(i) >= EXACT_INT for i in values):
+                return False
+            values = array.array("d", values)
+        # 整数的原文都是 "%d", 按 _shortest_int 格式化仍然一致
+        self.state = (FLOAT, values, text, _shortest_int)
+        return True
+
+    def _to_object(self):
+        """
+        转为文本列, O(行数) 但每列最多发生一次
+        """
+        shared = self.shared
+        self.state = (OBJECT, [shared.setdefault(cell, cell) for cell in self.cells(0, self.count)], {}, None)
+
+    def extend(self, cells: typing.Sequence[str | None]):
+        """
+        追加一批单元格, 必要时改变这一列的类型
+        :param cells: None 表示这一行没有这一列
+        """
+        kind = self.kind
+        if kind == OBJECT:
+            # 重复的文本(如状态)只保留一份
+            shared = self.shared
+            self._append([shared.setdefault(cell, cell) if cell else "" for cell in cells])
+            return
+        new_kind, values, text = _parse(cells)
+        if kind is None:
+            kind = new_kind
+            self.state = (kind, _empty(kind), {}, None)
+        elif kind == INT and new_kind == FLOAT:
+            if not self._to_float():
+                self._to_object()
+                self.extend(cells)
+                return
+            kind = FLOAT
+        if kind == FLOAT and new_kind == INT:
+            values = values.astype(numpy.float64) if numpy is not None else array.array("d", values)
+        _, _, old_text, fmt = self.state
+        # 还没有见过数值时(如只有表头)格式尚未确定, 从本批的单元格中推断
+        if fmt is not None:
+            formats = [fmt]
+        else:
+            formats = ["%d"] if kind == INT else _float_formats(cells)
+        listed = values.tolist()
+        numeric = kind == INT or any(value == value for value in listed)
+        best = None
+        for candidate in formats:
+            written = _format_all(candidate, listed)
+            # nan 读取时写为空单元格, 原文为 "nan" 的单元格需要逐个比较
+            if not text and "nan" not in written and written == list(cells):
+                best = (candidate, {})
+                break
+            mismatch = dict(text)  # 按格式写不回原文的单元格
+            for i, (cell, value, out) in enumerate(zip(cells, listed, written)):
+                if cell is None or i in text:
+                    continue
+                if cell != ("" if value != value else out):
+                    mismatch[i] = cell
+            if best is None or len(mismatch) < len(best[1]):
+                best = (candidate, mismatch)
+            if not mismatch:
+                break
+        candidate, text = best
+        if len(old_text) + len(text) > TEXT_LIMIT:
+            self._to_object()
+            self.extend(cells)
+            return
+        start = self.count
+        for i, cell in text.items():
+            old_text[start + i] = cell
+        self.state = (kind, self.state[1], old_text, candidate if numeric else fmt)
+        self._append(values)
+        self.totals = (self.count, _merge(self.totals[1], _summary(_numbers(values))))
+
+    def cells(self, start: int, stop: int) -> list[str]:
+        """
+        :return: 第 start 到 stop 行的原文, 没有这一列的行为空字符串
+        """
+        kind, values, text, fmt = self.state
+        if kind == OBJECT:
+            return values[start:stop]
+        if kind is None:
+            return [""] * (stop - start)
+        if fmt is None:
+            # 还没有数值, 都是空单元格或原文
+            result = [""] * (stop - start)
+        else:
+            result = _format_all(fmt, values[start:stop].tolist())
+        if "nan" in result:
+            # 空单元格
+            result = ["" if cell == "nan" else cell for cell in result]
+        for i, cell in text.items():
+            if start <= i < stop:
+                result[i - start] = cell
+        return result
+
+    def extremes(self, starts: list[int], stop: int) -> tuple[list, list]:
+        """
+        分段求最小值与最大值, 非数值单元格不参与
+        :param starts: 每段第一行的行号, 递增
+        :param stop: 最后一段的结束行号(不含)
+        :return: ([每段最小值], [每段最大值]), 没有数值的段与 inf 为 None
+        """
+        kind, values, _, _ = self.state
+        if kind is None:
+            return [None] * len(starts), [None] * len(starts)
+        values = values[starts[0]:stop]
+        if kind == OBJECT:
+            # 文本大多重复, 每种只解析一次
+            parsed = {cell: parse_cell(cell) for cell in set(values)}
+            values = [math.nan if parsed[cell] is None else parsed[cell] for cell in values]
+            if numpy is not None:
+                values = numpy.array(values, numpy.float64)
+        if numpy is not None:
+            offsets = numpy.array(starts) - starts[0]
+            # fmin/fmax 忽略 nan, 全为 nan 时结果为 nan
+            minimum = numpy.fmin.reduceat(values, offsets).tolist()
+            maximum = numpy.fmax.reduceat(values, offsets).tolist()
+        else:
+            minimum, maximum = [], []
+            for first, last in zip(starts, starts[1:] + [stop]):
+                chunk = [value for value in values[first - starts[0]:last - starts[0]] if value == value]
+                minimum.append(min(chunk) if chunk else math.nan)
+                maximum.append(max(chunk) if chunk else math.nan)
+        # nan 与 inf 不能写为 JSON
+        return ([float(value) if math.isfinite(value) else None for value in minimum],
+                [float(value) if math.isfinite(value) else None for value in maximum])
+
+    def stats(self, start: int, stop: int) -> dict | None:
+        """
+        第 start 到 stop 行的统计, 非数值单元格不参与
+        包含全部行时个数、最值、平均值、标准差直接取追加时合并的结果, 只有百分位数需要扫描
+        :return: {"count", "min", "max", "mean", "std"(总体标准差), "p50", "p95", "p99"}, 没有数值时只有 count 为 0
+                 含有 inf 时无法得到有限值的项为 None
+                 文本列为 None
+        """
+        kind, values, _, _ = self.state
+        if kind is None or kind == OBJECT:
+            return None
+        rows, totals = self.totals
+        numbers = _numbers(values[start:stop])
+        count, mean, squares, minimum, maximum = totals if start == 0 and stop == rows else _summary(numbers)
+        if not count:
+            return {"count": 0, "min": None, "max": None, "mean": None, "std": None,
+                    **{"p%d" % q: None for q in QUANTILES}}
+        if numpy is not None:
+            with numpy.errstate(invalid="ignore"):
+                quantiles = numpy.percentile(numbers, QUANTILES).tolist()
+        else:
+            quantiles = _percentiles(sorted(numbers), QUANTILES)
+        result = {"min": minimum, "max": maximum, "mean": mean, "std": math.sqrt(squares / count),
+                  **{"p%d" % q: value for q, value in zip(QUANTILES, quantiles)}}
+        # 含有 inf 时部分结果为 inf 或 nan, 不能写为 JSON
+        return {"count": count, **{k: v if math.isfinite(v) else None for k, v in result.items()}}
+
+    def nbytes(self) -> int:
+        """
+        :return: 大约占用的字节数(文本列只计算指针)
+        """
+        kind, values, text, _ = self.state
+        if kind == OBJECT:
+            return 8 * len(values)
+        if kind is None:
+            return 0
+        size = values.nbytes if numpy is not None else values.itemsize * len(values)
+        return size + 100 * len(text)
+
+
+class ColumnTable:
+    """
+    单个 nuc 上传的全部数据, 用法与 CSV 行的列表相同: len, 下标, 切片, 迭代, append, extend
+    另外 columns 中是各列的数据, 统计时直接使用 Column.values
+    写入由调用方加锁, 读取不需要加锁: count 在整批写完之后才增加
+    row_time 是每一行收到的时间, 与数据保存在同一个对象中, 读取方取得一个 ColumnTable 后两者总是一致的
+    id 在进程中唯一, 数据只追加, 同一个 id 中行号范围相同时数据相同, 可以作为缓存的键
+    """
+
+    def __init__(self):
+        self.id = next(_table_ids)
+        self.columns: list[Column] = []
+        self.lengths = array.array("I")  # 每行的列数, 行可以比 width 短
+        self.row_time = array.array("d")  # 每一行收到的时间(s), 只有 extend 时给出了时间才记录
+        self.width = 0  # 最长一行的列数
+        self.count = 0
+
+    def __len__(self):
+        return self.count
+
+    def extend(self, rows: typing.Sequence[typing.Sequence[str]], row_time: typing.Iterable[float] = ()):
+        """
+        整批追加 CSV 行
+        :param row_time: 每一行收到的时间(s), 与 rows 一一对应
+        """
+        if not rows:
+            return
+        lengths = [len(row) for row in rows]
+        width = max(lengths)
+        for _ in range(len(self.columns), width):
+            self.columns.append(Column(self.count))
+        if min(lengths) == width:
+            by_column = list(zip(*rows))
+        else:
+            by_column = [[row[i] if i < len(row) else None for row in rows] for i in range(width)]
+        for i, column in enumerate(self.columns):
+            column.extend(by_column[i] if i < width else [None] * len(rows))
+        self.lengths.extend(lengths)
+        self.row_time.extend(row_time)
+        self.width = max(self.width, width)
+        self.count += len(rows)
+
+    def append(self, row: typing.Sequence[str]):
+        self.extend([row])
+
+    def rows(self, start: int = 0, stop: int | None = None) -> list[list[str]]:
+        """
+        :return: 第 start 到 stop 行
+        """
+        count = self.count
+        stop = count if stop is None else min(stop, count)
+        if start >= stop:
+            return []
+        if not self.width:
+            # 到目前为止都是空行, 没有列可以按行组合
+            return [[] for _ in range(stop - start)]
+        columns = [column.cells(start, stop) for column in self.columns[:self.width]]
+        lengths = self.lengths[start:stop]
+        if min(lengths) == self.width:
+            return [list(row) for row in zip(*columns)]
+        return [[column[k] for column in columns[:length]] for k, length in enumerate(lengths)]
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            start, stop, step = index.indices(self.count)
+            if step == 1:
+                return self.rows(start, stop)
+            return [self[i] for i in range(start, stop, step)]
+        if index < 0:
+            index += self.count
+        if not 0 <= index < self.count:
+            raise IndexError("行号超出范围")
+        return self.rows(index, index + 1)[0]
+
+    def __iter__(self) -> typing.Iterator[list[str]]:
+        count = self.count
+        for start in range(0, count, 4096):
+            yield from self.rows(start, min(start + 4096, count))
+
+    def extremes(self, starts: list[int], stop: int) -> tuple[list[list], list[list]]:
+        """
+        分段求各列的最小值与最大值, 见 Column.extremes
+        :return: ([[每列最小值], ...], [[每列最大值], ...]), 每段的列数是段中最长一行的列数
+        """
+        bounds = starts[1:] + [stop]
+        widths = [max(self.lengths[first:last]) for first, last in zip(starts, bounds)]
+        result = [column.extremes(starts, stop) for column in self.columns]
+        minimum = [[result[i][0][b] for i in range(width)] for b, width in enumerate(widths)]
+        maximum = [[result[i][1][b] for i in range(width)] for b, width in enumerate(widths)]
+        return minimum, maximum
+
+    def stats(self, start: int, stop: int) -> list[dict | None]:
+        """
+        :return: 第 start 到 stop 行中各列的统计, 见 Column.stats
+        """
+        return [column.stats(start, stop) for column in self.columns[:self.width]]
+
+    def nbytes(self) -> int:
+        """
+        :return: 大约占用的字节数
+        """
+        return self.lengths.itemsize * len(self.lengths) + sum(column.nbytes() for column in self.columns)
@@ -3,14 +3,23 @@
 """
 数据管理
 """
+import io
 import os
 import re
+import csv
 import time
+import bisect
 import typing
+import threading
 import collections
 
 import yaml
 
+import backends
+import columns
+import track_store
+import track_segments
+
 CONFIG_PATH = os.path.dirname(__file__).replace("\\", "/") + "/" + "config.yaml"
 
 CONFIG_DATA = {
@@ -24,38 +33,131 @@ CONFIG_DATA = {
         "config_path": "~/.pyNumOnline/config.yaml",
     },
     "paths_server": {  # 服务器端配置
-        # "track_to": "~/.pyNumOnline/{nuc_name}/track.csv",  # 服务器端保存数据位置
+        # 服务器端保存跟踪数据的文件夹, 如 "~/.pyNumOnline/track/{nuc_name}@{nuc_user}", None 表示只缓存在内存中
+        # 使用 sqlite 后端时跟踪数据已经保存在数据库中, 不再使用此项
+        "track_to": None,
+    },
+    "backend": {  # 保存已连接nuc的后端, 见 backends.py
+        "name": "memory",  # "memory": 只能单进程运行; "sqlite": 多个服务器进程共享同一个数据库文件
+        "sqlite_path": "~/.pyNumOnline/server.db",
+        "flush_interval(s)": 0.2,  # sqlite 批量写入心跳的间隔
     },
     "connection": {  # 连接设置
         "nuc_app_cookie": {
             "User-Agent": "NumOnlineAPP/{VERSION}",
         },
         "nuc_disconnect_time(s)": 4,  # 若超过此时间nuc未更新数据，则断开连接
-    }
+        "max_upload_size(MB)": 64,  # 压缩的请求体解压后的大小上限
+    },
+    "beacon": {  # UDP 信标, 客户端据此找到服务器, 见 beacon.py
+        "port": 5432,  # 与客户端的 upload.signal_port 一致, None 表示不启用
+    },
+    "track": {  # 跟踪数据设置
+        "capacity": 86400,  # 每个nuc最多缓存的行数
+        "retention(s)": None,  # 最长缓存时间, None 表示只受行数限制
+    },
 }
 
+
 # 已连接的 nuc
 # 元素格式:
 # {
 #     "name": "test",
 #     "token": "123",
-#     "last": 3.1,
+#     "last": 3.1,  # 读取时计算, 见 backends.NucSession
 #     "user": "abc",
 #     "timestamp": time.time(),
 #     "upload_file": "~/.pyNumOnline/upload.txt",
-#     "data": [],  # CSV list
+#     "data": columns.ColumnTable(),  # 收到的 CSV 行, 按列保存, 用法与列表相同, 每一行收到的时间在 row_time 中
+#     "version": 12,  # 最近一次变化时的版本号, 见 mark_changed
 # }
-nuc = [
-]
+# 默认在进程内保存, 加载配置后由 open_backend 按配置替换
+nuc = backends.MemoryBackend()
 
-# 跟踪并缓存的数据
+# 跟踪并缓存的数据, 令牌 -> 跟踪信息
 # 元素格式:
 # {
 #    "nuc": {...},  # 此数据nuc信息, 就是nuc列表的元素
-#    "data": {time_1: {...}, time_2: {...}},  # 数据情况，单位是ns
-#    "last_update": {...}  # 上次更新的时间
+#    "data": track_store.TrackStore(...),  # 按列缓存的数据, 时间戳单位是ns, sqlite 后端为 backends.SqliteTrackView
+#    "disk": track_segments.SegmentLog(...),  # 配置了 paths_server.track_to 时保存到磁盘的全部数据, 否则为 None
+#    "last_update": time.time()  # 上次更新的时间
 # }
-track_and_cache_data = []
+track_and_cache_data = {}
+_tracked_names = {}  # (主机名称, 用户名称) -> 令牌, 与 track_and_cache_data 一起修改, 登录时据此找到断开的跟踪
+_track_lock = threading.RLock()  # 修改 track_and_cache_data 时持有
+
+
+def _set_tracked(token, track_data):
+    """
+    加入或替换 track_and_cache_data 中的一项, 调用时持有 _track_lock
+    """
+    track_and_cache_data[token] = track_data
+    _tracked_names[(track_data["nuc"]["name"], track_data["nuc"]["user"])] = token
+
+
+def _pop_tracked(token) -> dict | None:
+    """
+    从 track_and_cache_data 中删除一项, 调用时持有 _track_lock
+    """
+    track_data = track_and_cache_data.pop(token, None)
+    if track_data is not None:
+        key = (track_data["nuc"]["name"], track_data["nuc"]["user"])
+        if _tracked_names.get(key) == token:
+            del _tracked_names[key]
+    return track_data
+
+
+# 读写 CONFIG_DATA 时持有
+config_lock = threading.RLock()
+
+# 变更记录: 登录、断开、新数据、跟踪状态变化时版本号加一, 心跳只更新时间戳不计入
+# 元素格式: (版本号, 令牌)
+version = 0
+changes = collections.deque(maxlen=4096)
+_changed = threading.Condition()
+
+
+def mark_changed(token):
+    """
+    记录令牌对应的nuc发生了变化, 并唤醒等待变化的推送
+    """
+    global version
+    # peek 在共享的后端中会查询数据库, 不能在所有推送与上传共用的锁中进行
+    nuc_data = nuc.peek(token)
+    with _changed:
+        version += 1
+        changes.append((version, token))
+        if nuc_data is not None:
+            nuc_data["version"] = version
+        _changed.notify_all()
+
+
+def changes_since(old_version: int) -> tuple[int, set | None]:
+    """
+    :param old_version: 上次读取时的版本号
+    :return: (当前版本号, 之后发生变化的令牌), 变更记录已被丢弃时令牌为 None, 需要读取全部数据
+    """
+    with _changed:
+        if old_version >= version:
+            return version, set()
+        if not changes or changes[0][0] > old_version + 1:
+            return version, None
+        # 变更记录按版本号递增, 从新到旧找到 old_version 为止
+        tokens = set()
+        for v, token in reversed(changes):
+            if v <= old_version:
+                break
+            tokens.add(token)
+        return version, tokens
+
+
+def wait_for_change(old_version: int, timeout: float) -> bool:
+    """
+    等待版本号超过 old_version
+    :return: 是否有变化, False 表示超时
+    """
+    with _changed:
+        return _changed.wait_for(lambda: version > old_version, timeout)
 
 
 def get_real_path(path: str):
@@ -80,7 +182,8 @@ def load_config(config_path=None, encoding="utf-8"):
     with open(config_path, "r", encoding=encoding) as fp:
         new = yaml.safe_load(fp)
     if isinstance(new, dict):
-        CONFIG_DATA.update(new)
+        with config_lock:
+            CONFIG_DATA.update(new)
     return new
 
 
@@ -92,16 +195,56 @@ def save_config(config_path=None):
     """
     if config_path is None:
         config_path = CONFIG_PATH
-    with open(config_path, "w") as fp:
+    with config_lock, open(config_path, "w") as fp:
         yaml.safe_dump(CONFIG_DATA, fp)
 
 
+def open_backend():
+    """
+    按 CONFIG_DATA["backend"] 打开后端, 替换 nuc, 应在加载配置之后调用
+    多个服务器进程配置同一个 sqlite 文件时共享全部 nuc, 可以一起运行在负载均衡之后
+    """
+    global nuc
+    config = CONFIG_DATA["backend"]
+    path = config.get("sqlite_path")
+    if config["name"] == "sqlite":
+        path = get_real_path(path)
+        os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+    new = backends.open_backend(config["name"], path, config.get("flush_interval(s)", 0.2))
+    old, nuc = nuc, new
+    old.close()
+    nuc.watch(_backend_changed)
+    sync_tracking()
+
+
+def _backend_changed(token):
+    """
+    其他进程修改了令牌对应的nuc
+    """
+    sync_tracking()
+    mark_changed(token)
+
+
+def sync_tracking():
+    """
+    共享的后端中跟踪状态被其他进程修改后, 同步本进程的 track_and_cache_data
+    """
+    with _track_lock:
+        tracked = nuc.tracked()
+        if tracked is None:
+            return
+        for token in track_and_cache_data.keys() - tracked.keys():
+            _pop_tracked(token)
+        for token in tracked.keys() - track_and_cache_data.keys():
+            _set_tracked(token, _new_track_data(tracked[token]))
+
+
 def nuc_id_list() -> list[str, ...]:
     """
     获取所有登录端的令牌
     :return: 所有令牌
     """
-    return [i["token"] for i in nuc]
+    return nuc.tokens()
 
 
 def nuc_check_token(token) -> int:
@@ -113,7 +256,7 @@ def nuc_check_token(token) -> int:
     if len(token) != 32:
         # 令牌长度不合理
         return 2
-    if token in nuc_id_list():
+    if token in nuc:
         # 令牌已存在
         return 1
     # 令牌合理
@@ -122,27 +265,19 @@ def nuc_check_token(token) -> int:
 
 def refresh_nuc():
     """
-    更新nuc的时间数据。如果超过时间则删除连接。
+    删除超过时间未更新的连接。"last" 在读取时计算, 这里不再逐个改写
     """
-    timestamp = time.time()
-    index_for_remove = []
-    for i, n in enumerate(nuc):
-        last = timestamp - n["timestamp"]
-        n["last"] = round(last, 1)
-        if last > CONFIG_DATA["connection"]["nuc_disconnect_time(s)"]:
-            # 先将要删除的下标存入, 避免边迭代边修改
-            index_for_remove.append(i - len(index_for_remove))  # 减去 len(index_for_remove) 是为了适配已经删去部分值的nuc列表
-    while index_for_remove:
-        nuc.pop(index_for_remove.pop(0))
+    for nuc_data in nuc.expire(CONFIG_DATA["connection"]["nuc_disconnect_time(s)"]):
+        mark_changed(nuc_data["token"])
 
 
 def get_nuc_info_from_track_and_cache_data():
     """
     :return: 被跟踪且缓存的列表中的nuc数据
     """
-    for data in track_and_cache_data:
+    for data in list(track_and_cache_data.values()):
         nuc_data = data["nuc"]
-        if nuc_data in nuc:
+        if nuc.get(nuc_data["token"]) is nuc_data:
             yield nuc_data
 
 
@@ -161,26 +296,243 @@ def nuc_login(nuc_id, nuc_name, nuc_user) -> int:
     if not re.match(CONFIG_DATA["re_patterns"]["nuc_user_name"], nuc_user):
         return 12
     # 最后检查一个令牌是否可用
-    code = nuc_check_token(nuc_id)
-    if code != 0:
-        return code
-    for nuc_data in get_nuc_info_from_track_and_cache_data():
-        if nuc_data["name"] == nuc_name and nuc_data["user"] == nuc_user:
-            # 发现正在登陆的nuc在缓存中
-            nuc_data["timestamp"] = time.time()  # 更新时间戳
-            nuc.append(nuc_data)
-            break
-    else:
-        # 建立并添加新的登录信息
-        nuc.append({"token": nuc_id, "user": nuc_user, "name": nuc_name, "last": 0, "timestamp": time.time()})
+    # 持有令牌所在分片的锁, 检查与添加之间不会有同一令牌的登录插入
+    with nuc.lock(nuc_id):
+        code = nuc_check_token(nuc_id)
+        if code != 0:
+            return code
+        with _track_lock:
+            token = _tracked_names.get((nuc_name, nuc_user))
+            if token is not None and token not in nuc:
+                # 发现正在登陆的nuc在缓存中
+                track_data = _pop_tracked(token)
+                nuc_data = track_data["nuc"]
+                nuc.rekey(token, nuc_id)
+                nuc_data["token"] = nuc_id  # 客户端之后会使用新的令牌
+                nuc_data["timestamp"] = time.time()  # 更新时间戳
+                _set_tracked(nuc_id, track_data)
+                nuc.add(nuc_data)
+            else:
+                # 建立并添加新的登录信息
+                nuc.add(backends.NucSession(token=nuc_id, user=nuc_user, name=nuc_name, timestamp=time.time()))
+    mark_changed(nuc_id)
     return 0
 
 
-def track_to_string(track_data: dict[int: typing.Iterable[list]]) -> str:
+def nuc_append_data(nuc_data, rows: list[list[str, ...], ...], seq: int, reset=False) -> int:
+    """
+    追加客户端增量上传的数据行
+    :param nuc_data: nuc 数据
+    :param rows: 新的 CSV 行
+    :param seq: 本批第一行的序号, 即客户端认为服务器已有的行数
+    :param reset: 客户端文件被截断或替换, 先清空再从头同步
+    :return: 0->一切正常, 1->序号不连续, 需要客户端重新同步
+    """
+    # 同一个nuc的上传按顺序执行, 不同nuc互不影响
+    # 只持有这个 nuc 自己的锁, 不持有登记表分片的锁, 大批上传期间登录、心跳与 refresh_nuc 不必等待
+    with nuc_data.ingest_lock:
+        return _nuc_append_data(nuc_data, rows, seq, reset)
+
+
+def _nuc_append_data(nuc_data, rows, seq, reset) -> int:
+    reset = reset or "data" not in nuc_data
+    previous = nuc_data.get("data")
+    if reset:
+        nuc_data["data"] = columns.ColumnTable()
+        nuc_data["epoch"] = nuc_data.get("epoch", 0) + 1  # 每次清空加一, 推送据此判断是否需要重新加载
+        mark_changed(nuc_data["token"])
+    old = nuc_data["data"]
+    if seq > len(old):
+        # 中间缺了数据
+        return 1
+    # seq 小于已有行数说明上一次的回复丢失, 客户端重发了, 跳过已收到的行
+    rows = rows[len(old) - seq:]
+    start = len(old)
+    old.extend(rows, [time.time()] * len(rows))
+    if rows or reset:
+        nuc.save_rows(nuc_data, start, reset)
+    if rows:
+        mark_changed(nuc_data["token"])
+    track_data = track_and_cache_data.get(nuc_data["token"])
+    if track_data is not None and rows:
+        if reset and previous:
+            # 旧版客户端每次上传整个文件(总是清空), 开头与清空前相同的行已经被跟踪过, 只跟踪之后的行
+            # 文件真的被截断或替换时开头不同, 全部跟踪
+            n = len(previous)
+            if len(rows) >= n and previous.rows(0, n) == rows[:n]:
+                rows = rows[n:]
+        if rows:
+            time_ns = time.time_ns()
+            track_data["data"].extend(time_ns, rows)
+            if track_data["disk"] is not None:
+                track_data["disk"].extend(time_ns, rows)
+            track_data["last_update"] = time.time()
+    return 0
+
+
+def _time_range(rows: columns.ColumnTable, start: float | None, stop: float | None) -> tuple[int, int]:
+    """
+    :return: 收到的时间在 [start, stop) 内的行号范围 (开始, 结束)
+             只使用调用时已有的行, 同时上传或清空不会使结果中的行与时间不一致
+    """
+    count = len(rows)
+    # 收到的时间是递增的, 二分查找时间范围
+    lo = 0 if start is None else bisect.bisect_left(rows.row_time, start, 0, count)
+    hi = count if stop is None else bisect.bisect_left(rows.row_time, stop, 0, count)
+    return lo, max(lo, hi)
+
+
+def nuc_query(nuc_data, start: float | None = None, stop: float | None = None, points: int = 500) -> dict:
+    """
+    查询一段时间内收到的数据, 降采样为至多 points 个桶, 每个桶给出各列的最小值与最大值
+    返回的大小只取决于 points 与列数, 与数据总量无关
+    :param nuc_data: nuc 数据
+    :param start: 开始时间(s), None 表示最早
+    :param stop: 结束时间(s, 不含), None 表示最新
+    :param points: 桶的数量上限
+    :return: {"rows": 时间范围内的行数, "time": [每个桶第一行的时间], "min": [[每列最小值], ...], "max": [...]}
+             非数值单元格不参与计算, 没有数值的位置为 None
+    """
+    rows = nuc_data.get("data")
+    if rows is None:
+        return {"rows": 0, "time": [], "min": [], "max": []}
+    lo, hi = _time_range(rows, start, stop)
+    count = hi - lo
+    buckets = min(count, max(points, 1))
+    result = {"rows": count, "time": [], "min": [], "max": []}
+    if not buckets:
+        return result
+    starts = [lo + b * count // buckets for b in range(buckets)]
+    result["time"] = [rows.row_time[i] for i in starts]
+    # 直接使用各列的数组, 不再逐个解析单元格
+    result["min"], result["max"] = rows.extremes(starts, hi)
+    return result
+
+
+# nuc_stats 的结果, 键为 (ColumnTable.id, 开始行号, 结束行号)
+# 每次清空或重新登录都会换成新的 ColumnTable, 键不会与之前的数据重复; 没有新数据时重复查询直接返回
+_stats_cache = {}
+STATS_CACHE_SIZE = 256
+
+
+def nuc_stats(nuc_data, start: float | None = None, stop: float | None = None) -> dict:
+    """
+    一段时间内收到的数据中各列的统计
+    :param nuc_data: nuc 数据
+    :param start: 开始时间(s), None 表示最早
+    :param stop: 结束时间(s, 不含), None 表示最新
+    :return: {"rows": 时间范围内的行数, "columns": [每列的统计, 见 columns.Column.stats]}
+    """
+    rows = nuc_data.get("data")
+    if rows is None:
+        return {"rows": 0, "columns": []}
+    lo, hi = _time_range(rows, start, stop)
+    key = (rows.id, lo, hi)
+    result = _stats_cache.get(key)
+    if result is None:
+        if len(_stats_cache) >= STATS_CACHE_SIZE:
+            _stats_cache.clear()
+        result = _stats_cache[key] = {"rows": hi - lo, "columns": rows.stats(lo, hi)}
+    return result
+
+
+def nuc_summary(nuc_data) -> dict:
+    """
+    :return: 管理页面显示一个nuc需要的信息, 可以转为JSON
+    """
+    return {"token": nuc_data["token"],
+            "name": nuc_data["name"],
+            "user": nuc_data["user"],
+            "upload_file": nuc_data.get("upload_file"),
+            "rows": len(nuc_data.get("data", ())),
+            "tracking": nuc_data["token"] in track_and_cache_data}
+
+
+def is_tracking(token) -> bool:
+    """
+    :return: 令牌对应的nuc是否正被跟踪
+    """
+    return token in track_and_cache_data
+
+
+def track_nuc(token) -> bool:
+    """
+    开始跟踪一个已连接的nuc, 之后上传的数据会缓存到 TrackStore
+    :param token: 令牌
+    :return: 是否成功, 未连接的nuc无法跟踪
+    """
+    nuc_data = nuc.get(token)
+    if nuc_data is None:
+        return False
+    with _track_lock:
+        if token in track_and_cache_data:
+            return True
+        nuc.set_tracking(nuc_data, True)
+        _set_tracked(token, _new_track_data(nuc_data))
+    mark_changed(token)
+    return True
+
+
+def _new_track_data(nuc_data) -> dict:
+    """
+    :return: track_and_cache_data 的元素
+    """
+    track_to = CONFIG_DATA["paths_server"].get("track_to")
+    if track_to and not nuc.shared:
+        # 多个进程不能同时写入同一个段文件, 共享的后端自己保存数据
+        # 名称由 nuc 上传, 不能含有 "/" 或 ".." 等改变保存位置的部分
+        disk = track_segments.SegmentLog(get_real_path(track_to.format(
+            nuc_name=track_segments.path_part(nuc_data["name"]), nuc_user=track_segments.path_part(nuc_data["user"]))))
+    else:
+        disk = None
+    return {
+        "nuc": nuc_data,
+        "data": nuc.track_store(nuc_data, CONFIG_DATA["track"]["capacity"], CONFIG_DATA["track"]["retention(s)"]),
+        "disk": disk,
+        "last_update": time.time(),
+    }
+
+
+def untrack_nuc(token):
+    """
+    停止跟踪并丢弃缓存的数据, 已保存到磁盘的段文件保留
+    :param token: 令牌
+    :return: 被丢弃的跟踪信息, 没有跟踪时为 None
+    """
+    with _track_lock:
+        track_data = _pop_tracked(token)
+    if track_data is not None:
+        nuc.set_tracking(track_data["nuc"], False)
+        if track_data["disk"] is not None:
+            with track_data["nuc"].ingest_lock:  # 等待正在进行的写入
+                track_data["disk"].close()
+        mark_changed(token)
+    return track_data
+
+
+def iter_track_csv(track_data: track_store.TrackStore | track_segments.SegmentLog,
+                   chunk_size=64 * 1024, start_ns: int | None = None) -> typing.Iterator[str]:
+    """
+    逐行将追踪的数据写为CSV, 第一列是时间戳(ns)
+    每攒够 chunk_size 个字符返回一次, 内存占用与数据量无关
+    :param start_ns: 只导出这个时间戳(ns)之后的数据, None 表示全部
+    """
+    buffer = io.StringIO()
+    writer = csv.writer(buffer)
+    for time_ns, row in track_data.rows(start_ns):
+        writer.writerow([time_ns, *row])
+        if buffer.tell() >= chunk_size:
+            yield buffer.getvalue()
+            buffer.seek(0)
+            buffer.truncate()
+    yield buffer.getvalue()
+
+
+def iter_track_yaml(track_data: track_store.TrackStore | track_segments.SegmentLog,
+                    start_ns: int | None = None) -> typing.Iterator[str]:
     """
-    将追踪并缓存的数据转换为yaml文本
+    逐行将追踪的数据写为yaml, 每行一个文档: {时间戳(ns): CSV 行}
+    :param start_ns: 见 iter_track_csv
     """
-    data = collections.OrderedDict()  # XXX: 好像现在普通的字典也有序了？
-    for key in sorted(track_data):
-        data[key] = track_data[key]
-    return yaml.safe_dump_all(data)
+    for time_ns, row in track_data.rows(start_ns):
+        yield yaml.safe_dump({time_ns: row}, explicit_start=True, allow_unicode=True)
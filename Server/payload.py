@@ -0,0 +1,205 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+客户端上传数据 ("data" 字段) 的编码格式
+"json/1": 紧凑的 JSON 二维数组, 如 [["1","2"],["3"]]
+"repr":   旧版客户端的 python repr 文本, 迁移期间仍然接受, 用 ast.literal_eval 安全解析
+另外客户端可以用 Content-Encoding 压缩整个请求体, 见 decode_request
+压缩格式由客户端从登录回复的 "content_encodings" 中选择: gzip 与 deflate 总是支持, 安装了 zstandard 时还支持更快的 zstd
+"""
+import io
+import ast
+import json
+import zlib
+import typing
+
+try:
+    import orjson  # 可选, 解析速度更快
+except ImportError:
+    orjson = None
+try:
+    import zstandard  # 可选, 压缩与解压都比 gzip 快
+except ImportError:
+    zstandard = None
+
+# 当前版本的数据格式
+DATA_FORMAT = "json/1"
+
+_json_loads = json.loads if orjson is None else orjson.loads
+
+# 接受的请求体压缩格式, 按推荐的顺序排列, 登录时告知客户端
+CONTENT_ENCODINGS = ("zstd", "gzip", "deflate") if zstandard is not None else ("gzip", "deflate")
+MAX_DECODED_SIZE = 64 * 1024 * 1024  # 解压后请求体的默认大小上限, 防止压缩炸弹
+READ_SIZE = 64 * 1024  # 每次读取与解压的字节数
+
+
+def check_rows(rows) -> list[list[str, ...], ...]:
+    """
+    检查解析结果是否是字符串组成的二维列表
+    :raise ValueError: 结构不正确
+    :return: rows
+    """
+    if type(rows) is not list:
+        raise ValueError("数据应为列表")
+    for row in rows:
+        if type(row) is not list:
+            raise ValueError("数据行应为列表")
+        for cell in row:
+            if type(cell) is not str:
+                raise ValueError("单元格应为字符串")
+    return rows
+
+
+def decode_rows(text: str | bytes, data_format: str | None = None) -> list[list[str, ...], ...]:
+    """
+    解析上传的数据
+    :param text: "data" 字段的内容
+    :param data_format: 数据格式, None 表示没有声明格式的旧版客户端
+    :raise ValueError: 格式不支持或内容不正确
+    :return: CSV 行
+    """
+    if data_format == "json/1":
+        try:
+            rows = _json_loads(text)
+        except ValueError as err:  # json.JSONDecodeError 与 orjson.JSONDecodeError 都是 ValueError
+            raise ValueError("JSON 解析失败: %s" % err) from None
+        except RecursionError:
+            # 标准库 json 解析嵌套过深的数组时超过递归深度
+            raise ValueError("JSON 解析失败: 嵌套过深") from None
+    elif data_format is None or data_format == "repr":
+        try:
+            rows = ast.literal_eval(text)
+        except (SyntaxError, TypeError, MemoryError, RecursionError) as err:
+            raise ValueError("repr 解析失败: %s" % type(err).__name__) from None
+    else:
+        raise ValueError("不支持的数据格式 %s" % data_format)
+    return check_rows(rows)
+
+
+class _BodyReader:
+    """
+    只读取请求体的 length 字节, 不会读到连接中的下一个请求
+    """
+
+    def __init__(self, stream, length: int):
+        self.stream = stream
+        self.remaining = length
+        self.head = b""  # 第一次读取到的数据, 用于检查帧头
+
+    def read(self, size: int = -1) -> bytes:
+        """
+        :raise ValueError: 连接中断, 请求体不完整
+        """
+        if size < 0 or size > self.remaining:
+            size = self.remaining
+        data = self.stream.read(size) if size else b""
+        if size and not data:
+            raise ValueError("请求体不完整")
+        self.remaining -= len(data)
+        if not self.head:
+            self.head = data
+        return data
+
+
+def _inflate(body: _BodyReader, wbits: int) -> typing.Iterator[bytes]:
+    """
+    逐块解压 gzip / deflate, 每块至多 READ_SIZE 字节
+    """
+    decompressor = zlib.decompressobj(wbits)
+    while not decompressor.eof:
+        data = decompressor.unconsumed_tail or body.read(READ_SIZE)
+        if not data:
+            raise ValueError("压缩数据不完整")
+        try:
+            yield decompressor.decompress(data, READ_SIZE)
+        except zlib.error as err:
+            raise ValueError("解压失败: %s" % err) from None
+
+
+def _unzstd(body: _BodyReader) -> typing.Iterator[bytes]:
+    """
+    逐块解压 zstd, 每块至多 READ_SIZE 字节
+    """
+    reader = zstandard.ZstdDecompressor().stream_reader(body, read_size=READ_SIZE)
+    total = 0
+    try:
+        while chunk := reader.read(READ_SIZE):
+            total += len(chunk)
+            yield chunk
+        # 数据在帧中途结束时不会报错, 帧头记录了原始大小时据此检查
+        size = zstandard.get_frame_parameters(body.head).content_size
+    except zstandard.ZstdError as err:
+        raise ValueError("解压失败: %s" % err) from None
+    if size != zstandard.CONTENTSIZE_UNKNOWN and size != total:
+        raise ValueError("压缩数据不完整")
+
+
+def iter_decompress(stream, length: int, encoding: str) -> typing.Iterator[bytes]:
+    """
+    从流中边读取边解压, 内存占用与压缩率无关
+    :param stream: 压缩的请求体
+    :param length: 请求体的字节数
+    :param encoding: Content-Encoding
+    :raise LookupError: 不支持的压缩格式
+    :raise ValueError: 数据损坏(迭代时)
+    :return: 解压后的数据块
+    """
+    if encoding not in CONTENT_ENCODINGS:
+        raise LookupError("不支持的压缩格式 %s" % encoding)
+    body = _BodyReader(stream, length)
+    if encoding == "zstd":
+        return _unzstd(body)
+    return _inflate(body, 16 + zlib.MAX_WBITS if encoding == "gzip" else zlib.MAX_WBITS)
+
+
+def decompress_stream(stream, length: int, encoding: str, limit: int = MAX_DECODED_SIZE) -> bytes:
+    """
+    解压请求体, 解压出的数据超过 limit 时立即停止
+    :param stream: 压缩的请求体
+    :param length: 请求体的字节数
+    :param encoding: Content-Encoding
+    :param limit: 解压后的大小上限
+    :raise LookupError: 不支持的压缩格式
+    :raise ValueError: 数据损坏或解压后超过 limit
+    :return: 解压后的请求体
+    """
+    result = bytearray()
+    for chunk in iter_decompress(stream, length, encoding):
+        result += chunk
+        if len(result) > limit:
+            raise ValueError("解压后超过 %d 字节" % limit)
+    return bytes(result)
+
+
+def decompress(body: bytes, encoding: str, limit: int = MAX_DECODED_SIZE) -> bytes:
+    """
+    解压内存中的请求体, 参数与异常见 decompress_stream
+    """
+    return decompress_stream(io.BytesIO(body), len(body), encoding, limit)
+
+
+def decode_request(wsgi_app, limit: int = MAX_DECODED_SIZE):
+    """
+    WSGI 中间件: 解压带有 Content-Encoding 的请求体, 之后的表单解析看到的就是普通请求
+    不支持的压缩格式返回 415, 数据损坏或过大返回 400
+    :param limit: 解压后请求体的大小上限
+    """
+
+    def middleware(environ, start_response):
+        encoding = environ.get("HTTP_CONTENT_ENCODING", "").strip().lower()
+        if encoding in ("", "identity"):
+            return wsgi_app(environ, start_response)
+        length = int(environ.get("CONTENT_LENGTH") or 0)
+        try:
+            body = decompress_stream(environ["wsgi.input"], length, encoding, limit)
+        except (LookupError, ValueError) as err:
+            status = "415 Unsupported Media Type" if isinstance(err, LookupError) else "400 Bad Request"
+            start_response(status, [("Content-Type", "text/plain; charset=utf-8")])
+            return [str(err).encode()]
+        environ = dict(environ)
+        del environ["HTTP_CONTENT_ENCODING"]
+        environ["wsgi.input"] = io.BytesIO(body)
+        environ["CONTENT_LENGTH"] = str(len(body))
+        return wsgi_app(environ, start_response)
+
+    return middleware
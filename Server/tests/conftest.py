@@ -0,0 +1,8 @@
+# -*- coding: utf-8 -*-
+"""
+服务器的模块按顶层模块导入(import data), 测试时把 Server 文件夹加入 sys.path
+"""
+import os
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
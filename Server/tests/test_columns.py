@@ -0,0 +1,27 @@
+# -*- coding: utf-8 -*-
+"""
+ColumnTable 与 CSV 行的列表行为一致
+"""
+import columns
+
+
+def test_empty_rows():
+    """
+    全部是空行(列数为 0)时, 行数、下标、切片与迭代一致
+    """
+    table = columns.ColumnTable()
+    table.extend([[], []])
+    assert len(table) == 2
+    assert table.rows() == [[], []] and table[0] == table[-1] == [] and table[1:] == [[]]
+    assert list(table) == [[], []]
+    table.extend([["1", "a"], []])
+    assert list(table) == [[], [], ["1", "a"], []]
+    assert table[3] == [] and table.rows(0, 2) == [[], []]
+
+
+def test_ragged_rows_keep_text():
+    rows = [["1", "2.50"], ["x"], ["3", "", "1e3"]]
+    table = columns.ColumnTable()
+    for row in rows:
+        table.append(row)
+    assert list(table) == rows and table[::2] == rows[::2]
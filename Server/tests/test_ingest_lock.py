@@ -0,0 +1,125 @@
+# -*- coding: utf-8 -*-
+"""
+上传与登记表的并发: 多个线程同时登录、上传、心跳、过期检查后数据仍然一致,
+大批上传期间 refresh_nuc 不被阻塞
+"""
+import time
+import uuid
+import random
+import threading
+
+import pytest
+
+import data
+
+NAME = "stress"
+
+
+@pytest.fixture(autouse=True)
+def clean_registry():
+    for token in data.nuc.tokens():
+        data.nuc.remove(token)
+    yield
+    for token in data.nuc.tokens():
+        data.nuc.remove(token)
+
+
+def login() -> dict:
+    token = uuid.uuid4().hex
+    assert data.nuc_login(token, NAME, "u" + token[:8]) == 0
+    return data.nuc.get(token)
+
+
+def run_threads(targets: list, seconds: float = 0.0) -> list[BaseException]:
+    """
+    同时运行各个函数, 收集抛出的异常
+    """
+    errors = []
+
+    def wrap(target):
+        try:
+            target()
+        except BaseException as e:
+            errors.append(e)
+
+    threads = [threading.Thread(target=wrap, args=(target,)) for target in targets]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join(60 + seconds)
+    return errors
+
+
+def test_concurrent_ingest_keeps_invariants():
+    """
+    每个 nuc 的行数、接收时间与客户端发送的一致, 清空后轮次增加
+    """
+    sessions = [login() for _ in range(8)]
+    stop = threading.Event()
+    expected = {}
+
+    def upload(nuc_data):
+        rng = random.Random(nuc_data["token"])
+        sent, epoch = 0, nuc_data.get("epoch", 0)
+        for _ in range(200):
+            reset = rng.random() < 0.05
+            if reset:
+                sent = 0
+            rows = [[str(sent + i), "%.2f" % rng.random(), "x" if rng.random() < 0.1 else ""]
+                    for i in range(rng.randint(1, 50))]
+            assert data.nuc_append_data(nuc_data, rows, sent, reset) == 0
+            sent += len(rows)
+            if reset:
+                assert nuc_data["epoch"] > epoch
+                epoch = nuc_data["epoch"]
+            data.nuc.touch(nuc_data)
+        expected[nuc_data["token"]] = sent
+
+    def churn():
+        # 同一分片中不断有登录、过期检查与查询
+        while not stop.is_set():
+            login()
+            data.refresh_nuc()
+            data.nuc.snapshot()
+
+    uploaders = [lambda s=s: upload(s) for s in sessions]
+    errors = []
+    errors += run_threads([lambda: (errors.extend(run_threads(uploaders)), stop.set()), churn, churn])
+    assert not errors
+    for nuc_data in sessions:
+        table = nuc_data["data"]
+        assert len(table) == len(table.row_time) == expected[nuc_data["token"]]
+        assert [int(row[0]) for row in table] == list(range(len(table)))
+        assert data.nuc.get(nuc_data["token"]) is nuc_data
+
+
+def test_refresh_not_blocked_by_large_ingest():
+    """
+    一次上传 30 万行期间反复调用 refresh_nuc, 每次都应很快返回
+    """
+    big = login()
+    rows = [[str(i), "%.3f" % (i / 7), "%d" % (i * 3), "%.1f" % (i / 3), str(-i)] for i in range(300_000)]
+    done = threading.Event()
+    elapsed = []
+
+    def ingest():
+        start = time.perf_counter()
+        assert data.nuc_append_data(big, rows, 0) == 0
+        elapsed.append(time.perf_counter() - start)
+        done.set()
+
+    thread = threading.Thread(target=ingest)
+    thread.start()
+    latencies = []
+    while not done.is_set():
+        start = time.perf_counter()
+        data.refresh_nuc()
+        login()
+        latencies.append(time.perf_counter() - start)
+        time.sleep(0.005)
+    thread.join()
+    assert len(big["data"]) == len(rows)
+    if elapsed[0] < 0.5:
+        pytest.skip("上传太快(%.2fs), 无法判断是否阻塞" % elapsed[0])
+    # 以前要等到上传结束(数秒), 现在只受 GIL 切换影响
+    assert max(latencies) < elapsed[0] / 2, (max(latencies), elapsed[0])
@@ -0,0 +1,110 @@
+# -*- coding: utf-8 -*-
+"""
+请求体的流式解压: 每次只读取与产生一小块, 超过上限立即停止, 不会把整个请求体解压到内存
+上传数据的解析: 格式不正确时只抛出 ValueError
+"""
+import io
+import gzip
+import json
+import zlib
+import tracemalloc
+
+import pytest
+
+import payload
+
+BOMB_SIZE = 256 * 1024 * 1024  # 压缩炸弹解压后的大小
+LIMIT = 1024 * 1024
+
+
+class CountingStream(io.BytesIO):
+    """
+    记录读取了多少字节, 以及单次读取的最大字节数
+    """
+
+    def __init__(self, data: bytes):
+        super().__init__(data)
+        self.consumed = 0
+        self.largest = 0
+
+    def read(self, size: int = -1) -> bytes:
+        data = super().read(size)
+        self.consumed += len(data)
+        self.largest = max(self.largest, len(data))
+        return data
+
+
+def compress(encoding: str, size: int, block: bytes = b"\0" * (1024 * 1024)) -> bytes:
+    """
+    分块压缩 size 字节的 0, 测试本身也不需要把原始数据放在内存中
+    """
+    if encoding == "zstd":
+        compressor = payload.zstandard.ZstdCompressor().compressobj()
+    else:
+        compressor = zlib.compressobj(9, zlib.DEFLATED, 16 + zlib.MAX_WBITS if encoding == "gzip" else zlib.MAX_WBITS)
+    parts = [compressor.compress(block) for _ in range(size // len(block))]
+    return b"".join(parts) + compressor.flush()
+
+
+@pytest.fixture(params=payload.CONTENT_ENCODINGS)
+def encoding(request):
+    return request.param
+
+
+def test_bomb_stops_at_limit(encoding):
+    body = compress(encoding, BOMB_SIZE)
+    stream = CountingStream(body + b"next request")
+    tracemalloc.start()
+    try:
+        with pytest.raises(ValueError):
+            payload.decompress_stream(stream, len(body), encoding, LIMIT)
+        peak = tracemalloc.get_traced_memory()[1]
+    finally:
+        tracemalloc.stop()
+    # 解压出的数据刚超过上限就停止, 至多多读一块压缩数据
+    assert stream.consumed <= 2 * payload.READ_SIZE < len(body) or stream.consumed == len(body) <= payload.READ_SIZE
+    assert stream.largest <= payload.READ_SIZE
+    assert peak < 4 * LIMIT, peak
+
+
+def test_chunks_are_bounded(encoding):
+    body = compress(encoding, 8 * 1024 * 1024)
+    stream = CountingStream(body + b"next request")
+    total = 0
+    for chunk in payload.iter_decompress(stream, len(body), encoding):
+        assert len(chunk) <= payload.READ_SIZE
+        total += len(chunk)
+    assert total == 8 * 1024 * 1024
+    # 不会读到连接中的下一个请求
+    assert stream.consumed == len(body) and stream.read() == b"next request"
+
+
+def test_truncated_body(encoding):
+    """
+    与客户端一样一次压缩整个请求体(zstd 的帧头中记录了原始大小), 截断后应报错
+    """
+    raw = b"0123456789" * 100_000
+    if encoding == "zstd":
+        body = payload.zstandard.ZstdCompressor(level=3).compress(raw)
+    elif encoding == "gzip":
+        body = gzip.compress(raw)
+    else:
+        body = zlib.compress(raw)
+    body = body[:len(body) // 2]
+    with pytest.raises(ValueError):
+        payload.decompress(body, encoding)
+
+
+@pytest.mark.parametrize("loads", [json.loads, getattr(payload.orjson, "loads", None)], ids=["json", "orjson"])
+@pytest.mark.parametrize("data_format", ["json/1", "repr", None])
+@pytest.mark.parametrize("text", ["[" * 100_000, "[" * 100_000 + "]" * 100_000, "[[" * 300 + "]]" * 300])
+def test_nested_rows(monkeypatch, loads, data_format, text):
+    """
+    嵌套过深或结构不对的数据是格式错误(客户端收到 400), 不能变成服务器内部错误
+    没有安装 orjson 时使用标准库 json, 两者都要检查
+    """
+    if loads is None:
+        pytest.skip("没有安装 orjson")
+    monkeypatch.setattr(payload, "_json_loads", loads)
+    with pytest.raises(ValueError):
+        payload.decode_rows(text, data_format)
@@ -0,0 +1,44 @@
+# -*- coding: utf-8 -*-
+"""
+nuc_stats 的缓存与非有限值
+"""
+import json
+
+import pytest
+
+import data
+
+TOKEN = "c" * 32
+
+
+@pytest.fixture
+def nuc_data():
+    """
+    登录一个 nuc, 测试结束(包括断言失败)后断开, 不影响其他测试
+    """
+    data.nuc.remove(TOKEN)
+    assert data.nuc_login(TOKEN, "stats", "u") == 0
+    yield data.nuc.get(TOKEN)
+    data.nuc.remove(TOKEN)
+
+
+def test_cache_not_reused_after_relogin(nuc_data):
+    """
+    同一个令牌断开后重新登录, epoch 重新从 1 开始, 不能返回上一次登录时缓存的结果
+    """
+    data.nuc_append_data(nuc_data, [["1"], ["2"]], 0)
+    assert data.nuc_stats(nuc_data)["columns"][0]["max"] == 2
+    data.nuc.remove(TOKEN)
+    assert data.nuc_login(TOKEN, "stats", "u") == 0
+    relogged = data.nuc.get(TOKEN)
+    data.nuc_append_data(relogged, [["7"], ["9"]], 0)
+    assert relogged["epoch"] == 1
+    assert data.nuc_stats(relogged)["columns"][0]["max"] == 9
+
+
+def test_non_finite_values_are_null(nuc_data):
+    data.nuc_append_data(nuc_data, [["1", "inf"], ["-inf", "2"], ["3", "4"]], 0)
+    stats = data.nuc_stats(nuc_data)
+    json.dumps(stats, allow_nan=False)
+    assert stats["columns"][0]["mean"] is None and stats["columns"][1]["min"] == 2
+    json.dumps(data.nuc_query(nuc_data), allow_nan=False)
@@ -0,0 +1,67 @@
+# -*- coding: utf-8 -*-
+"""
+跟踪数据的段文件: 空段不影响按时间查询, 读取与写入在不同线程中时只读取已写出的记录
+"""
+import sys
+import threading
+
+import track_segments
+
+
+def test_empty_segment_in_ranges(tmp_path):
+    """
+    新建段之后还没有写入(或写入前中断)时, 按时间导出不出错
+    """
+    log = track_segments.SegmentLog(str(tmp_path))
+    log.extend(1_000, [["1"], ["2"]])
+    log._new_segment(2)
+    assert list(log.rows(start_ns=500)) == [(1_000, ["1"]), (1_000, ["2"])]
+    assert list(log.rows(start_ns=2_000)) == []
+    log.close()
+    log = track_segments.SegmentLog(str(tmp_path))
+    assert len(log.segments) == 2 and not log.segments[-1].count
+    assert list(log.rows(start_ns=500, stop_ns=2_000)) == [(1_000, ["1"]), (1_000, ["2"])]
+    log.extend(3_000, [["3", "x"]])
+    assert list(log.rows(start_ns=2_000)) == [(3_000, ["3", "x"])]
+    log.close()
+
+
+def test_read_while_appending(tmp_path):
+    """
+    写入线程不断追加(不写出缓冲), 读取线程同时导出, 每次读到的都是完整的前若干行
+    """
+    log = track_segments.SegmentLog(str(tmp_path))
+    log.extend(0, [["0"]])
+    total = 20_000
+    errors = []
+
+    def write():
+        for i in range(1, total):
+            log.append(i, [str(i), "t%d" % i if i % 7 == 0 else "%.2f" % (i / 4)])
+
+    def read():
+        try:
+            while writer.is_alive():
+                rows = list(log.rows(start_ns=0))
+                for k, (time_ns, row) in enumerate(rows):
+                    assert time_ns == k and row[0] == str(k), (k, time_ns, row)
+        except BaseException as e:
+            errors.append(e)
+
+    writer = threading.Thread(target=write)
+    readers = [threading.Thread(target=read) for _ in range(2)]
+    interval = sys.getswitchinterval()
+    sys.setswitchinterval(1e-6)  # 频繁切换线程, 写入更容易落在读取的写出缓冲与映射之间
+    try:
+        writer.start()
+        for reader in readers:
+            reader.start()
+        writer.join()
+        for reader in readers:
+            reader.join()
+    finally:
+        sys.setswitchinterval(interval)
+    assert not errors, errors[0]
+    rows = list(log.rows())
+    assert len(rows) == total and rows[14][1] == ["14", "t14"]
+    log.close()
@@ -0,0 +1,36 @@
+# -*- coding: utf-8 -*-
+"""
+跟踪中的 nuc: 旧版客户端每次上传整个文件, 跟踪的数据不重复
+"""
+import pytest
+
+import data
+
+TOKEN = "d" * 32
+
+
+@pytest.fixture
+def tracked(tmp_path, monkeypatch):
+    monkeypatch.setitem(data.CONFIG_DATA["paths_server"], "track_to", str(tmp_path / "{nuc_name}-{nuc_user}"))
+    assert data.nuc_login(TOKEN, "track", "u") == 0
+    assert data.track_nuc(TOKEN)
+    yield data.nuc.get(TOKEN)
+    data.untrack_nuc(TOKEN)
+    data.nuc.remove(TOKEN)
+
+
+def tracked_rows(track_data) -> tuple[list, list]:
+    return [row for _, row in track_data["data"].rows()], [row for _, row in track_data["disk"].rows()]
+
+
+def test_full_file_uploads_are_not_duplicated(tracked):
+    track_data = data.track_and_cache_data[TOKEN]
+    lines = [[str(i), "%.1f" % (i / 2)] for i in range(10)]
+    for end in (3, 3, 7, 10):
+        # 旧版客户端: 没有 seq, 每次清空后上传整个文件
+        assert data.nuc_append_data(tracked, lines[:end], 0, True) == 0
+    assert tracked_rows(track_data) == (lines, lines)
+    # 文件被替换, 开头不同, 新文件的行全部跟踪
+    new = [["a"], ["b"]]
+    assert data.nuc_append_data(tracked, new, 0, True) == 0
+    assert tracked_rows(track_data) == (lines + new, lines + new)
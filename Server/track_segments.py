@@ -0,0 +1,379 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+跟踪数据的磁盘存储: 只追加的定长二进制段文件, 读取时通过 mmap
+每个 nuc 一个文件夹, 文件夹中按序号保存段文件 000000.seg, 000001.seg ...
+段文件格式(小端):
+  文件头 16 字节: b"NUMT", 版本号(uint16), 宽度(uint16), 8 字节保留
+  之后每条记录: 时间戳 int64(ns) + 列数 uint16 + 宽度个 float64 + 宽度个 uint8 格式
+  比宽度短的行用 nan 补齐, 格式见 FORMAT_SHORTEST, FORMAT_TEXT, 其余为 "%.{格式 - 1}f"
+按格式写不回原文的单元格(表头、"nan"、"1e3" 等)另外保存在同名的 .txt 文件中, 每行一个 JSON: [记录序号, 列, 原文]
+行比宽度长或文件超过大小上限时开始新的段, 新段的宽度至少翻倍, 列数变化产生的段数是对数级的
+只有最后一个段打开用于写入, 其余的段只在读取时映射
+写入与读取可以在不同的线程中: 每个段有自己的锁, 读取时在锁中写出缓冲并取得记录数, 只映射这些记录
+每个段在内存中只保留稀疏的时间戳索引(每 INDEX_STEP 条记录一个), 范围查询先二分索引再二分块内
+"""
+import os
+import re
+import mmap
+import json
+import math
+import array
+import bisect
+import struct
+import typing
+import hashlib
+import threading
+
+import columns
+
+MAGIC = b"NUMT"
+FORMAT_VERSION = 2
+HEADER = struct.Struct("<4sHH8x")
+TIME = struct.Struct("<q")
+INDEX_STEP = 1024  # 稀疏索引的间隔(条)
+SEGMENT_SIZE = 64 * 1024 * 1024  # 段文件大小上限(字节)
+MAX_WIDTH = 0xFFFF  # 每行最多的列数
+FORMAT_SHORTEST = 0  # 整数不带小数点, 其余同 repr, nan 为空单元格
+FORMAT_TEXT = 0xFF  # 原文保存在 .txt 文件中
+
+
+def format_value(value: float) -> str:
+    """
+    将记录中的值转回单元格文本, nan 为空单元格
+    """
+    if math.isnan(value):
+        return ""
+    if value.is_integer() and abs(value) < 2 ** 53:
+        return str(int(value))
+    return repr(value)
+
+
+def encode_cell(cell: str) -> tuple[float, int]:
+    """
+    :return: (记录中的值, 格式), 格式为 FORMAT_TEXT 时需要另外保存原文
+    """
+    value = columns.parse_cell(cell)
+    if value is None:
+        return math.nan, FORMAT_TEXT
+    if format_value(value) == cell:
+        return value, FORMAT_SHORTEST
+    point = cell.find(".")
+    if value == value and point >= 0:
+        decimals = len(cell) - point - 1
+        if decimals < FORMAT_TEXT - 1 and "%.*f" % (decimals, value) == cell:
+            return value, decimals + 1
+    return math.nan, FORMAT_TEXT
+
+
+def decode_cell(value: float, fmt: int) -> str:
+    """
+    encode_cell 的逆过程, FORMAT_TEXT 由调用方处理
+    """
+    if fmt == FORMAT_SHORTEST:
+        return format_value(value)
+    return "%.*f" % (fmt - 1, value)
+
+
+def path_part(name: str) -> str:
+    """
+    :return: 可以安全地作为路径中一级文件夹名的字符串
+             只含字母、数字、"_"、"-"、"." 且不以 "." 开头的名称不变, 否则替换其余字符并加上名称的哈希值避免重名
+    """
+    if re.fullmatch(r"[\w-][\w.-]*", name):
+        return name
+    return "%s-%s" % (re.sub(r"[^\w.-]", "_", name).lstrip("."), hashlib.sha1(name.encode()).hexdigest()[:8])
+
+
+class Segment:
+    """
+    单个段文件
+    """
+
+    def __init__(self, path: str, width: int | None = None):
+        """
+        :param path: 段文件路径
+        :param width: 宽度, 不为 None 时新建段文件, 否则打开已有的段文件
+        :raise ValueError: 文件头不正确
+        """
+        self.path = path
+        self.text_path = path[:-4] + ".txt"
+        self.lock = threading.Lock()  # 写入缓冲与 count 一起变化, 读取方在锁中取得两者一致的状态
+        if width is not None:
+            with open(path, "xb") as fp:
+                fp.write(HEADER.pack(MAGIC, FORMAT_VERSION, width))
+        with open(path, "rb") as fp:
+            magic, version, width = HEADER.unpack(fp.read(HEADER.size))
+        if magic != MAGIC or version != FORMAT_VERSION:
+            raise ValueError("不是段文件或版本不支持: %s" % path)
+        self.width = width
+        self.record = struct.Struct("<qH%dd%dB" % (width, width))
+        size = os.path.getsize(path)
+        self.count = (size - HEADER.size) // self.record.size
+        if HEADER.size + self.count * self.record.size != size:
+            # 上次写入时中断, 丢弃不完整的记录
+            os.truncate(path, HEADER.size + self.count * self.record.size)
+        self._fp = None  # 写入时才打开
+        self._text_fp = None
+        self._drop_texts()
+        self._map = None
+        self._mapped = 0  # 已映射的记录数
+        self.index = array.array("q")  # 第 k 项是第 k * INDEX_STEP 条记录的时间戳
+        for i in range(0, self.count, INDEX_STEP):
+            self.index.append(self.time_at(i))
+        self.unmap()
+
+    @property
+    def nbytes(self) -> int:
+        return HEADER.size + self.count * self.record.size
+
+    @property
+    def first_time(self) -> int | None:
+        return self.index[0] if self.index else None
+
+    def _drop_texts(self):
+        """
+        丢弃 .txt 中不属于已有记录的原文(上次写入时中断), 否则之后追加的记录会用到它们
+        """
+        if not os.path.exists(self.text_path):
+            return
+        texts = self.texts()
+        with open(self.text_path, "r", encoding="utf-8") as fp:
+            lines = sum(1 for _ in fp)
+        if lines != len(texts):
+            with open(self.text_path, "w", encoding="utf-8") as fp:
+                for (record, column), text in texts.items():
+                    fp.write(json.dumps([record, column, text], ensure_ascii=False) + "\n")
+
+    def append(self, time_ns: int, row: typing.Sequence[str]):
+        """
+        追加一条记录
+        :param time_ns: 时间戳(ns), 不应小于已有的时间戳
+        :param row: CSV 行, 长度不超过宽度
+        """
+        values = [math.nan] * self.width
+        formats = [FORMAT_SHORTEST] * self.width
+        for i, cell in enumerate(row):
+            values[i], formats[i] = encode_cell(cell)
+        record = self.record.pack(time_ns, len(row), *values, *formats)
+        with self.lock:
+            if self._text_fp is None and FORMAT_TEXT in formats:
+                self._text_fp = open(self.text_path, "a", encoding="utf-8")
+            for i, cell in enumerate(row):
+                if formats[i] == FORMAT_TEXT:
+                    self._text_fp.write(json.dumps([self.count, i, cell], ensure_ascii=False) + "\n")
+            if self._fp is None:
+                self._fp = open(self.path, "ab")
+            self._fp.write(record)
+            if self.count % INDEX_STEP == 0:
+                self.index.append(time_ns)
+            self.count += 1
+
+    def _flush(self) -> int:
+        """
+        写出缓冲, 调用时持有 lock
+        :return: 文件中完整的记录数
+        """
+        for fp in (self._text_fp, self._fp):
+            if fp is not None:
+                fp.flush()
+        return self.count
+
+    def flush(self) -> int:
+        """
+        :return: 文件中完整的记录数, 读取方只应使用这么多记录
+        """
+        with self.lock:
+            return self._flush()
+
+    def close(self):
+        """
+        关闭写入用的文件并释放映射, 之后仍可以读取
+        """
+        with self.lock:
+            for fp in (self._text_fp, self._fp):
+                if fp is not None:
+                    fp.close()
+            self._fp = self._text_fp = None
+            self._map = None
+            self._mapped = 0
+
+    def unmap(self):
+        """
+        释放映射, 仍有 memoryview 引用时由垃圾回收关闭
+        """
+        with self.lock:
+            self._map = None
+            self._mapped = 0
+
+    def _view(self, need: int) -> memoryview:
+        """
+        :param need: 需要的记录数, 不超过已有的记录数
+        :return: 文件开头至少 need 条记录的只读 memoryview, 不够时重新映射
+                 只映射锁中写出缓冲后的记录数, 与之后继续写入的记录无关
+        """
+        with self.lock:
+            if self._map is None or self._mapped < need:
+                count = self._flush()
+                with open(self.path, "rb") as fp:
+                    self._map = mmap.mmap(fp.fileno(), HEADER.size + count * self.record.size, access=mmap.ACCESS_READ)
+                self._mapped = count
+            return memoryview(self._map)
+
+    def time_at(self, i: int) -> int:
+        """
+        :return: 第 i 条记录的时间戳
+        """
+        return TIME.unpack_from(self._view(i + 1), HEADER.size + i * self.record.size)[0]
+
+    def search(self, time_ns: int) -> int:
+        """
+        :return: 第一条时间戳不小于 time_ns 的记录序号, 都小于时返回 count
+        """
+        block = bisect.bisect_left(self.index, time_ns)
+        lo = max(block - 1, 0) * INDEX_STEP
+        hi = min(block * INDEX_STEP, self.count)
+        while lo < hi:
+            mid = (lo + hi) // 2
+            if self.time_at(mid) < time_ns:
+                lo = mid + 1
+            else:
+                hi = mid
+        return lo
+
+    def records(self, start: int = 0, stop: int | None = None) -> memoryview:
+        """
+        :return: 第 start 到 stop 条记录的原始字节, 直接引用 mmap, 不复制
+        """
+        if stop is None:
+            stop = self.count
+        view = self._view(stop)
+        return view[HEADER.size + start * self.record.size:HEADER.size + stop * self.record.size]
+
+    def texts(self) -> dict[tuple[int, int], str]:
+        """
+        :return: {(记录序号, 列): 原文}, 只包含已有的记录
+        """
+        count = self.flush()
+        texts = {}
+        if not os.path.exists(self.text_path):
+            return texts
+        with open(self.text_path, "r", encoding="utf-8") as fp:
+            for line in fp:
+                try:
+                    record, column, text = json.loads(line)
+                except ValueError:
+                    continue  # 写入时中断的最后一行
+                if record < count:
+                    texts[record, column] = text
+        return texts
+
+    def rows(self, start: int = 0, stop: int | None = None) -> typing.Iterator[tuple[int, list[str, ...]]]:
+        """
+        :return: 第 start 到 stop 条记录对应的 (时间戳(ns), CSV 行), 从 mmap 逐条解析
+        """
+        texts = self.texts()
+        width = self.width
+        for i, (time_ns, length, *cells) in enumerate(self.record.iter_unpack(self.records(start, stop)), start):
+            yield time_ns, [texts.get((i, c), "") if cells[width + c] == FORMAT_TEXT
+                            else decode_cell(cells[c], cells[width + c]) for c in range(length)]
+
+
+class SegmentLog:
+    """
+    单个 nuc 的全部段文件
+    接口与 track_store.TrackStore 一致的部分: append, extend, rows, __len__
+    """
+
+    def __init__(self, directory: str, segment_size: int = SEGMENT_SIZE):
+        """
+        :param directory: 保存段文件的文件夹, 不存在时新建, 已有的段文件会被继续使用
+        :param segment_size: 段文件大小上限(字节)
+        """
+        self.directory = directory
+        self.segment_size = segment_size
+        os.makedirs(directory, exist_ok=True)
+        names = sorted(i for i in os.listdir(directory) if i.endswith(".seg"))
+        self.segments = [Segment(os.path.join(directory, i)) for i in names]
+        self._last_time = self.segments[-1].time_at(self.segments[-1].count - 1) \
+            if self.segments and self.segments[-1].count else -1
+        if self.segments:
+            self.segments[-1].unmap()
+
+    def __len__(self):
+        return sum(i.count for i in self.segments)
+
+    def _new_segment(self, width: int) -> Segment:
+        if self.segments:
+            # 之前的段不再写入, 关闭文件
+            self.segments[-1].close()
+            number = int(os.path.basename(self.segments[-1].path)[:-4]) + 1
+        else:
+            number = 0
+        segment = Segment(os.path.join(self.directory, "%06d.seg" % number), width)
+        self.segments.append(segment)
+        return segment
+
+    def append(self, time_ns: int, row: typing.Sequence[str]):
+        """
+        追加一行, 时间戳比上一行小时(系统时间被调整)按上一行的时间戳保存, 保证有序
+        :param time_ns: 时间戳(ns)
+        :param row: CSV 行
+        :raise ValueError: 列数超过 MAX_WIDTH
+        """
+        if len(row) > MAX_WIDTH:
+            raise ValueError("列数超过 %d" % MAX_WIDTH)
+        time_ns = max(time_ns, self._last_time)
+        self._last_time = time_ns
+        segment = self.segments[-1] if self.segments else None
+        if segment is None:
+            segment = self._new_segment(len(row))
+        elif len(row) > segment.width:
+            segment = self._new_segment(min(max(len(row), 2 * segment.width), MAX_WIDTH))
+        elif segment.nbytes + segment.record.size > self.segment_size:
+            segment = self._new_segment(segment.width)
+        segment.append(time_ns, row)
+
+    def extend(self, time_ns: int, rows: typing.Iterable[typing.Sequence[str]]):
+        """
+        以同一个时间戳追加多行
+        """
+        for row in rows:
+            self.append(time_ns, row)
+        if self.segments:
+            self.segments[-1].flush()
+
+    def close(self):
+        for segment in self.segments:
+            segment.close()
+
+    def ranges(self, start_ns: int | None = None, stop_ns: int | None = None) \
+            -> typing.Iterator[tuple[Segment, int, int]]:
+        """
+        :return: 时间戳在 [start_ns, stop_ns) 内的记录, 每个段一组 (段, 开始序号, 结束序号)
+        """
+        # 新建后还没有写入的段(写入前中断, 或正在写入第一条)没有时间戳, 不参与查找
+        segments = [i for i in self.segments if i.count]
+        first = 0
+        if start_ns is not None:
+            # 跳过最后一条记录早于 start_ns 的段
+            first = max(bisect.bisect_right([i.first_time for i in segments], start_ns) - 1, 0)
+        for segment in segments[first:]:
+            if stop_ns is not None and segment.first_time >= stop_ns:
+                break
+            start = 0 if start_ns is None else segment.search(start_ns)
+            stop = segment.count if stop_ns is None else segment.search(stop_ns)
+            if start < stop:
+                yield segment, start, stop
+            elif segment is not segments[-1]:
+                segment.unmap()
+
+    def rows(self, start_ns: int | None = None, stop_ns: int | None = None) \
+            -> typing.Iterator[tuple[int, list[str, ...]]]:
+        """
+        从旧到新返回时间戳在 [start_ns, stop_ns) 内的 (时间戳(ns), CSV 行)
+        读完一个段后释放它的映射, 同时打开的文件数与段数无关
+        """
+        for segment, start, stop in self.ranges(start_ns, stop_ns):
+            yield from segment.rows(start, stop)
+            segment.unmap()
@@ -0,0 +1,139 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+跟踪数据的按列存储
+每个被跟踪的 nuc 一个 TrackStore: 由若干定长的块组成, 每块是一列时间戳(ns) + 一个 columns.ColumnTable
+列的类型与读回的文本都由 ColumnTable 负责: 表头等少数文本单元格不会改变列的类型, 导出的文本与上传时完全一致
+容量满或超过保留时间的旧数据被丢弃, 整块用完后释放, 每个 nuc 的内存占用不超过 容量 + 一块
+"""
+import array
+import bisect
+import typing
+import collections
+
+import columns
+
+CHUNK_ROWS = 4096  # 每块的行数
+
+
+class _Chunk:
+    """
+    TrackStore 中的一块, 只追加, 写满后不再变化
+    """
+
+    def __init__(self):
+        self.times = array.array("q")  # 时间戳(ns)
+        self.table = columns.ColumnTable()
+
+
+class TrackStore:
+    """
+    单个 nuc 的跟踪数据, 按块组织的按列存储
+    追加为均摊 O(1), 最旧的数据在容量满或超过保留时间后被丢弃
+    """
+
+    def __init__(self, capacity: int = 86400, retention: float | None = None):
+        """
+        :param capacity: 最多保存的行数
+        :param retention: 最长保存时间(s), None 表示只受容量限制
+        """
+        if capacity <= 0:
+            raise ValueError("容量必须为正数")
+        self.capacity = capacity
+        self.retention = retention
+        self.chunk_rows = min(CHUNK_ROWS, capacity)
+        self._chunks: collections.deque[_Chunk] = collections.deque()
+        self._skip = 0  # 第一块中已被丢弃的行数
+        self._count = 0
+        self._last_time = -1
+
+    def __len__(self):
+        return self._count
+
+    def _drop(self, rows: int):
+        """
+        丢弃最旧的 rows 行, 整块丢弃后释放
+        """
+        while rows:
+            first = self._chunks[0]
+            remaining = len(first.times) - self._skip
+            if rows < remaining:
+                self._skip += rows
+                self._count -= rows
+                return
+            self._chunks.popleft()
+            self._skip = 0
+            self._count -= remaining
+            rows -= remaining
+
+    def _evict_expired(self, now_ns: int):
+        if self.retention is None:
+            return
+        limit = now_ns - int(self.retention * 1e9)
+        while self._count:
+            # 同一块中的时间戳递增
+            first = self._chunks[0]
+            expired = bisect.bisect_left(first.times, limit, self._skip) - self._skip
+            if not expired:
+                return
+            self._drop(expired)
+
+    def append(self, time_ns: int, row: typing.Sequence[str]):
+        """
+        追加一行, 已满时丢弃最旧的一行
+        :param time_ns: 时间戳(ns)
+        :param row: CSV 行
+        """
+        self.extend(time_ns, [row])
+
+    def extend(self, time_ns: int, rows: typing.Iterable[typing.Sequence[str]]):
+        """
+        以同一个时间戳追加多行, 每块整批写入
+        时间戳比上一行小时(系统时间被调整)按上一行的时间戳保存, 保证有序
+        """
+        rows = list(rows)[-self.capacity:]
+        time_ns = self._last_time = max(time_ns, self._last_time)
+        self._evict_expired(time_ns)
+        done = 0
+        while done < len(rows):
+            last = self._chunks[-1] if self._chunks else None
+            if last is None or len(last.times) == self.chunk_rows:
+                last = _Chunk()
+                self._chunks.append(last)
+            batch = rows[done:done + self.chunk_rows - len(last.times)]
+            # 先写数据再写时间戳, 读取时以时间戳的个数为准
+            last.table.extend(batch)
+            last.times.extend([time_ns] * len(batch))
+            self._count += len(batch)
+            done += len(batch)
+        if self._count > self.capacity:
+            self._drop(self._count - self.capacity)
+
+    def rows(self, start_ns: int | None = None, stop_ns: int | None = None) \
+            -> typing.Iterator[tuple[int, list[str, ...]]]:
+        """
+        从旧到新返回时间戳在 [start_ns, stop_ns) 内的 (时间戳(ns), CSV 行)
+        只返回开始迭代时已有的行
+        """
+        chunks, skip, count = list(self._chunks), self._skip, self._count
+        for chunk in chunks:
+            if count <= 0:
+                return
+            stop = min(len(chunk.times), skip + count)
+            count -= stop - skip
+            first, last = skip, stop
+            skip = 0
+            if start_ns is not None:
+                first = bisect.bisect_left(chunk.times, start_ns, first, last)
+            if stop_ns is not None:
+                last = bisect.bisect_left(chunk.times, stop_ns, first, last)
+            if first < last:
+                yield from zip(chunk.times[first:last], chunk.table.rows(first, last))
+            if stop_ns is not None and last < stop:
+                return
+
+    def nbytes(self) -> int:
+        """
+        :return: 大约占用的字节数, 见 columns.ColumnTable.nbytes
+        """
+        return sum(chunk.times.itemsize * len(chunk.times) + chunk.table.nbytes() for chunk in self._chunks)